@@ -1,5 +1,8 @@
 from django.contrib import admin
-from .models import User, Category, SubCategory, Product, ProductImage, ContactMessage, Favorite
+from .models import (
+    User, Category, SubCategory, Product, ProductImage, ContactMessage, Favorite, ProductChangeCompaction,
+    InventoryReservation, ArchivedProduct
+)
 # Register your models here.
 
 admin.site.register(User)
@@ -8,4 +11,7 @@ admin.site.register(SubCategory)
 admin.site.register(Product)
 admin.site.register(ProductImage)
 admin.site.register(ContactMessage)
-admin.site.register(Favorite)
\ No newline at end of file
+admin.site.register(Favorite)
+admin.site.register(ProductChangeCompaction)
+admin.site.register(InventoryReservation)
+admin.site.register(ArchivedProduct)
\ No newline at end of file
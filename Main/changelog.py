@@ -0,0 +1,95 @@
+# changelog.py
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from .models import ProductChange, ProductChangeCompaction
+
+
+class ResyncRequired(Exception):
+    """The sync token predates compacted tombstones"""
+
+
+def record_change(product_id, action='upsert'):
+    """Append to the change log inside the caller's transaction"""
+    ProductChange.objects.create(product_id=product_id, action=action)
+
+
+def record_changes(product_ids, action='upsert'):
+    """record_change() for many products in one INSERT"""
+    ProductChange.objects.bulk_create(
+        [ProductChange(product_id=product_id, action=action) for product_id in product_ids]
+    )
+
+
+def settled_before():
+    """
+    Entries created after this are held back: on databases with concurrent
+    writers, a lower sequence number can commit after a higher one, and a
+    client that moved past it would never see it
+    """
+    return timezone.now() - timedelta(seconds=getattr(settings, 'PRODUCT_CHANGES_SETTLE_SECONDS', 2))
+
+
+def head_token():
+    """
+    Token for a client starting from a full download: the newest settled
+    entry, so entries still settling are served on its first delta sync
+    """
+    head = ProductChange.objects.filter(created_at__lte=settled_before()).aggregate(head=Max('id'))['head']
+    return max(head or 0, purged_through())
+
+
+def purged_through():
+    compaction = ProductChangeCompaction.objects.first()
+    return compaction.purged_through if compaction else 0
+
+
+def changes_since(since, limit):
+    """
+    Return ({product id: action}, next token, has_more) for log entries after
+    `since`. Only the latest action per product is kept. Entries younger than
+    PRODUCT_CHANGES_SETTLE_SECONDS are held back; see settled_before().
+    """
+    if since < purged_through():
+        raise ResyncRequired()
+    entries = list(
+        ProductChange.objects.filter(
+            id__gt=since, created_at__lte=settled_before()
+        ).order_by('id').values_list('id', 'product_id', 'action')[:limit + 1]
+    )
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+    latest = {}
+    for _, product_id, action in entries:
+        latest[product_id] = action
+    return latest, entries[-1][0] if entries else since, has_more
+
+
+def compact_changes():
+    """
+    Drop entries superseded by a newer entry for the same product; no token
+    can need them, since the newer entry is reported to every client that
+    would have seen the old one. Then purge tombstones older than
+    PRODUCT_CHANGES_TOMBSTONE_DAYS. Clients holding a token from before the
+    last purged tombstone must resync. Returns the number of rows removed.
+    """
+    tombstone_days = getattr(settings, 'PRODUCT_CHANGES_TOMBSTONE_DAYS', 30)
+    with transaction.atomic():
+        latest = ProductChange.objects.values('product_id').annotate(latest=Max('id')).values('latest')
+        removed, _ = ProductChange.objects.exclude(id__in=latest).delete()
+
+        expired = ProductChange.objects.filter(
+            action='delete', created_at__lt=timezone.now() - timedelta(days=tombstone_days)
+        )
+        horizon = expired.aggregate(horizon=Max('id'))['horizon']
+        if horizon is not None:
+            purged, _ = expired.filter(id__lte=horizon).delete()
+            removed += purged
+        ProductChangeCompaction.objects.create(
+            purged_through=max(horizon or 0, purged_through()), removed=removed
+        )
+    return removed
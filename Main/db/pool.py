@@ -0,0 +1,149 @@
+# pool.py
+import logging
+import os
+import queue
+import threading
+import time
+
+from django.db import OperationalError
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionPool:
+    """
+    Per-process pool of DB-API connections.
+
+    Up to `size` idle connections are kept open; `max_overflow` more may be
+    opened under load and are closed when handed back. When all of them are
+    checked out, callers wait up to `timeout` seconds before getting an
+    OperationalError. Connections idle for longer than `pre_ping` seconds
+    are checked with `ping` before reuse and replaced if they fail.
+    """
+
+    def __init__(self, connect=None, size=5, max_overflow=10, timeout=10.0, pre_ping=30.0,
+                 ping=None, name='default'):
+        self.connect = connect
+        self.size = size
+        self.max_overflow = max_overflow
+        self.timeout = timeout
+        self.pre_ping = pre_ping
+        self.ping = ping
+        self.name = name
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size + max_overflow)
+        self.lock = threading.Lock()
+        self.in_use = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.timeouts = 0
+
+    def acquire(self, connect=None):
+        """Check out a connection, opening one with `connect` if none is idle"""
+        started = time.perf_counter()
+        if not self.slots.acquire(blocking=False):
+            if not self.slots.acquire(timeout=self.timeout):
+                with self.lock:
+                    self.timeouts += 1
+                raise OperationalError(
+                    f'Connection pool "{self.name}" exhausted after {self.timeout}s '
+                    f'({self.size} + {self.max_overflow} connections in use)'
+                )
+            waited = time.perf_counter() - started
+            with self.lock:
+                self.waits += 1
+                self.wait_seconds_total += waited
+                self.wait_seconds_max = max(self.wait_seconds_max, waited)
+            if waited > 1:
+                logger.warning(f'Waited {waited:.3f}s for a "{self.name}" database connection')
+
+        try:
+            connection = self._take_idle()
+            if connection is None:
+                connection = (connect or self.connect)()
+        except Exception:
+            self.slots.release()
+            raise
+        with self.lock:
+            self.in_use += 1
+            self.checkouts += 1
+        return connection
+
+    def _take_idle(self):
+        while True:
+            try:
+                connection, released_at = self.idle.get_nowait()
+            except queue.Empty:
+                return None
+            if self.ping is None or time.monotonic() - released_at < self.pre_ping:
+                return connection
+            try:
+                self.ping(connection)
+                return connection
+            except Exception:
+                self._close(connection)
+
+    def release(self, connection, discard=False):
+        """Hand a connection back; broken or surplus connections are closed"""
+        try:
+            if discard or self.idle.qsize() >= self.size:
+                self._close(connection)
+            else:
+                self.idle.put((connection, time.monotonic()))
+        finally:
+            with self.lock:
+                self.in_use -= 1
+            self.slots.release()
+
+    def _close(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def close_idle(self):
+        while True:
+            try:
+                connection, _ = self.idle.get_nowait()
+            except queue.Empty:
+                return
+            self._close(connection)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': self.size,
+                'max_overflow': self.max_overflow,
+                'in_use': self.in_use,
+                'idle': self.idle.qsize(),
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'wait_seconds_total': round(self.wait_seconds_total, 6),
+                'wait_seconds_max': round(self.wait_seconds_max, 6),
+                'wait_seconds_avg': round(self.wait_seconds_total / self.waits, 6) if self.waits else 0.0,
+                'timeouts': self.timeouts,
+            }
+
+
+# One pool per database alias and process; forked workers build their own
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias, factory):
+    key = (alias, os.getpid())
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = factory()
+        return pool
+
+
+def pool_stats():
+    """Statistics of this process's pools, keyed by database alias"""
+    pid = os.getpid()
+    with _pools_lock:
+        pools = {alias: pool for (alias, owner), pool in _pools.items() if owner == pid}
+    return {alias: pool.stats() for alias, pool in pools.items()}
@@ -0,0 +1,54 @@
+# base.py
+from django.db.backends.postgresql import base
+from django.db.backends.postgresql.psycopg_any import IsolationLevel
+
+from ..pool import ConnectionPool, get_pool
+
+
+def _ping(connection):
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT 1')
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """
+    PostgreSQL backend that checks connections out of a per-process pool
+    instead of opening one per request (or per thread with CONN_MAX_AGE).
+    Configure it with a POOL dict next to the usual DATABASES keys:
+    SIZE, MAX_OVERFLOW, TIMEOUT and PRE_PING (seconds idle before a
+    connection is tested with SELECT 1).
+    """
+
+    def get_pool(self):
+        options = self.settings_dict.get('POOL', {})
+        return get_pool(self.alias, lambda: ConnectionPool(
+            size=options.get('SIZE', 5),
+            max_overflow=options.get('MAX_OVERFLOW', 10),
+            timeout=options.get('TIMEOUT', 10.0),
+            pre_ping=options.get('PRE_PING', 30.0),
+            ping=_ping,
+            name=self.alias,
+        ))
+
+    def get_new_connection(self, conn_params):
+        self.pool = self.get_pool()
+        connection = self.pool.acquire(lambda: super(DatabaseWrapper, self).get_new_connection(conn_params))
+        # Set by the parent only when it opens a connection itself
+        isolation_level = self.settings_dict['OPTIONS'].get('isolation_level')
+        self.isolation_level = (
+            IsolationLevel.READ_COMMITTED if isolation_level is None else IsolationLevel(isolation_level)
+        )
+        return connection
+
+    def _close(self):
+        if self.connection is None:
+            return
+        connection = self.connection
+        discard = connection.closed or (self.errors_occurred and not self.is_usable())
+        if not discard:
+            try:
+                # Never hand out a connection in the middle of a transaction
+                connection.rollback()
+            except Exception:
+                discard = True
+        self.pool.release(connection, discard=discard)
@@ -0,0 +1,46 @@
+# retry.py
+import logging
+import random
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connections
+
+logger = logging.getLogger(__name__)
+
+# Errors that mean another writer held the lock; the transaction did nothing
+LOCK_ERRORS = ('database is locked', 'database table is locked', 'deadlock detected',
+               'could not serialize access')
+
+
+def is_lock_error(error):
+    message = str(error).lower()
+    return any(text in message for text in LOCK_ERRORS)
+
+
+def retry_on_lock(func=None, *, using=DEFAULT_DB_ALIAS):
+    """
+    Re-run a write transaction that failed on lock contention, after an
+    exponential backoff with full jitter. Up to DB_LOCK_RETRIES retries,
+    starting from DB_LOCK_RETRY_DELAY seconds. The wrapped function must open
+    its own transaction.atomic() block. Inside an outer transaction the error
+    is raised right away, because only the outermost block can be retried.
+    """
+    if func is None:
+        return lambda func: retry_on_lock(func, using=using)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        retries = getattr(settings, 'DB_LOCK_RETRIES', 5)
+        delay = getattr(settings, 'DB_LOCK_RETRY_DELAY', 0.05)
+        for attempt in range(retries + 1):
+            try:
+                return func(*args, **kwargs)
+            except OperationalError as e:
+                if attempt == retries or connections[using].in_atomic_block or not is_lock_error(e):
+                    raise
+                pause = random.uniform(0, delay * 2 ** attempt)
+                logger.warning(f"Retrying {func.__name__} after lock contention ({attempt + 1}/{retries}): {e}")
+                time.sleep(pause)
+    return wrapper
@@ -0,0 +1,39 @@
+# base.py
+from django.db.backends.sqlite3 import base
+
+# Applied to every new connection unless overridden by PRAGMAS in DATABASES;
+# busy_timeout follows OPTIONS['timeout']
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 268435456,
+    'cache_size': -65536,
+    'temp_store': 'MEMORY',
+}
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """
+    SQLite backend tuned for concurrent web workers.
+
+    WAL lets readers run alongside the single writer, and synchronous=NORMAL
+    is safe in WAL mode. busy_timeout makes writers queue for the lock
+    instead of failing. Transactions start with BEGIN IMMEDIATE (see
+    TRANSACTION_MODE), so the write lock is taken up front. A deferred
+    transaction that upgrades from read to write cannot wait for the lock;
+    SQLite fails it at once with "database is locked".
+    """
+
+    def get_new_connection(self, conn_params):
+        connection = super().get_new_connection(conn_params)
+        pragmas = dict(DEFAULT_PRAGMAS, **self.settings_dict.get('PRAGMAS', {}))
+        pragmas.setdefault('busy_timeout', int(conn_params.get('timeout', 5) * 1000))
+        if self.is_in_memory_db():
+            pragmas.pop('journal_mode')
+        for name, value in pragmas.items():
+            connection.execute(f'PRAGMA {name} = {value}')
+        return connection
+
+    def _start_transaction_under_autocommit(self):
+        mode = self.settings_dict.get('TRANSACTION_MODE', 'IMMEDIATE')
+        self.cursor().execute(f'BEGIN {mode}')
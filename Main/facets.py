@@ -0,0 +1,271 @@
+# facets.py
+import threading
+import time
+from bisect import bisect_right
+from decimal import Decimal
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Product, units_for_base_unit
+from .resync import SyncedIndex
+from .routers import on_primary
+
+# Facets returned to clients; 'farmer' is indexed for filtering only
+FACETS = ('category', 'subcategory', 'organic', 'unit', 'location', 'price')
+INDEX_COLUMNS = ('id', 'status', 'category_id', 'subcategory_id', 'organic', 'unit',
+                 'location', 'price', 'farmer_id', 'price_per_base_unit')
+
+
+def _bitmap(ids):
+    """Build a bitmap (a Python int with bit `id` set) from product ids"""
+    ids = list(ids)
+    if not ids:
+        return 0
+    bits = bytearray(max(ids) // 8 + 1)
+    for pk in ids:
+        bits[pk >> 3] |= 1 << (pk & 7)
+    return int.from_bytes(bits, 'little')
+
+
+ID_FILTERS = ('category', 'subcategory', 'farmer')
+
+
+def parse_id_filters(params):
+    """
+    The category, subcategory and farmer ids in ProductListView's query
+    parameters, keyed by parameter; raises ValueError for one that isn't an id
+    """
+    ids = {}
+    for param in ID_FILTERS:
+        if params.get(param):
+            if not params[param].isdigit():
+                raise ValueError(f'{param} must be an id.')
+            ids[param] = int(params[param])
+    return ids
+
+
+class FacetIndex(SyncedIndex):
+    """
+    In-memory posting lists for the available products, one bitmap per facet
+    value, so facet counts for any filter combination are a few ANDs and
+    popcounts instead of one GROUP BY per facet. Unit prices are kept per
+    product for the min_unit_price/max_unit_price range filters.
+
+    Writes in this process are applied through signals once their
+    transaction commits; other workers' writes arrive through SyncedIndex.
+    A full rebuild every FACET_INDEX_MAX_AGE seconds catches hard deletes
+    and bulk updates.
+    """
+    generation_key = 'facets:generation'
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.postings = {}
+        self.documents = {}
+        self.unit_prices = {}
+        self.built_at = None
+        self.synced_at = None
+        self.generation = None
+
+    @property
+    def price_edges(self):
+        return [Decimal(str(edge)) for edge in getattr(
+            settings, 'FACET_PRICE_BUCKETS', [50, 100, 250, 500, 1000])]
+
+    def price_bucket(self, price):
+        return bisect_right(self.price_edges, Decimal(str(price)))
+
+    def facet_values(self, row):
+        return {
+            'category': row['category_id'],
+            'subcategory': row['subcategory_id'],
+            'organic': row['organic'],
+            'unit': row['unit'],
+            'location': row['location'],
+            'price': self.price_bucket(row['price']),
+            'farmer': row['farmer_id'],
+        }
+
+    def rebuild(self):
+        ids = {}
+        documents = {}
+        unit_prices = {}
+        rows = Product.objects.filter(status='available').order_by().values(*INDEX_COLUMNS)
+        synced_at = timezone.now()
+        for row in rows.iterator(chunk_size=5000):
+            values = self.facet_values(row)
+            documents[row['id']] = values
+            unit_prices[row['id']] = row['price_per_base_unit']
+            for facet, value in values.items():
+                ids.setdefault(facet, {}).setdefault(value, []).append(row['id'])
+
+        postings = {
+            facet: {value: _bitmap(pks) for value, pks in by_value.items()}
+            for facet, by_value in ids.items()
+        }
+        with self.lock:
+            self.postings = postings
+            self.documents = documents
+            self.unit_prices = unit_prices
+            self.built_at = time.monotonic()
+            self.synced_at = synced_at
+            self.generation = self.shared_generation()
+
+    def discard(self, pk):
+        with self.lock:
+            values = self.documents.pop(pk, None)
+            self.unit_prices.pop(pk, None)
+            if values is None:
+                return
+            mask = ~(1 << pk)
+            for facet, value in values.items():
+                bitmap = self.postings[facet][value] & mask
+                if bitmap:
+                    self.postings[facet][value] = bitmap
+                else:
+                    del self.postings[facet][value]
+
+    def index_row(self, row):
+        """Add, move or drop a product given its INDEX_COLUMNS values"""
+        with self.lock:
+            if self.built_at is None:
+                return
+            self.discard(row['id'])
+            if row['status'] != 'available':
+                return
+            values = self.facet_values(row)
+            self.documents[row['id']] = values
+            self.unit_prices[row['id']] = row['price_per_base_unit']
+            bit = 1 << row['id']
+            for facet, value in values.items():
+                facet_postings = self.postings.setdefault(facet, {})
+                facet_postings[value] = facet_postings.get(value, 0) | bit
+
+    def apply_changes(self, queryset):
+        for row in queryset.order_by().values(*INDEX_COLUMNS).iterator(chunk_size=5000):
+            self.index_row(row)
+
+    @on_primary
+    def ensure_fresh(self):
+        max_age = getattr(settings, 'FACET_INDEX_MAX_AGE', 300)
+        if self.built_at is None or time.monotonic() - self.built_at > max_age:
+            self.rebuild()
+            return
+        self.sync_if_changed()
+
+    def filter_bitmaps(self, params, search_ids=None, near_ids=None):
+        """Bitmap per active filter, keyed by the facet it constrains"""
+        postings = self.postings
+        filters = {}
+        for facet, pk in parse_id_filters(params).items():
+            filters[facet] = postings.get(facet, {}).get(pk, 0)
+        if params.get('organic'):
+            filters['organic'] = postings.get('organic', {}).get(params['organic'].lower() == 'true', 0)
+        if params.get('location'):
+            needle = params['location'].lower()
+            bitmap = 0
+            for location, bits in postings.get('location', {}).items():
+                if needle in location.lower():
+                    bitmap |= bits
+            filters['location'] = bitmap
+        if params.get('base_unit'):
+            filters['base_unit'] = 0
+            for unit in units_for_base_unit(params['base_unit']):
+                filters['base_unit'] |= postings.get('unit', {}).get(unit, 0)
+        # The list view has already rejected bounds that aren't numbers
+        low, high = (Decimal(params[name]) if params.get(name) else None
+                     for name in ('min_unit_price', 'max_unit_price'))
+        if low is not None or high is not None:
+            filters['unit_price'] = _bitmap(
+                pk for pk, price in self.unit_prices.items()
+                if (low is None or price >= low) and (high is None or price <= high)
+            )
+        if search_ids is not None:
+            filters['search'] = _bitmap(search_ids)
+        if near_ids is not None:
+            filters['near'] = _bitmap(near_ids)
+        return filters
+
+    def counts(self, params, search_ids=None, near_ids=None):
+        """
+        Facet counts for a ProductListView filter set; `search_ids` and
+        `near_ids` are the products matching its search and near= filters.
+        Each facet is counted against every filter except its own, so clients
+        can offer the alternatives to an active selection.
+        """
+        self.ensure_fresh()
+        location_limit = getattr(settings, 'FACET_LOCATION_LIMIT', 20)
+        with self.lock:
+            filters = self.filter_bitmaps(params, search_ids, near_ids)
+            everything = -1
+            result = {}
+            for facet in FACETS:
+                base = everything
+                for other, bitmap in filters.items():
+                    if other != facet:
+                        base &= bitmap
+                counts = []
+                for value, bitmap in self.postings.get(facet, {}).items():
+                    count = (bitmap & base).bit_count()
+                    if count:
+                        counts.append((value, count))
+                result[facet] = counts
+
+        result['location'] = sorted(result['location'], key=lambda item: -item[1])[:location_limit]
+        return self.format(result)
+
+    def format(self, result):
+        edges = self.price_edges
+        formatted = {}
+        for facet, counts in result.items():
+            if facet == 'price':
+                formatted[facet] = [{
+                    'min': str(edges[bucket - 1]) if bucket else '0',
+                    'max': str(edges[bucket]) if bucket < len(edges) else None,
+                    'count': count,
+                } for bucket, count in sorted(counts)]
+            elif facet == 'location':
+                formatted[facet] = [{'value': value, 'count': count} for value, count in counts]
+            else:
+                formatted[facet] = [
+                    {'value': value, 'count': count}
+                    for value, count in sorted(counts, key=lambda item: (item[0] is None, item[0]))
+                ]
+        return formatted
+
+
+facet_index = FacetIndex()
+
+
+def product_search_ids(search, semantic_ids=None):
+    """Ids of available products matching the ProductListView search term"""
+    matches = (
+        Q(name__icontains=search) |
+        Q(description__icontains=search) |
+        Q(category__name__icontains=search)
+    )
+    if semantic_ids:
+        matches |= Q(id__in=semantic_ids)
+    return Product.objects.filter(matches, status='available').values_list('id', flat=True)
+
+
+def facet_row(product, deleted=False):
+    """INDEX_COLUMNS values for a product instance; deleted products index as gone"""
+    row = {column: getattr(product, column) for column in INDEX_COLUMNS}
+    if deleted:
+        row['status'] = None
+    return row
+
+
+def mark_product_changed(row):
+    """Reindex a product locally and tell other workers to resync"""
+    mark_products_changed([row])
+
+
+def mark_products_changed(rows):
+    """Reindex products given their INDEX_COLUMNS values, with one resync notice"""
+    for row in rows:
+        facet_index.index_row(row)
+    facet_index.bump_generation()
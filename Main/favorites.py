@@ -0,0 +1,55 @@
+# favorites.py
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import Favorite, User
+
+
+def favorites_cache_key(user_id):
+    return f'favorites:{user_id}'
+
+
+def favorite_product_ids(user, product_ids=None):
+    """
+    Ids of the products a user has favorited, loaded with one query and
+    cached for FAVORITES_CACHE_TIMEOUT seconds when that is set (use it only
+    with a cache shared by all workers, e.g. Redis).
+
+    Without that cache, passing `product_ids` (the products about to be shown)
+    looks up only those instead of loading the whole set. The result may still
+    hold other ids, so callers should only test membership.
+    """
+    if user is None or not user.is_authenticated:
+        return frozenset()
+
+    timeout = getattr(settings, 'FAVORITES_CACHE_TIMEOUT', 0)
+    if not timeout and product_ids is not None:
+        if not product_ids:
+            return frozenset()
+        return frozenset(Favorite.objects.filter(
+            user=user, product_id__in=product_ids
+        ).values_list('product_id', flat=True))
+
+    key = favorites_cache_key(user.pk)
+    if timeout:
+        product_ids = cache.get(key)
+        if product_ids is not None:
+            return product_ids
+
+    product_ids = frozenset(Favorite.objects.filter(user=user).values_list('product_id', flat=True))
+    if timeout:
+        cache.set(key, product_ids, timeout)
+    return product_ids
+
+
+def invalidate_favorites(user_id):
+    if getattr(settings, 'FAVORITES_CACHE_TIMEOUT', 0):
+        cache.delete(favorites_cache_key(user_id))
+
+
+def lock_favorites(user_id):
+    """
+    Serialize a user's favorite writes until the transaction ends, so what
+    a write reads of their favorites stays true through its inserts
+    """
+    list(User.objects.select_for_update().filter(pk=user_id).values_list('pk'))
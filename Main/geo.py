@@ -0,0 +1,190 @@
+# geo.py
+import math
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import Product
+from .resync import SyncedIndex
+from .routers import on_primary
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = 111.32
+
+
+def coordinate_rows(queryset):
+    """(id, status, lat, lon) for products, falling back to the farm location"""
+    return queryset.order_by().annotate(
+        effective_latitude=Coalesce('latitude', 'farmer__farm_latitude'),
+        effective_longitude=Coalesce('longitude', 'farmer__farm_longitude'),
+    ).values_list('id', 'status', 'effective_latitude', 'effective_longitude')
+
+
+def haversine_km(lat, lon, lats, lons):
+    """Great-circle distance from one point to arrays of points, in km"""
+    lat, lon = math.radians(lat), math.radians(lon)
+    lats, lons = np.radians(lats), np.radians(lons)
+    a = (np.sin((lats - lat) / 2) ** 2
+         + math.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class GeoIndex(SyncedIndex):
+    """
+    Grid index over the coordinates of available products.
+
+    Points are bucketed into cells of GEO_CELL_DEGREES and stored in numpy
+    arrays sorted by cell number, so every row of cells inside a query's
+    bounding box is one contiguous slice found with searchsorted. Distances
+    are computed vectorized on those candidates only.
+
+    Writes land in a small overlay that is merged at query time; the arrays
+    are rebuilt once the overlay grows past GEO_OVERLAY_LIMIT or the index is
+    older than GEO_INDEX_MAX_AGE seconds. Other workers' writes arrive
+    through SyncedIndex.
+    """
+    generation_key = 'geo:generation'
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.built_at = None
+        self.synced_at = None
+        self.generation = None
+        self.overlay = {}
+        self.set_arrays([], [], [])
+
+    @property
+    def cell_degrees(self):
+        return getattr(settings, 'GEO_CELL_DEGREES', 0.1)
+
+    @property
+    def columns(self):
+        return int(math.ceil(360 / self.cell_degrees))
+
+    def cell_of(self, lats, lons):
+        max_row = int(math.ceil(180 / self.cell_degrees)) - 1
+        rows = np.floor((np.asarray(lats) + 90) / self.cell_degrees).astype(np.int64)
+        rows = np.minimum(rows, max_row)
+        cols = np.floor((np.asarray(lons) + 180) / self.cell_degrees).astype(np.int64)
+        return rows * self.columns + np.minimum(cols, self.columns - 1)
+
+    def set_arrays(self, ids, lats, lons):
+        ids = np.asarray(ids, dtype=np.int64)
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        cells = self.cell_of(lats, lons)
+        order = np.argsort(cells, kind='stable')
+        self.ids, self.lats, self.lons, self.cells = ids[order], lats[order], lons[order], cells[order]
+
+    def rebuild(self):
+        synced_at = timezone.now()
+        rows = coordinate_rows(Product.objects.filter(status='available'))
+        points = [(pk, float(lat), float(lon)) for pk, _, lat, lon in rows.iterator(chunk_size=10000)
+                  if lat is not None and lon is not None]
+        ids, lats, lons = zip(*points) if points else ((), (), ())
+        with self.lock:
+            self.set_arrays(ids, lats, lons)
+            self.overlay = {}
+            self.built_at = time.monotonic()
+            self.synced_at = synced_at
+            self.generation = self.shared_generation()
+
+    def apply_rows(self, rows):
+        """Record (id, status, lat, lon) rows in the overlay"""
+        with self.lock:
+            if self.built_at is None:
+                return
+            for pk, status, lat, lon in rows:
+                if status == 'available' and lat is not None and lon is not None:
+                    self.overlay[pk] = (float(lat), float(lon))
+                else:
+                    self.overlay[pk] = None
+
+    def apply_changes(self, queryset):
+        self.apply_rows(coordinate_rows(queryset))
+
+    @on_primary
+    def ensure_fresh(self):
+        max_age = getattr(settings, 'GEO_INDEX_MAX_AGE', 600)
+        overlay_limit = getattr(settings, 'GEO_OVERLAY_LIMIT', 10000)
+        if (self.built_at is None or time.monotonic() - self.built_at > max_age
+                or len(self.overlay) > overlay_limit):
+            self.rebuild()
+            return
+        self.sync_if_changed()
+
+    def candidate_slices(self, lat, lon, radius_km):
+        """Index ranges of the sorted arrays covering the query's bounding box"""
+        cell = self.cell_degrees
+        dlat = radius_km / KM_PER_DEGREE
+        cos_lat = math.cos(math.radians(min(abs(lat) + dlat, 90.0)))
+        dlon = 180.0 if cos_lat < 1e-6 else min(radius_km / (KM_PER_DEGREE * cos_lat), 180.0)
+
+        max_row = int(math.ceil(180 / cell)) - 1
+        row_min = max(int(math.floor((lat - dlat + 90) / cell)), 0)
+        row_max = min(int(math.floor((lat + dlat + 90) / cell)), max_row)
+
+        col_ranges = []
+        if dlon >= 180.0:
+            col_ranges.append((0, self.columns - 1))
+        else:
+            col_min = int(math.floor((lon - dlon + 180) / cell))
+            col_max = int(math.floor((lon + dlon + 180) / cell))
+            # Split boxes that cross the antimeridian
+            if col_min < 0:
+                col_ranges += [(col_min + self.columns, self.columns - 1), (0, col_max)]
+            elif col_max >= self.columns:
+                col_ranges += [(col_min, self.columns - 1), (0, col_max - self.columns)]
+            else:
+                col_ranges.append((col_min, col_max))
+
+        starts, ends = [], []
+        for row in range(row_min, row_max + 1):
+            for col_min, col_max in col_ranges:
+                starts.append(row * self.columns + col_min)
+                ends.append(row * self.columns + col_max)
+        left = np.searchsorted(self.cells, starts, side='left')
+        right = np.searchsorted(self.cells, ends, side='right')
+        return [(start, end) for start, end in zip(left, right) if end > start]
+
+    def nearby(self, lat, lon, radius_km, limit=None):
+        """[(product id, distance km)] within radius_km, nearest first"""
+        self.ensure_fresh()
+        with self.lock:
+            slices = self.candidate_slices(lat, lon, radius_km)
+            if slices:
+                index = np.concatenate([np.arange(start, end) for start, end in slices])
+                ids, lats, lons = self.ids[index], self.lats[index], self.lons[index]
+            else:
+                ids = np.empty(0, dtype=np.int64)
+                lats = lons = np.empty(0)
+            if self.overlay:
+                keep = ~np.isin(ids, np.fromiter(self.overlay, dtype=np.int64))
+                points = [(pk, point) for pk, point in self.overlay.items() if point]
+                ids = np.concatenate([ids[keep], np.array([pk for pk, _ in points], dtype=np.int64)])
+                lats = np.concatenate([lats[keep], np.array([p[0] for _, p in points], dtype=np.float64)])
+                lons = np.concatenate([lons[keep], np.array([p[1] for _, p in points], dtype=np.float64)])
+
+        distances = haversine_km(lat, lon, lats, lons)
+        inside = distances <= radius_km
+        ids, distances = ids[inside], distances[inside]
+        order = np.argsort(distances, kind='stable')
+        if limit is not None:
+            order = order[:limit]
+        return [(int(ids[i]), float(distances[i])) for i in order]
+
+
+geo_index = GeoIndex()
+
+
+def mark_products_moved(product_ids):
+    """Refresh products in the local overlay and tell other workers to resync"""
+    rows = list(coordinate_rows(Product.objects.filter(pk__in=product_ids)))
+    found = {row[0] for row in rows}
+    rows += [(pk, None, None, None) for pk in product_ids if pk not in found]
+    geo_index.apply_rows(rows)
+    geo_index.bump_generation()
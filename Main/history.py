@@ -0,0 +1,176 @@
+# history.py
+"""
+Price and stock history.
+
+Each price or stock change appends a PriceHistory row and is folded into the
+product's DailyPrice row for the day. Changes saved through Product.save()
+are recorded in the same transaction; stock taken or returned by the
+reservations in Main.inventory is recorded after it commits, outside the
+row lock. `manage.py rollup_category_prices` derives CategoryDailyPrice rows
+from those, so the trend endpoints read a few rollup rows per day instead of
+raw history.
+"""
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import DecimalField, F, Value
+from django.db.models.functions import Greatest, Least
+from django.utils import timezone
+
+from .models import BASE_UNITS, UNIT_PRICE_PLACES, CategoryDailyPrice, DailyPrice, PriceHistory, Product
+
+CENTS = Decimal('0.01')
+
+
+def record_price(product, previous_price=None):
+    """
+    Append the product's current price and stock to its history.
+    `previous_price` is the price before this change, None for new products.
+    """
+    price = Decimal(str(product.price))
+    PriceHistory.objects.create(
+        product_id=product.pk, price=price, quantity_available=product.quantity_available
+    )
+    day = timezone.localdate()
+    updates = {
+        'category_id': product.category_id,
+        'close_price': price,
+        'close_quantity': product.quantity_available,
+    }
+    if previous_price is not None and previous_price != price:
+        value = Value(price, output_field=DecimalField(max_digits=10, decimal_places=2))
+        updates.update(
+            min_price=Least(F('min_price'), value),
+            max_price=Greatest(F('max_price'), value),
+            price_sum=F('price_sum') + price,
+            samples=F('samples') + 1,
+        )
+    if DailyPrice.objects.filter(product_id=product.pk, day=day).update(**updates):
+        return
+
+    open_price = price if previous_price is None else previous_price
+    prices = [open_price] if open_price == price else [open_price, price]
+    try:
+        with transaction.atomic():
+            DailyPrice.objects.create(
+                product_id=product.pk, category_id=product.category_id, day=day,
+                open_price=open_price, min_price=min(prices), max_price=max(prices),
+                price_sum=sum(prices), samples=len(prices),
+                close_price=price, close_quantity=product.quantity_available,
+            )
+    except IntegrityError:
+        # A concurrent change created the day's row first
+        DailyPrice.objects.filter(product_id=product.pk, day=day).update(**updates)
+
+
+def _day_range(days, first_day=None):
+    today = timezone.localdate()
+    start = today - timedelta(days=days - 1)
+    if first_day is not None:
+        start = max(start, first_day)
+    return [start + timedelta(days=offset) for offset in range((today - start).days + 1)]
+
+
+def product_trend(product, days):
+    """
+    Daily open/min/avg/max/close prices and closing stock of a product over
+    the last `days` days, oldest first. Days without a change carry the
+    previous close forward.
+    """
+    dates = _day_range(days, timezone.localdate(product.created_at))
+    rows = {row.day: row for row in DailyPrice.objects.filter(product_id=product.pk, day__gte=dates[0])}
+    previous = DailyPrice.objects.filter(product_id=product.pk, day__lt=dates[0]).order_by('-day').first()
+    if previous is not None:
+        close, quantity = previous.close_price, previous.close_quantity
+    elif rows:
+        # Before the first recorded change the price was that change's opening price
+        close, quantity = rows[min(rows)].open_price, None
+    else:
+        close, quantity = product.price, product.quantity_available
+
+    trend = []
+    for day in dates:
+        row = rows.get(day)
+        if row is not None:
+            point = (row.open_price, row.min_price, (row.price_sum / row.samples).quantize(CENTS),
+                     row.max_price, row.close_price)
+            close, quantity = row.close_price, row.close_quantity
+        else:
+            point = (close,) * 5
+        trend.append({
+            'day': day.isoformat(),
+            **{name: str(value) for name, value in zip(('open', 'min', 'avg', 'max', 'close'), point)},
+            'quantity': None if quantity is None else str(quantity),
+        })
+    return trend
+
+
+def rollup_category_prices(day):
+    """
+    Recompute the CategoryDailyPrice rows of `day` from the DailyPrice rows
+    of the products available now and created by then. Prices are converted
+    to the product's base unit so kg and per-piece products are not mixed.
+    Returns the number of rows written.
+    """
+    on_day = {
+        row['product_id']: row
+        for row in DailyPrice.objects.filter(day=day).values('product_id', 'min_price', 'max_price',
+                                                              'price_sum', 'samples')
+    }
+    # A product that first changed after `day` held that change's opening price on it
+    opens = {}
+    for product_id, open_price in DailyPrice.objects.filter(day__gt=day).order_by(
+        'product_id', 'day'
+    ).values_list('product_id', 'open_price'):
+        opens.setdefault(product_id, open_price)
+
+    groups = {}
+    products = Product.objects.filter(status='available', created_at__date__lte=day).order_by().values_list(
+        'id', 'category_id', 'unit', 'price'
+    )
+    for product_id, category_id, unit, price in products.iterator(chunk_size=5000):
+        if unit not in BASE_UNITS:
+            continue
+        base_unit, factor = BASE_UNITS[unit]
+        row = on_day.get(product_id)
+        if row is not None:
+            low, high, avg = row['min_price'], row['max_price'], row['price_sum'] / row['samples']
+        else:
+            low = high = avg = opens.get(product_id, price)
+        group = groups.setdefault((category_id, base_unit), [[], [], []])
+        for values, value in zip(group, (low, avg, high)):
+            values.append(value / factor)
+
+    rollups = [
+        CategoryDailyPrice(
+            category_id=category_id, base_unit=base_unit, day=day,
+            min_price=min(lows).quantize(UNIT_PRICE_PLACES),
+            avg_price=(sum(avgs) / len(avgs)).quantize(UNIT_PRICE_PLACES),
+            max_price=max(highs).quantize(UNIT_PRICE_PLACES),
+            product_count=len(lows),
+        )
+        for (category_id, base_unit), (lows, avgs, highs) in groups.items()
+    ]
+    with transaction.atomic():
+        CategoryDailyPrice.objects.filter(day=day).delete()
+        CategoryDailyPrice.objects.bulk_create(rollups)
+    return len(rollups)
+
+
+def category_trend(category_id, days, base_unit=None):
+    """Daily min/avg/max per base unit for a category, oldest first"""
+    dates = _day_range(days)
+    rows = CategoryDailyPrice.objects.filter(category_id=category_id, day__gte=dates[0]).order_by('day')
+    if base_unit:
+        rows = rows.filter(base_unit=base_unit)
+    trend = {}
+    for row in rows:
+        trend.setdefault(row.base_unit, []).append({
+            'day': row.day.isoformat(),
+            'min': str(row.min_price),
+            'avg': str(row.avg_price),
+            'max': str(row.max_price),
+            'products': row.product_count,
+        })
+    return trend
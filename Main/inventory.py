@@ -0,0 +1,173 @@
+# inventory.py
+"""
+Stock reservations.
+
+Stock is taken with one conditional UPDATE (quantity_available >= requested),
+so concurrent buyers cannot oversell. The UPDATE locks the product's row
+until the reservation's transaction commits, i.e. through the reservation
+INSERT, the change log write and the stats updates, so keep those short.
+The price and stock history is written after commit. The reserved quantity
+is recorded in InventoryReservation until it is confirmed, released or
+expires; releases and expiries put it back. A product flips to out_of_stock
+when it reaches zero and back to available when stock returns, through a
+release, an expiry or the farmer restocking.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import Case, F, Value, When
+from django.db.models.functions import Round
+from django.utils import timezone
+
+from .changelog import record_changes
+from .db.retry import retry_on_lock
+from .facets import facet_row, mark_products_changed
+from .geo import mark_products_moved
+from .history import record_price
+from .models import InventoryReservation, Product
+from .pages import invalidate_product_lists, invalidate_product_pages
+from .realtime import publish_products
+from .semantic import mark_products_text_changed
+from .stats import STAT_FIELDS, apply_product_change, product_state
+
+
+class InsufficientStock(Exception):
+    """The product is not available or has less stock than requested"""
+
+
+def _stock_changed(product_ids, flipped):
+    """
+    QuerySet.update() skips the model signals, so their fan-out is done
+    here: the change log, live updates and cached product pages and lists
+    for every product, and the stats and search indexes for products whose
+    status flipped. `flipped` maps product id to its STAT_FIELDS state
+    before the update. The price and stock history is written after commit,
+    so it stays out of the row lock.
+    """
+    products = list(Product.objects.filter(pk__in=product_ids))
+    record_changes([product.pk for product in products])
+    invalidate_product_pages([product.pk for product in products], {product.farmer_id for product in products})
+    invalidate_product_lists()
+    publish_products([product.pk for product in products])
+
+    reopened = [product for product in products if product.pk in flipped]
+    for product in reopened:
+        apply_product_change(flipped[product.pk], product_state(product))
+    if reopened:
+        rows = [facet_row(product) for product in reopened]
+        reopened_ids = [product.pk for product in reopened]
+        transaction.on_commit(lambda: mark_products_changed(rows))
+        transaction.on_commit(lambda: mark_products_moved(reopened_ids))
+        transaction.on_commit(lambda: mark_products_text_changed(reopened_ids))
+
+    def record_history():
+        for product in products:
+            record_price(product, previous_price=product.price)
+
+    transaction.on_commit(record_history)
+
+
+@retry_on_lock
+def reserve(product_id, user, quantity, ttl=None):
+    """Take `quantity` off the product's stock and hold it for `user`"""
+    if ttl is None:
+        ttl = getattr(settings, 'INVENTORY_RESERVATION_TTL_SECONDS', 900)
+    now = timezone.now()
+    with transaction.atomic():
+        taken = Product.objects.filter(
+            pk=product_id, status='available', quantity_available__gte=quantity
+        ).update(
+            quantity_available=Round(F('quantity_available') - quantity, 2),
+            # Evaluated against the row before the update
+            status=Case(
+                When(quantity_available=quantity, then=Value('out_of_stock')),
+                default=F('status'), output_field=models.CharField()
+            ),
+            updated_at=now,
+        )
+        if not taken:
+            raise InsufficientStock()
+        reservation = InventoryReservation.objects.create(
+            product_id=product_id, user=user, quantity=quantity, expires_at=now + timedelta(seconds=ttl)
+        )
+        state = Product.objects.filter(pk=product_id).values(*STAT_FIELDS).get()
+        flipped = {product_id: dict(state, status='available')} if state['status'] == 'out_of_stock' else {}
+        _stock_changed([product_id], flipped)
+    return reservation
+
+
+def _restock(quantities):
+    """Put {product id: quantity} back, reopening products that ran out"""
+    now = timezone.now()
+    before = {
+        state['id']: state
+        for state in Product.objects.select_for_update().filter(pk__in=quantities).order_by('pk').values(
+            'id', *STAT_FIELDS
+        )
+    }
+    for product_id, quantity in quantities.items():
+        Product.objects.filter(pk=product_id).update(
+            quantity_available=Round(F('quantity_available') + quantity, 2),
+            status=Case(
+                When(status='out_of_stock', quantity_available__lte=0, then=Value('available')),
+                default=F('status'), output_field=models.CharField()
+            ),
+            updated_at=now,
+        )
+    reopened = set(Product.objects.filter(pk__in=before, status='available').values_list('id', flat=True))
+    flipped = {
+        pk: {field: state[field] for field in STAT_FIELDS}
+        for pk, state in before.items() if state['status'] == 'out_of_stock' and pk in reopened
+    }
+    _stock_changed(list(before), flipped)
+
+
+@retry_on_lock
+def release(reservation):
+    """Cancel a reservation and return its stock; False if it was already gone"""
+    with transaction.atomic():
+        # Deleting the row claims it, so a concurrent expiry cannot restock twice
+        deleted, _ = InventoryReservation.objects.filter(pk=reservation.pk).delete()
+        if not deleted:
+            return False
+        _restock({reservation.product_id: reservation.quantity})
+    return True
+
+
+@retry_on_lock
+def confirm(reservation):
+    """Turn a reservation into a sale; the stock stays taken"""
+    with transaction.atomic():
+        deleted, _ = InventoryReservation.objects.filter(pk=reservation.pk, expires_at__gt=timezone.now()).delete()
+    return bool(deleted)
+
+
+@retry_on_lock
+def _expire_batch(now, batch_size):
+    with transaction.atomic():
+        rows = list(
+            InventoryReservation.objects.select_for_update(skip_locked=True).filter(
+                expires_at__lte=now
+            ).values_list('id', 'product_id', 'quantity')[:batch_size]
+        )
+        if not rows:
+            return 0
+        InventoryReservation.objects.filter(id__in=[row[0] for row in rows]).delete()
+        quantities = {}
+        for _, product_id, quantity in rows:
+            quantities[product_id] = quantities.get(product_id, 0) + quantity
+        _restock(quantities)
+    return len(rows)
+
+
+def expire_reservations(now=None, batch_size=None):
+    """Return the stock of reservations past `expires_at`; returns how many expired"""
+    now = now or timezone.now()
+    batch_size = batch_size or getattr(settings, 'INVENTORY_EXPIRY_BATCH_SIZE', 500)
+    expired = 0
+    while True:
+        count = _expire_batch(now, batch_size)
+        expired += count
+        if count < batch_size:
+            return expired
@@ -0,0 +1,222 @@
+# logs.py
+"""
+Structured logging off the request thread.
+
+QueueLogHandler only puts records on an in-memory queue; a QueueListener
+thread formats them as JSON lines and writes them out, so a slow disk or
+pipe never holds up a request. When the queue is full, records are dropped
+and counted instead of blocking; the count is logged as a warning as soon
+as the queue has room again.
+
+RequestLogMiddleware gives each request an id (X-Request-ID, generated when
+the client sends none), which RequestContextFilter adds to every record
+logged while serving it, along with the route, and logs one timing line per
+request. SamplingFilter keeps a fraction of the INFO and lower records,
+decided once per request so a request's lines are kept or dropped together.
+Wired up in settings.LOGGING.
+"""
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from contextvars import ContextVar
+from datetime import datetime, timezone
+
+import orjson
+from django.conf import settings
+
+request_id_var = ContextVar('request_id', default=None)
+route_var = ContextVar('route', default=None)
+sampled_var = ContextVar('log_sampled', default=None)
+
+REQUEST_ID_RE = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+request_logger = logging.getLogger('Main.requests')
+
+# Attributes every LogRecord has; anything else came in through extra=
+RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class RequestContextFilter(logging.Filter):
+    """Add the current request's id and route to records"""
+
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        record.route = route_var.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keep `rate` of the records below WARNING; warnings and errors always pass"""
+
+    def __init__(self, rate=1.0):
+        super().__init__()
+        self.rate = float(rate)
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or self.rate >= 1:
+            return True
+        sampled = sampled_var.get()
+        if sampled is None:
+            # Outside a request each record is sampled on its own
+            return random.random() < self.rate
+        return sampled
+
+
+class ErrorsUnlessDebugFilter(logging.Filter):
+    """Keep only errors unless DEBUG is on, checked per record since the test runner turns DEBUG off"""
+
+    def filter(self, record):
+        return record.levelno >= logging.ERROR or settings.DEBUG
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message, request context and extras"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES and value is not None:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        if record.stack_info:
+            entry['stack'] = record.stack_info
+        return orjson.dumps(entry, default=str).decode()
+
+
+class QueueLogHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to a background QueueListener writing JSON lines to
+    `filename`, or to stderr without one. Never blocks the caller.
+    """
+
+    def __init__(self, filename=None, maxsize=10000):
+        super().__init__(queue.Queue(maxsize))
+        self.filename = filename
+        self.dropped = 0
+        self.listener = None
+        self.pid = None
+        self.start_lock = threading.Lock()
+
+    def start(self):
+        # Forked workers inherit the handler but not the listener thread
+        with self.start_lock:
+            if self.pid == os.getpid():
+                return
+            if self.filename:
+                target = logging.handlers.WatchedFileHandler(self.filename)
+            else:
+                target = logging.StreamHandler(sys.stderr)
+            target.setFormatter(JSONFormatter())
+            self.queue = queue.Queue(self.queue.maxsize)
+            self.listener = logging.handlers.QueueListener(self.queue, target)
+            self.listener.start()
+            self.pid = os.getpid()
+            atexit.register(self.stop)
+
+    def stop(self):
+        if self.listener is not None and self.pid == os.getpid():
+            with self.lock:
+                self.enqueue(None)
+            self.listener.stop()
+            self.listener = self.pid = None
+
+    def prepare(self, record):
+        """
+        Resolve the message and traceback now, while their arguments are
+        current, but leave the JSON formatting to the listener thread
+        """
+        record = logging.makeLogRecord(vars(record))
+        record.msg, record.args = record.getMessage(), None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def dropped_record(self):
+        return logging.makeLogRecord({
+            'name': __name__, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+            'msg': f"Dropped {self.dropped} log records while the log queue was full",
+            'dropped': self.dropped,
+        })
+
+    def enqueue(self, record):
+        """Queue `record` (None reports the dropped count only); called under the handler's lock"""
+        try:
+            if self.dropped:
+                self.queue.put_nowait(self.dropped_record())
+                self.dropped = 0
+            if record is not None:
+                self.queue.put_nowait(record)
+        except queue.Full:
+            if record is not None:
+                self.dropped += 1
+
+    def emit(self, record):
+        if self.pid != os.getpid():
+            self.start()
+        super().emit(record)
+
+
+class RequestLogMiddleware:
+    """
+    Tag the request's log records with its id and route, echo the id in the
+    X-Request-ID response header and log the request's status and duration
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sample_rate = getattr(settings, 'LOG_INFO_SAMPLE_RATE', 1.0)
+
+    def __call__(self, request):
+        request_id = request.headers.get('X-Request-ID', '')
+        if not REQUEST_ID_RE.match(request_id):
+            request_id = uuid.uuid4().hex
+        request.request_id = request_id
+        tokens = (
+            request_id_var.set(request_id),
+            route_var.set(None),
+            sampled_var.set(self.sample_rate >= 1 or random.random() < self.sample_rate),
+        )
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+            response['X-Request-ID'] = request_id
+            route_var.set(self.route_name(request))
+            request_logger.info(
+                f"{request.method} {request.path} {response.status_code}",
+                extra={
+                    'method': request.method,
+                    'path': request.path,
+                    'status': response.status_code,
+                    'duration_ms': round((time.perf_counter() - started) * 1000, 2),
+                },
+            )
+            return response
+        finally:
+            for var, token in zip((request_id_var, route_var, sampled_var), tokens):
+                var.reset(token)
+
+    @staticmethod
+    def route_name(request):
+        match = getattr(request, 'resolver_match', None)
+        return None if match is None else match.view_name or match.route
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        route_var.set(self.route_name(request))
+        return None
@@ -0,0 +1,96 @@
+import threading
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from Main.inventory import InsufficientStock, reserve
+from Main.models import Category, InventoryReservation, Product, User
+
+
+class Command(BaseCommand):
+    help = (
+        'Reserve stock from concurrent buyer threads against the configured database and '
+        'report throughput per thread count, with each buyer on its own product and with '
+        'all buyers on one product. Creates and then deletes its own farmer, buyers and '
+        'products. On SQLite all writes share one database lock; run it with POSTGRES_DB '
+        'set to see buyers on different products proceed in parallel.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+        parser.add_argument('--operations', type=int, default=200, help='Reservations per thread')
+
+    def handle(self, *args, **options):
+        most = max(options['threads'])
+        farmer = User.objects.create(
+            email='reservation-benchmark@example.com', username='reservation-benchmark@example.com',
+            phone='+910000000000', user_type='farmer'
+        )
+        category = Category.objects.create(name='Reservation benchmark')
+        buyers = [
+            User.objects.create(
+                email=f'reservation-buyer-{n}@example.com', username=f'reservation-buyer-{n}@example.com',
+                phone=f'+91{n:010d}', user_type='horeca'
+            )
+            for n in range(1, most + 1)
+        ]
+        try:
+            for spread in (True, False):
+                baseline = None
+                label = 'one product per buyer' if spread else 'all buyers, one product'
+                self.stdout.write(label)
+                for threads in options['threads']:
+                    rate, sold_out = self.run(farmer, category, buyers[:threads], spread, options['operations'])
+                    baseline = baseline or rate
+                    self.stdout.write(
+                        f'  {threads:>3} threads: {rate:8.0f} reservations/s '
+                        f'({rate / baseline:.2f}x of 1 thread), {sold_out} refused for lack of stock'
+                    )
+        finally:
+            Product.objects.filter(farmer=farmer).delete()
+            category.delete()
+            User.objects.filter(pk__in=[farmer.pk] + [buyer.pk for buyer in buyers]).delete()
+
+    def run(self, farmer, category, buyers, spread, operations):
+        # A shared product has stock for half the attempts, so it sells out under contention
+        stock = Decimal(operations * (1 if spread else max(len(buyers) // 2, 1)))
+        products = [
+            Product.objects.create(
+                farmer=farmer, category=category, name=f'Benchmark {n}', description='-',
+                price=Decimal('10'), unit='kg', quantity_available=stock, location='-'
+            )
+            for n in range(len(buyers) if spread else 1)
+        ]
+        counts = {'ok': 0, 'sold_out': 0}
+        lock = threading.Lock()
+
+        def buyer(index):
+            product = products[index if spread else 0]
+            for _ in range(operations):
+                try:
+                    reserve(product.pk, buyers[index], Decimal('1'))
+                    outcome = 'ok'
+                except InsufficientStock:
+                    outcome = 'sold_out'
+                with lock:
+                    counts[outcome] += 1
+            connections.close_all()
+
+        workers = [threading.Thread(target=buyer, args=(index,)) for index in range(len(buyers))]
+        started = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - started
+
+        for product in products:
+            product.refresh_from_db()
+            reserved = sum(InventoryReservation.objects.filter(product=product).values_list('quantity', flat=True))
+            if product.quantity_available + reserved != stock:
+                raise CommandError(f'Stock of {product} does not add up: {product.quantity_available} + {reserved}')
+        InventoryReservation.objects.filter(product__in=products).delete()
+        Product.objects.filter(pk__in=[product.pk for product in products]).delete()
+        return counts['ok'] / elapsed, counts['sold_out']
@@ -0,0 +1,90 @@
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+from django.db import OperationalError, connections, transaction
+from django.core.management.base import BaseCommand
+
+from Main.db.retry import is_lock_error, retry_on_lock
+
+MODES = {
+    'stock': {'ENGINE': 'django.db.backends.sqlite3'},
+    'tuned': {'ENGINE': 'Main.db.sqlite3', 'OPTIONS': {'timeout': 20}},
+}
+
+
+class Command(BaseCommand):
+    help = (
+        'Run concurrent favorite-toggle style write transactions (read, then insert or delete) '
+        'against a scratch SQLite file with the stock and the tuned backend, and count '
+        '"database is locked" errors.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=16)
+        parser.add_argument('--operations', type=int, default=200, help='Transactions per thread')
+
+    def handle(self, *args, **options):
+        directory = tempfile.mkdtemp()
+        try:
+            for mode, config in MODES.items():
+                self.run_mode(mode, config, os.path.join(directory, f'{mode}.sqlite3'), options)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def run_mode(self, mode, config, path, options):
+        alias = f'benchmark_{mode}'
+        connections.settings[alias] = connections.configure_settings(
+            {'default': {'ENGINE': 'django.db.backends.dummy'}, alias: dict(config, NAME=path)}
+        )[alias]
+        with connections[alias].cursor() as cursor:
+            cursor.execute('CREATE TABLE favorite (user_id integer, product_id integer, '
+                           'UNIQUE (user_id, product_id))')
+        connections[alias].close()
+
+        def toggle(user_id, product_id):
+            with transaction.atomic(using=alias):
+                with connections[alias].cursor() as cursor:
+                    cursor.execute('SELECT 1 FROM favorite WHERE user_id = %s AND product_id = %s',
+                                   [user_id, product_id])
+                    if cursor.fetchone():
+                        cursor.execute('DELETE FROM favorite WHERE user_id = %s AND product_id = %s',
+                                       [user_id, product_id])
+                    else:
+                        cursor.execute('INSERT INTO favorite VALUES (%s, %s)', [user_id, product_id])
+
+        if mode == 'tuned':
+            toggle = retry_on_lock(toggle, using=alias)
+
+        counts = {'ok': 0, 'locked': 0}
+        lock = threading.Lock()
+
+        def worker(user_id):
+            for _ in range(options['operations']):
+                try:
+                    toggle(user_id, random.randint(1, 50))
+                    outcome = 'ok'
+                except OperationalError as e:
+                    if not is_lock_error(e):
+                        raise
+                    outcome = 'locked'
+                with lock:
+                    counts[outcome] += 1
+            connections[alias].close()
+
+        threads = [threading.Thread(target=worker, args=(user_id,)) for user_id in range(options['threads'])]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        total = counts['ok'] + counts['locked']
+        self.stdout.write(
+            f'{mode:>5}: {total} transactions in {elapsed:.2f}s ({total / elapsed:.0f}/s), '
+            f'{counts["locked"]} "database is locked" errors'
+        )
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from Main.recommendations import build_related_products
+
+
+class Command(BaseCommand):
+    help = 'Update the favorites co-occurrence matrix used for related products'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--full', action='store_true',
+            help='Recount every user instead of only those whose favorites changed',
+        )
+
+    def handle(self, *args, **options):
+        changed = build_related_products(full=options['full'])
+        self.stdout.write(self.style.SUCCESS(f'Related products rebuilt ({changed} users recounted).'))
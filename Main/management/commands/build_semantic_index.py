@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from Main.semantic import semantic_index
+
+
+class Command(BaseCommand):
+    help = 'Re-embed all available products and persist the semantic search index'
+
+    def handle(self, *args, **options):
+        semantic_index.rebuild()
+        self.stdout.write(self.style.SUCCESS('Semantic search index rebuilt.'))
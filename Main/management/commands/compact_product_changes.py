@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from Main.changelog import compact_changes
+
+
+class Command(BaseCommand):
+    help = 'Drop superseded product change log entries and expired tombstones'
+
+    def handle(self, *args, **options):
+        removed = compact_changes()
+        self.stdout.write(self.style.SUCCESS(f'Product change log compacted ({removed} entries removed).'))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from Main.inventory import expire_reservations
+
+
+class Command(BaseCommand):
+    help = 'Return the stock held by expired reservations'
+
+    def handle(self, *args, **options):
+        expired = expire_reservations()
+        self.stdout.write(self.style.SUCCESS(f'{expired} expired reservations released.'))
@@ -0,0 +1,62 @@
+import statistics
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = (
+        'Fire concurrent GET requests at a running server and report latency percentiles. '
+        'Compare e.g. POSTGRES_POOL_SIZE=0 POSTGRES_CONN_MAX_AGE=0 (a connection per request) '
+        'against the pooled default under the same gunicorn worker count.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('url', help='Full URL, e.g. http://127.0.0.1:8000/api/products/')
+        parser.add_argument('--requests', type=int, default=1000)
+        parser.add_argument('--concurrency', type=int, default=32)
+        parser.add_argument('--warmup', type=int, default=50)
+        parser.add_argument('--header', action='append', default=[],
+                            help='Extra header as "Name: value", e.g. an Authorization header')
+
+    def fetch(self, url, headers):
+        request = urllib.request.Request(url, headers=headers)
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                response.read()
+                ok = response.status < 400
+        except Exception:
+            ok = False
+        return time.perf_counter() - started, ok
+
+    def handle(self, *args, **options):
+        url = options['url']
+        headers = dict(header.split(':', 1) for header in options['header'])
+        headers = {name.strip(): value.strip() for name, value in headers.items()}
+
+        with ThreadPoolExecutor(options['concurrency']) as executor:
+            list(executor.map(lambda _: self.fetch(url, headers), range(options['warmup'])))
+            started = time.perf_counter()
+            results = list(executor.map(lambda _: self.fetch(url, headers), range(options['requests'])))
+            elapsed = time.perf_counter() - started
+
+        latencies = sorted(latency * 1000 for latency, ok in results if ok)
+        errors = sum(1 for _, ok in results if not ok)
+        if not latencies:
+            self.stdout.write(self.style.ERROR(f'All {errors} requests failed.'))
+            return
+
+        def percentile(fraction):
+            return latencies[min(int(len(latencies) * fraction), len(latencies) - 1)]
+
+        self.stdout.write(
+            f'{len(results)} requests, concurrency {options["concurrency"]}, {errors} errors, '
+            f'{len(results) / elapsed:.1f} req/s'
+        )
+        self.stdout.write(
+            f'latency ms: mean {statistics.mean(latencies):.1f}  p50 {percentile(0.5):.1f}  '
+            f'p95 {percentile(0.95):.1f}  p99 {percentile(0.99):.1f}  max {latencies[-1]:.1f}'
+        )
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from Main.popularity import rebuild_popularity
+
+
+class Command(BaseCommand):
+    help = 'Recompute product favorite counts and popularity scores from favorites'
+
+    def handle(self, *args, **options):
+        rebuild_popularity()
+        self.stdout.write(self.style.SUCCESS('Popularity rebuilt.'))
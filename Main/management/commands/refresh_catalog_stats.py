@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from Main.stats import refresh_catalog_stats
+
+
+class Command(BaseCommand):
+    help = 'Recompute per-category and per-subcategory product stats (run after bulk updates)'
+
+    def handle(self, *args, **options):
+        refresh_catalog_stats()
+        self.stdout.write(self.style.SUCCESS('Catalog stats refreshed.'))
@@ -0,0 +1,24 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from Main.history import rollup_category_prices
+
+
+class Command(BaseCommand):
+    help = (
+        'Recompute the per-category daily price rollups behind the price trend endpoint. '
+        'By default today and yesterday, so an hourly run also finalizes the previous day.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=2, help='Number of days to recompute, ending today')
+
+    def handle(self, *args, **options):
+        today = timezone.localdate()
+        for offset in range(options['days'] - 1, -1, -1):
+            day = today - timedelta(days=offset)
+            written = rollup_category_prices(day)
+            self.stdout.write(f'{day}: {written} category rollups')
+        self.stdout.write(self.style.SUCCESS('Category price rollups updated.'))
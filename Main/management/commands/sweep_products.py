@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from Main.sweeper import archive_discontinued_products, retire_expired_products
+
+
+class Command(BaseCommand):
+    help = (
+        'Discontinue products past their expiry date and move products discontinued for '
+        'more than PRODUCT_ARCHIVE_AFTER_DAYS to the archive table. Run it daily.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, help='Products per transaction')
+        parser.add_argument('--skip-archive', action='store_true')
+
+    def handle(self, *args, **options):
+        retired = retire_expired_products(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'{retired} expired products discontinued.'))
+        if not options['skip_archive']:
+            archived = archive_discontinued_products(batch_size=options['batch_size'])
+            self.stdout.write(self.style.SUCCESS(f'{archived} discontinued products archived.'))
@@ -1,12 +1,20 @@
 # Main/middleware.py
+import hashlib
 import json
 import logging
+import zlib
+from django.conf import settings
+from django.core.cache import cache
 from django.http import JsonResponse
+from django.utils.cache import cc_delim_re, patch_vary_headers
+from django.utils.module_loading import import_string
 from django.core.exceptions import ValidationError
 from django.db import IntegrityError, OperationalError
 from rest_framework.views import exception_handler
 from rest_framework import status
 
+from .routers import pin_to_primary, replica_aliases
+
 logger = logging.getLogger(__name__)
 
 
@@ -95,4 +103,272 @@ def custom_exception_handler(exc, context):
         
         response.data = custom_response_data
     
-    return response
\ No newline at end of file
+    return response
+
+
+try:
+    import zstandard
+except ImportError:  # zstd support is optional
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:  # brotli support is optional
+    brotli = None
+
+
+class _GzipStream:
+    def __init__(self, level):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, chunk):
+        return self._compressor.compress(chunk) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class _ZstdStream:
+    def __init__(self, level):
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, chunk):
+        return (self._compressor.compress(chunk)
+                + self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK))
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class _BrotliStream:
+    def __init__(self, level):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, chunk):
+        return self._compressor.process(chunk) + self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+def _compress_gzip(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+# encoding -> (one-shot compressor, streaming compressor class), in server preference order
+COMPRESSORS = {}
+if zstandard is not None:
+    COMPRESSORS['zstd'] = (lambda data, level: zstandard.ZstdCompressor(level=level).compress(data),
+                           _ZstdStream)
+if brotli is not None:
+    COMPRESSORS['br'] = (lambda data, level: brotli.compress(data, quality=level), _BrotliStream)
+COMPRESSORS['gzip'] = (_compress_gzip, _GzipStream)
+
+
+def parse_accept_encoding(header):
+    """Return {encoding: q} for an Accept-Encoding header"""
+    accepted = {}
+    for item in header.split(','):
+        encoding, _, params = item.strip().partition(';')
+        encoding = encoding.strip().lower()
+        if not encoding:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[encoding] = q
+    return accepted
+
+
+def negotiate_encoding(header, available=None):
+    """Pick the best supported encoding for the client, or None"""
+    accepted = parse_accept_encoding(header or '')
+    wildcard = accepted.get('*', 0.0)
+    best, best_q = None, 0.0
+    for encoding in available or COMPRESSORS:
+        q = accepted.get(encoding, wildcard)
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+class CompressionMiddleware:
+    """
+    Compress responses with zstd, brotli or gzip based on Accept-Encoding.
+
+    Only content types listed in COMPRESSION_CONTENT_TYPES (and not in
+    COMPRESSION_EXCLUDED_CONTENT_TYPES) are compressed and bodies shorter than
+    COMPRESSION_MIN_LENGTH are sent as is. Live streams, such as the SSE feed
+    marked X-Accel-Buffering: no, are passed through so events are not held
+    in a compressor. Compressed bytes are cached by ETag and the request
+    headers the response varies on, so unchanged responses are not
+    recompressed.
+    Keep ConditionalGetMiddleware below this one so ETags are computed on
+    the uncompressed body, as with Django's GZipMiddleware.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.min_length = getattr(settings, 'COMPRESSION_MIN_LENGTH', 512)
+        self.content_types = getattr(settings, 'COMPRESSION_CONTENT_TYPES', ['application/json'])
+        self.excluded_content_types = getattr(settings, 'COMPRESSION_EXCLUDED_CONTENT_TYPES', ['text/event-stream'])
+        self.levels = getattr(settings, 'COMPRESSION_LEVELS', {})
+        self.cache_timeout = getattr(settings, 'COMPRESSION_CACHE_TIMEOUT', 300)
+        encodings = getattr(settings, 'COMPRESSION_ENCODINGS', list(COMPRESSORS))
+        self.encodings = [encoding for encoding in encodings if encoding in COMPRESSORS]
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        return self.process_response(request, response)
+
+    def compressible(self, response):
+        if response.has_header('Content-Encoding') or response.has_header('Content-Range'):
+            return False
+        if response.streaming and response.get('X-Accel-Buffering', '').lower() == 'no':
+            return False
+        content_type = response.get('Content-Type', '').split(';')[0].strip().lower()
+        if content_type in self.excluded_content_types:
+            return False
+        for allowed in self.content_types:
+            if allowed.endswith('/*'):
+                if content_type.startswith(allowed[:-1]):
+                    return True
+            elif content_type == allowed:
+                return True
+        return False
+
+    def process_response(self, request, response):
+        if not self.compressible(response):
+            return response
+        if not response.streaming and len(response.content) < self.min_length:
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        encoding = negotiate_encoding(request.META.get('HTTP_ACCEPT_ENCODING'), self.encodings)
+        if encoding is None:
+            return response
+
+        compress, stream_class = COMPRESSORS[encoding]
+        level = self.levels.get(encoding, {'zstd': 3, 'br': 4, 'gzip': 6}[encoding])
+
+        if response.streaming:
+            if response.is_async:
+                response.streaming_content = self._compress_async(
+                    response.streaming_content, stream_class(level))
+            else:
+                response.streaming_content = self._compress_sequence(
+                    response.streaming_content, stream_class(level))
+            del response.headers['Content-Length']
+        else:
+            compressed = self._compress_content(request, response, encoding, compress, level)
+            if len(compressed) >= len(response.content):
+                return response
+            response.content = compressed
+            response.headers['Content-Length'] = str(len(compressed))
+
+        # The compressed body is a different representation of the same
+        # resource, so a strong ETag must become weak (RFC 9110 8.8.3).
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response.headers['ETag'] = 'W/' + etag
+
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+    def _compress_content(self, request, response, encoding, compress, level):
+        etag = response.get('ETag')
+        vary = {header.strip().lower() for header in cc_delim_re.split(response.get('Vary', '')) if header.strip()}
+        if not etag or not self.cache_timeout or '*' in vary:
+            return compress(response.content, level)
+
+        # Responses with the same ETag may still differ in the headers they vary on
+        varied = [f"{header}:{request.headers.get(header, '')}" for header in sorted(vary - {'accept-encoding'})]
+        digest = hashlib.md5('\n'.join([etag, *varied]).encode(), usedforsecurity=False).hexdigest()
+        key = f'compression:{encoding}:{level}:{digest}'
+        compressed = cache.get(key)
+        if compressed is None:
+            compressed = compress(response.content, level)
+            cache.set(key, compressed, self.cache_timeout)
+        return compressed
+
+    @staticmethod
+    def _compress_sequence(sequence, stream):
+        for chunk in sequence:
+            data = stream.compress(chunk)
+            if data:
+                yield data
+        yield stream.finish()
+
+    @staticmethod
+    async def _compress_async(sequence, stream):
+        async for chunk in sequence:
+            data = stream.compress(chunk)
+            if data:
+                yield data
+        yield stream.finish()
+
+
+class ReadYourWritesMiddleware:
+    """
+    Pin a user's reads to the primary database for READ_YOUR_WRITES_SECONDS
+    after any successful write, so replica lag never hides their own edits.
+    Needs to sit below BrowserOnlyMiddleware, which runs the session auth
+    for browser pages. For API requests DRF copies the JWT user onto the
+    request once the view has authenticated it.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if (request.method not in ('GET', 'HEAD', 'OPTIONS') and response.status_code < 400
+                and replica_aliases()):
+            user = getattr(request, 'user', None)
+            if user is not None and user.is_authenticated:
+                pin_to_primary(user.pk)
+        return response
+
+
+class BrowserOnlyMiddleware:
+    """
+    Run the BROWSER_MIDDLEWARE stack (sessions, CSRF, auth, messages) for
+    everything except API_PATH_PREFIX. The JWT-authenticated API never uses
+    those, so it skips them, along with the session lookups and Vary: Cookie
+    they add. The wrapped middleware's process_view hooks are forwarded, so
+    CSRF checks still apply to the admin.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.api_prefix = getattr(settings, 'API_PATH_PREFIX', '/api/')
+        self.view_hooks = []
+        handler = get_response
+        for path in reversed(getattr(settings, 'BROWSER_MIDDLEWARE', [])):
+            handler = import_string(path)(handler)
+            if hasattr(handler, 'process_view'):
+                self.view_hooks.insert(0, handler.process_view)
+        self.browser_stack = handler
+
+    def is_api(self, request):
+        return request.path_info.startswith(self.api_prefix)
+
+    def __call__(self, request):
+        if self.is_api(request):
+            return self.get_response(request)
+        return self.browser_stack(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if self.is_api(request):
+            return None
+        for process_view in self.view_hooks:
+            response = process_view(request, view_func, view_args, view_kwargs)
+            if response is not None:
+                return response
+        return None
@@ -0,0 +1,89 @@
+# Generated by Django 4.2.7 on 2026-10-19 06:47
+
+from django.db import migrations, models
+from django.db.models import Count, Max, Min, Q, Sum
+
+
+def backfill_stats(apps, schema_editor):
+    Product = apps.get_model('Main', 'Product')
+    available = Product.objects.filter(status='available').order_by()
+    for model_name, key in (('Category', 'category_id'), ('SubCategory', 'subcategory_id')):
+        model = apps.get_model('Main', model_name)
+        rows = available.exclude(**{key: None}).values(key).annotate(
+            available_count=Count('id'),
+            organic_count=Count('id', filter=Q(organic=True)),
+            price_sum=Sum('price'),
+            min_price=Min('price'),
+            max_price=Max('price'),
+        )
+        for row in rows:
+            model.objects.filter(pk=row.pop(key)).update(**row)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Main', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='available_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='max_price',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='min_price',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='organic_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='price_sum',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=16),
+        ),
+        migrations.AddField(
+            model_name='subcategory',
+            name='available_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='subcategory',
+            name='max_price',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='subcategory',
+            name='min_price',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='subcategory',
+            name='organic_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='subcategory',
+            name='price_sum',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=16),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['category', 'status'], name='product_category_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['subcategory', 'status'], name='product_subcat_status_idx'),
+        ),
+        migrations.RunPython(backfill_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.2.7 on 2026-10-19 07:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Main', '0006_inventory_reservation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedProduct',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('farmer_id', models.BigIntegerField(db_index=True)),
+                ('category_id', models.BigIntegerField()),
+                ('subcategory_id', models.BigIntegerField(blank=True, null=True)),
+                ('name', models.CharField(max_length=200)),
+                ('description', models.TextField()),
+                ('price', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('unit', models.CharField(max_length=10)),
+                ('quantity_available', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('harvest_date', models.DateField(blank=True, null=True)),
+                ('expiry_date', models.DateField(blank=True, null=True)),
+                ('organic', models.BooleanField(default=False)),
+                ('location', models.CharField(max_length=200)),
+                ('images', models.JSONField(default=list)),
+                ('created_at', models.DateTimeField()),
+                ('updated_at', models.DateTimeField()),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['status', 'expiry_date'], name='product_status_expiry_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.2.7 on 2026-10-19 07:19
+
+from decimal import Decimal
+
+from django.db import migrations, models
+
+# Base units per unit, as Main.models.BASE_UNITS stood when this migration was written
+UNIT_FACTORS = {
+    'kg': Decimal('1'), 'g': Decimal('0.001'), 'ton': Decimal('1000'),
+    'piece': Decimal('1'), 'dozen': Decimal('12'), 'bunch': Decimal('1'), 'box': Decimal('1'), 'bag': Decimal('1'),
+}
+
+
+def backfill_unit_prices(apps, schema_editor):
+    Product = apps.get_model('Main', 'Product')
+    Product.objects.update(price_per_base_unit=models.Case(
+        *[models.When(unit=unit, then=models.F('price') / models.Value(factor)) for unit, factor in UNIT_FACTORS.items()],
+        output_field=models.DecimalField(max_digits=16, decimal_places=4)
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Main', '0007_product_expiry_sweep'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='price_per_base_unit',
+            field=models.DecimalField(decimal_places=4, default=0, editable=False, max_digits=16),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['status', 'price_per_base_unit'], name='product_unit_price_idx'),
+        ),
+        migrations.RunPython(backfill_unit_prices, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 4.2.7 on 2026-10-19 07:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Main', '0008_product_unit_price'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PriceHistory',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('product_id', models.BigIntegerField()),
+                ('price', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('quantity_available', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('recorded_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['product_id', 'recorded_at'], name='price_history_product_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='DailyPrice',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('product_id', models.BigIntegerField()),
+                ('category_id', models.BigIntegerField()),
+                ('day', models.DateField()),
+                ('open_price', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('min_price', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('max_price', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('price_sum', models.DecimalField(decimal_places=2, max_digits=16)),
+                ('samples', models.PositiveIntegerField(default=1)),
+                ('close_price', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('close_quantity', models.DecimalField(decimal_places=2, max_digits=10)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['day', 'category_id'], name='daily_price_day_idx')],
+                'unique_together': {('product_id', 'day')},
+            },
+        ),
+        migrations.CreateModel(
+            name='CategoryDailyPrice',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('category_id', models.BigIntegerField()),
+                ('base_unit', models.CharField(max_length=10)),
+                ('day', models.DateField()),
+                ('min_price', models.DecimalField(decimal_places=4, max_digits=16)),
+                ('avg_price', models.DecimalField(decimal_places=4, max_digits=16)),
+                ('max_price', models.DecimalField(decimal_places=4, max_digits=16)),
+                ('product_count', models.PositiveIntegerField()),
+            ],
+            options={
+                'unique_together': {('category_id', 'base_unit', 'day')},
+            },
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.7 on 2026-10-19 09:10
+
+import math
+from datetime import datetime, timezone
+
+from django.db import migrations
+
+EPOCH = datetime(2025, 1, 1, tzinfo=timezone.utc)
+HALF_LIFE_SECONDS = 7 * 86400
+
+
+def log_weight(created_at):
+    return (created_at - EPOCH).total_seconds() * math.log(2) / HALF_LIFE_SECONDS
+
+
+def rebuild_log_scores(apps, schema_editor):
+    """Popularity scores are now stored as ln(1 + sum of weights)"""
+    Product = apps.get_model('Main', 'Product')
+    Favorite = apps.get_model('Main', 'Favorite')
+    weights = {}
+    for product_id, created_at in Favorite.objects.values_list('product_id', 'created_at').iterator():
+        weights.setdefault(product_id, []).append(log_weight(created_at))
+    Product.objects.update(favorite_count=0, popularity_score=0)
+    for product_id, product_weights in weights.items():
+        top = max(0.0, *product_weights)
+        score = top + math.log(math.exp(-top) + sum(math.exp(weight - top) for weight in product_weights))
+        Product.objects.filter(pk=product_id).update(favorite_count=len(product_weights), popularity_score=score)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Main', '0009_price_history'),
+    ]
+
+    operations = [
+        migrations.RunPython(rebuild_log_scores, migrations.RunPython.noop),
+    ]
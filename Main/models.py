@@ -1,7 +1,7 @@
 # models.py
 from django.db import models
 from django.contrib.auth.models import AbstractUser
-from django.core.validators import RegexValidator
+from django.core.validators import RegexValidator, MinValueValidator, MaxValueValidator
 import uuid
 from decimal import Decimal
 
@@ -31,6 +31,14 @@ class User(AbstractUser):
     farm_name = models.CharField(max_length=100, blank=True, null=True)
     farm_location = models.CharField(max_length=200, blank=True, null=True)
     farm_size = models.DecimalField(max_digits=10, decimal_places=2, blank=True, null=True)
+    farm_latitude = models.DecimalField(
+        max_digits=9, decimal_places=6, blank=True, null=True,
+        validators=[MinValueValidator(-90), MaxValueValidator(90)]
+    )
+    farm_longitude = models.DecimalField(
+        max_digits=9, decimal_places=6, blank=True, null=True,
+        validators=[MinValueValidator(-180), MaxValueValidator(180)]
+    )
     
     # Additional fields for HoReCa
     business_name = models.CharField(max_length=100, blank=True, null=True)
@@ -59,7 +67,25 @@ class User(AbstractUser):
         super().save(*args, **kwargs)
 
 
-class Category(models.Model):
+class ProductStats(models.Model):
+    """Denormalized aggregates over the available products of a category or subcategory"""
+    available_count = models.PositiveIntegerField(default=0)
+    organic_count = models.PositiveIntegerField(default=0)
+    price_sum = models.DecimalField(max_digits=16, decimal_places=2, default=0)
+    min_price = models.DecimalField(max_digits=10, decimal_places=2, blank=True, null=True)
+    max_price = models.DecimalField(max_digits=10, decimal_places=2, blank=True, null=True)
+    
+    class Meta:
+        abstract = True
+    
+    @property
+    def avg_price(self):
+        if not self.available_count:
+            return None
+        return (self.price_sum / self.available_count).quantize(Decimal('0.01'))
+
+
+class Category(ProductStats):
     name = models.CharField(max_length=100, unique=True)
     description = models.TextField(blank=True, null=True)
     image = models.ImageField(upload_to='category_images/', blank=True, null=True)
@@ -73,7 +99,7 @@ class Category(models.Model):
         return self.name
 
 
-class SubCategory(models.Model):
+class SubCategory(ProductStats):
     category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='subcategories')
     name = models.CharField(max_length=100)
     description = models.TextField(blank=True, null=True)
@@ -88,6 +114,79 @@ class SubCategory(models.Model):
         return f"{self.category.name} - {self.name}"
 
 
+# unit -> (base unit, base units per unit). Count units without a fixed
+# piece count (bunch, box, bag) are priced per item.
+BASE_UNITS = {
+    'kg': ('kg', Decimal('1')),
+    'g': ('kg', Decimal('0.001')),
+    'ton': ('kg', Decimal('1000')),
+    'piece': ('piece', Decimal('1')),
+    'dozen': ('piece', Decimal('12')),
+    'bunch': ('piece', Decimal('1')),
+    'box': ('piece', Decimal('1')),
+    'bag': ('piece', Decimal('1')),
+}
+
+UNIT_PRICE_PLACES = Decimal('0.0001')
+
+
+def base_unit_names():
+    """The base units prices are compared in, in a stable order"""
+    return sorted({base for base, _ in BASE_UNITS.values()})
+
+
+def units_for_base_unit(base_unit):
+    """Units priced per `base_unit`"""
+    return [unit for unit, (base, _) in BASE_UNITS.items() if base == base_unit]
+
+
+def unit_price(price, unit):
+    """Price per kg, or per piece for count units"""
+    if price is None or unit not in BASE_UNITS:
+        return None
+    return (Decimal(str(price)) / BASE_UNITS[unit][1]).quantize(UNIT_PRICE_PLACES)
+
+
+def unit_price_expression(price=None, unit=None):
+    """
+    SQL computing price_per_base_unit from `price` (the column by default).
+    `unit` is a unit being written in the same UPDATE, if any.
+    """
+    price = models.F('price') if price is None else price
+    if not hasattr(price, 'resolve_expression'):
+        price = models.Value(Decimal(str(price)))
+    output_field = models.DecimalField(max_digits=16, decimal_places=4)
+    if unit is not None:
+        return models.ExpressionWrapper(price / models.Value(BASE_UNITS[unit][1]), output_field=output_field)
+    return models.Case(
+        *[models.When(unit=name, then=price / models.Value(factor)) for name, (_, factor) in BASE_UNITS.items()],
+        output_field=output_field
+    )
+
+
+class ProductQuerySet(models.QuerySet):
+    """Keeps price_per_base_unit in step with price and unit in bulk writes"""
+
+    def update(self, **kwargs):
+        if ('price' in kwargs or 'unit' in kwargs) and 'price_per_base_unit' not in kwargs:
+            kwargs['price_per_base_unit'] = unit_price_expression(kwargs.get('price'), kwargs.get('unit'))
+        return super().update(**kwargs)
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        for obj in objs:
+            obj.price_per_base_unit = unit_price(obj.price, obj.unit)
+        return super().bulk_create(objs, *args, **kwargs)
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        objs = list(objs)
+        if {'price', 'unit'} & set(fields):
+            for obj in objs:
+                obj.price_per_base_unit = unit_price(obj.price, obj.unit)
+            fields = [*fields, 'price_per_base_unit']
+        return super().bulk_update(objs, fields, *args, **kwargs)
+
+
 class Product(models.Model):
     UNIT_CHOICES = (
         ('kg', 'Kilogram'),
@@ -114,6 +213,8 @@ class Product(models.Model):
     description = models.TextField()
     price = models.DecimalField(max_digits=10, decimal_places=2)
     unit = models.CharField(max_length=10, choices=UNIT_CHOICES)
+    # Derived from price and unit on every save; see BASE_UNITS
+    price_per_base_unit = models.DecimalField(max_digits=16, decimal_places=4, default=0, editable=False)
     quantity_available = models.DecimalField(max_digits=10, decimal_places=2)
     min_order_quantity = models.DecimalField(max_digits=10, decimal_places=2, default=1)
     
@@ -122,17 +223,50 @@ class Product(models.Model):
     expiry_date = models.DateField(blank=True, null=True)
     organic = models.BooleanField(default=False)
     location = models.CharField(max_length=200)
+    # Falls back to the farmer's farm coordinates when not set
+    latitude = models.DecimalField(
+        max_digits=9, decimal_places=6, blank=True, null=True,
+        validators=[MinValueValidator(-90), MaxValueValidator(90)]
+    )
+    longitude = models.DecimalField(
+        max_digits=9, decimal_places=6, blank=True, null=True,
+        validators=[MinValueValidator(-180), MaxValueValidator(180)]
+    )
     
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='available')
     is_featured = models.BooleanField(default=False)
+    # Maintained from Favorite writes, see Main.popularity
+    favorite_count = models.PositiveIntegerField(default=0)
+    popularity_score = models.FloatField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['category', 'status'], name='product_category_status_idx'),
+            models.Index(fields=['subcategory', 'status'], name='product_subcat_status_idx'),
+            models.Index(fields=['status', '-popularity_score'], name='product_popularity_idx'),
+            # Expiry sweep, see Main.sweeper
+            models.Index(fields=['status', 'expiry_date'], name='product_status_expiry_idx'),
+            models.Index(fields=['status', 'price_per_base_unit'], name='product_unit_price_idx'),
+        ]
+    
+    objects = ProductQuerySet.as_manager()
     
     def __str__(self):
         return f"{self.name} - {self.farmer.email}"
+    
+    @property
+    def base_unit(self):
+        return BASE_UNITS[self.unit][0] if self.unit in BASE_UNITS else None
+    
+    def save(self, *args, **kwargs):
+        self.price_per_base_unit = unit_price(self.price, self.unit)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'price', 'unit'} & set(update_fields):
+            kwargs['update_fields'] = {*update_fields, 'price_per_base_unit'}
+        super().save(*args, **kwargs)
 
 
 class ProductImage(models.Model):
@@ -179,4 +313,149 @@ class Favorite(models.Model):
         unique_together = ['user', 'product']
     
     def __str__(self):
-        return f"{self.user.email} - {self.product.name}"
\ No newline at end of file
+        return f"{self.user.email} - {self.product.name}"
+
+
+class ProductChange(models.Model):
+    """
+    Append-only log of catalog changes for delta sync. The primary key is the
+    sync sequence; product_id is a plain column so tombstones outlive the
+    product they describe.
+    """
+    ACTION_CHOICES = (
+        ('upsert', 'Created or updated'),
+        ('delete', 'Deleted'),
+    )
+    
+    id = models.BigAutoField(primary_key=True)
+    product_id = models.BigIntegerField()
+    action = models.CharField(max_length=10, choices=ACTION_CHOICES)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['product_id', 'id'], name='product_change_product_idx'),
+        ]
+    
+    def __str__(self):
+        return f"#{self.id} {self.action} product {self.product_id}"
+
+
+class ProductChangeCompaction(models.Model):
+    """Each compaction run; sync tokens below `purged_through` must resync"""
+    purged_through = models.BigIntegerField(default=0)
+    removed = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        ordering = ['-id']
+    
+    def __str__(self):
+        return f"Compaction through #{self.purged_through}"
+
+
+class InventoryReservation(models.Model):
+    """
+    Stock held for a buyer until `expires_at`. The quantity has already been
+    taken off Product.quantity_available; see Main.inventory.
+    """
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='reservations')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='reservations')
+    quantity = models.DecimalField(max_digits=10, decimal_places=2)
+    expires_at = models.DateTimeField(db_index=True)
+    
+    def __str__(self):
+        return f"{self.quantity} of product {self.product_id} for user {self.user_id}"
+
+
+class ArchivedProduct(models.Model):
+    """
+    Cold copy of a product that stayed discontinued for
+    PRODUCT_ARCHIVE_AFTER_DAYS; the live row is deleted. Keeps the original
+    id and plain ids instead of foreign keys, so it outlives its farmer and
+    category.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    farmer_id = models.BigIntegerField(db_index=True)
+    category_id = models.BigIntegerField()
+    subcategory_id = models.BigIntegerField(blank=True, null=True)
+    name = models.CharField(max_length=200)
+    description = models.TextField()
+    price = models.DecimalField(max_digits=10, decimal_places=2)
+    unit = models.CharField(max_length=10)
+    quantity_available = models.DecimalField(max_digits=10, decimal_places=2)
+    harvest_date = models.DateField(blank=True, null=True)
+    expiry_date = models.DateField(blank=True, null=True)
+    organic = models.BooleanField(default=False)
+    location = models.CharField(max_length=200)
+    images = models.JSONField(default=list)
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+    
+    def __str__(self):
+        return f"{self.name} (archived)"
+
+
+class PriceHistory(models.Model):
+    """Append-only record of each price or stock change of a product"""
+    id = models.BigAutoField(primary_key=True)
+    product_id = models.BigIntegerField()
+    price = models.DecimalField(max_digits=10, decimal_places=2)
+    quantity_available = models.DecimalField(max_digits=10, decimal_places=2)
+    recorded_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['product_id', 'recorded_at'], name='price_history_product_idx'),
+        ]
+    
+    def __str__(self):
+        return f"Product {self.product_id}: {self.price} at {self.recorded_at}"
+
+
+class DailyPrice(models.Model):
+    """
+    Per-product daily rollup, updated as changes are recorded. Days without
+    a change have no row; their price is the previous day's close.
+    """
+    product_id = models.BigIntegerField()
+    category_id = models.BigIntegerField()
+    day = models.DateField()
+    open_price = models.DecimalField(max_digits=10, decimal_places=2)
+    min_price = models.DecimalField(max_digits=10, decimal_places=2)
+    max_price = models.DecimalField(max_digits=10, decimal_places=2)
+    # Sum and count of the prices held during the day, for the average
+    price_sum = models.DecimalField(max_digits=16, decimal_places=2)
+    samples = models.PositiveIntegerField(default=1)
+    close_price = models.DecimalField(max_digits=10, decimal_places=2)
+    close_quantity = models.DecimalField(max_digits=10, decimal_places=2)
+    
+    class Meta:
+        unique_together = ['product_id', 'day']
+        indexes = [
+            models.Index(fields=['day', 'category_id'], name='daily_price_day_idx'),
+        ]
+    
+    def __str__(self):
+        return f"Product {self.product_id} on {self.day}"
+
+
+class CategoryDailyPrice(models.Model):
+    """
+    Per-category daily rollup of prices per base unit (kg or piece) over the
+    category's available products; see Main.history
+    """
+    category_id = models.BigIntegerField()
+    base_unit = models.CharField(max_length=10)
+    day = models.DateField()
+    min_price = models.DecimalField(max_digits=16, decimal_places=4)
+    avg_price = models.DecimalField(max_digits=16, decimal_places=4)
+    max_price = models.DecimalField(max_digits=16, decimal_places=4)
+    product_count = models.PositiveIntegerField()
+    
+    class Meta:
+        unique_together = ['category_id', 'base_unit', 'day']
+    
+    def __str__(self):
+        return f"Category {self.category_id} per {self.base_unit} on {self.day}"
@@ -0,0 +1,100 @@
+# pages.py
+"""
+Sections of the composite product page (/api/products/<id>/page/).
+
+Each section is cached on its own through get_or_compute_for_request() under a group the
+writes it depends on invalidate: `product:<id>` for the product's details,
+`farmer:<id>` for the farmer and their products, and `categories` for the
+subcategory list. Sections are built with an empty favorites set so they
+can be shared; the view fills in is_favorited per request.
+"""
+from django.conf import settings
+from django.db import transaction
+
+from .models import Product, SubCategory, User
+from .serializers import ProductDetailSerializer, ProductListRowSerializer, SubCategorySerializer
+from .singleflight import get_or_compute_for_request, invalidate_group
+
+
+def _context(request):
+    return {'request': request, 'favorite_ids': set()}
+
+
+def product_section(request, pk):
+    """Product details plus the ids the other sections need, None if missing"""
+    def compute(request):
+        serializer = ProductDetailSerializer(context=_context(request))
+        columns, relations = serializer.get_select_columns()
+        product = Product.objects.select_related(*relations).only(
+            *columns, 'farmer_id', 'category_id'
+        ).prefetch_related('images').filter(pk=pk).first()
+        if product is None:
+            return None
+        return {
+            'product': ProductDetailSerializer(product, context=serializer.context).data,
+            'farmer_id': product.farmer_id,
+            'category_id': product.category_id,
+        }
+
+    return get_or_compute_for_request(
+        request, f'product-page:product:{pk}', compute,
+        ttl=getattr(settings, 'PRODUCT_PAGE_CACHE_SECONDS', 60), group=f'product:{pk}'
+    )
+
+
+def farmer_section(request, farmer_id):
+    """
+    The farmer and their newest available products, one more than
+    PRODUCT_PAGE_FARMER_PRODUCTS so the product being viewed can be left out
+    """
+    def compute(request):
+        farmer = User.objects.filter(pk=farmer_id).only(
+            'first_name', 'last_name', 'email', 'farm_name', 'farm_location'
+        ).first()
+        if farmer is None:
+            return None
+        products = Product.objects.filter(farmer_id=farmer_id, status='available')
+        limit = getattr(settings, 'PRODUCT_PAGE_FARMER_PRODUCTS', 8) + 1
+        rows = products.order_by('-created_at').values_list(*ProductListRowSerializer.columns())[:limit]
+        return {
+            'id': farmer.pk,
+            'name': f"{farmer.first_name} {farmer.last_name}".strip() or farmer.email,
+            'farm_name': farmer.farm_name,
+            'farm_location': farmer.farm_location,
+            'product_count': products.count(),
+            'products': ProductListRowSerializer(list(rows), context=_context(request)).data,
+        }
+
+    return get_or_compute_for_request(
+        request, f'product-page:farmer:{farmer_id}', compute,
+        ttl=getattr(settings, 'PRODUCT_PAGE_CACHE_SECONDS', 60), group=f'farmer:{farmer_id}'
+    )
+
+
+def subcategories_section(request, category_id):
+    def compute(request):
+        queryset = SubCategory.objects.filter(category_id=category_id, is_active=True).select_related('category')
+        return [dict(item) for item in SubCategorySerializer(queryset, many=True).data]
+
+    return get_or_compute_for_request(
+        request, f'product-page:subcategories:{category_id}', compute,
+        ttl=getattr(settings, 'CATEGORY_CACHE_SECONDS', 300), group='categories'
+    )
+
+
+def invalidate_product_pages(product_ids=(), farmer_ids=()):
+    """Mark the cached sections of these products and farmers stale once the transaction commits"""
+    groups = [f'product:{pk}' for pk in product_ids] + [f'farmer:{pk}' for pk in farmer_ids]
+
+    def invalidate():
+        for group in groups:
+            invalidate_group(group)
+
+    if groups:
+        transaction.on_commit(invalidate)
+
+
+def invalidate_product_lists():
+    """Mark the cached featured and category lists stale once the transaction commits"""
+    transaction.on_commit(lambda: invalidate_group('featured'))
+    transaction.on_commit(lambda: invalidate_group('categories'))
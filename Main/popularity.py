@@ -0,0 +1,115 @@
+# popularity.py
+"""
+Favorite counts and time-decayed popularity scores on the product row.
+
+A favorite's weight doubles every POPULARITY_HALF_LIFE_DAYS after
+POPULARITY_EPOCH, which is the same as halving older favorites, so scores
+decay without ever being rewritten. The weights themselves grow without
+bound, so the score is stored as ln(1 + sum of weights): adding or removing a
+favorite is a log-sum-exp step done in SQL with F() expressions, and the
+stored value only grows by ~36 per year at the default half-life. An empty
+score is 0; the order is the same as sorting by the plain sum.
+"""
+import math
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, FloatField, Value, When
+from django.db.models.functions import Abs, Exp, Greatest, Ln
+
+from .models import Product, Favorite
+
+DEFAULT_EPOCH = datetime(2025, 1, 1, tzinfo=dt_timezone.utc)
+
+# Keeps exp() clear of underflow errors (PostgreSQL raises instead of returning 0)
+MIN_EXPONENT = -600.0
+
+# A removal leaving less than ~0.01% of the score is recounted from the favorites
+RECOUNT_MARGIN = 1e-4
+RECOUNT = -1.0
+
+
+def favorite_weight(created_at):
+    """Natural log of the weight of a favorite created at `created_at`"""
+    half_life = getattr(settings, 'POPULARITY_HALF_LIFE_DAYS', 7) * 86400
+    epoch = getattr(settings, 'POPULARITY_EPOCH', DEFAULT_EPOCH)
+    return (created_at - epoch).total_seconds() * math.log(2) / half_life
+
+
+def score_of(weights):
+    """ln(1 + sum of exp(weight)) of log weights, without overflowing"""
+    weights = list(weights)
+    if not weights:
+        return 0.0
+    top = max(0.0, *weights)
+    return top + math.log(math.exp(-top) + sum(math.exp(weight - top) for weight in weights))
+
+
+def _float(value):
+    return Value(value, output_field=FloatField())
+
+
+def _added(score, weight):
+    """ln(e^score + e^weight)"""
+    return Greatest(score, weight) + Ln(
+        _float(1.0) + Exp(Greatest(-Abs(score - weight), _float(MIN_EXPONENT)))
+    )
+
+
+def _removed(score, weight):
+    """ln(e^score - e^weight), never below the empty score"""
+    remaining = _float(1.0) - Exp(Greatest(weight - score, _float(MIN_EXPONENT)))
+    return Greatest(score + Ln(Greatest(remaining, _float(1e-300))), _float(0.0))
+
+
+def _recompute(product_ids):
+    weights = {pk: [] for pk in product_ids}
+    for product_id, created_at in Favorite.objects.filter(product_id__in=product_ids).values_list(
+        'product_id', 'created_at'
+    ):
+        weights[product_id].append(favorite_weight(created_at))
+    for product_id, product_weights in weights.items():
+        Product.objects.filter(pk=product_id).update(popularity_score=score_of(product_weights))
+
+
+def record_favorites(product_ids, created_at, removed=False):
+    """Apply favorites created (or removed) at created_at with race-safe F() updates"""
+    log_weight = favorite_weight(created_at)
+    weight = _float(log_weight)
+    if removed:
+        with transaction.atomic():
+            Product.objects.filter(id__in=product_ids).update(
+                favorite_count=F('favorite_count') - 1,
+                popularity_score=Case(
+                    When(favorite_count__lte=1, then=_float(0.0)),
+                    # Removing nearly all of the score would leave rounding noise; mark
+                    # those for an exact recount while the update holds their row locks
+                    When(popularity_score__lt=log_weight + RECOUNT_MARGIN, then=_float(RECOUNT)),
+                    default=_removed(F('popularity_score'), weight), output_field=FloatField()
+                ),
+            )
+            recount = list(Product.objects.filter(id__in=product_ids, popularity_score=RECOUNT).values_list(
+                'id', flat=True
+            ))
+            if recount:
+                _recompute(recount)
+    else:
+        Product.objects.filter(id__in=product_ids).update(
+            favorite_count=F('favorite_count') + 1,
+            popularity_score=_added(F('popularity_score'), weight),
+        )
+
+
+def rebuild_popularity():
+    """Recompute favorite counts and scores from the Favorite table"""
+    weights = {}
+    for product_id, created_at in Favorite.objects.values_list('product_id', 'created_at').iterator():
+        weights.setdefault(product_id, []).append(favorite_weight(created_at))
+
+    with transaction.atomic():
+        Product.objects.update(favorite_count=0, popularity_score=0)
+        for product_id, product_weights in weights.items():
+            Product.objects.filter(pk=product_id).update(
+                favorite_count=len(product_weights), popularity_score=score_of(product_weights)
+            )
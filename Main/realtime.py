@@ -0,0 +1,345 @@
+# realtime.py
+"""
+Server push of product price and stock changes.
+
+Clients subscribe to topics (product:<id>, category:<id>, farmer:<id>) over
+Server-Sent Events at /api/events/ or a WebSocket at /ws/events/, both of
+which need the ASGI application. Product saves and deletes are published
+once their transaction commits and fanned out in-process; with
+REALTIME_REDIS_URL set, events are also relayed to the other workers.
+
+Events are coalesced per client and product: a client that is slow to read,
+or a burst of updates within REALTIME_COALESCE_SECONDS, only gets the latest
+state of each product.
+"""
+import asyncio
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+import uuid
+from urllib.parse import parse_qs
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import Product
+
+try:
+    import redis
+except ImportError:  # pragma: no cover - only needed for REALTIME_REDIS_URL
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+TOPIC_RE = re.compile(r'^(product|category|farmer):\d+$')
+
+EVENT_FIELDS = ('id', 'category_id', 'farmer_id', 'price', 'quantity_available', 'unit', 'status', 'updated_at')
+
+
+def parse_topics(value):
+    """Split a comma separated topic list, raising ValueError on bad input"""
+    topics = {topic.strip() for topic in value.split(',') if topic.strip()} if value else set()
+    invalid = sorted(topic for topic in topics if not TOPIC_RE.match(topic))
+    if invalid:
+        raise ValueError(f"Invalid topics: {', '.join(invalid)}")
+    if len(topics) > getattr(settings, 'REALTIME_MAX_TOPICS', 50):
+        raise ValueError('Too many topics.')
+    return topics
+
+
+def product_event(row, deleted=False):
+    """Event payload for a product instance or a values() row"""
+    if not isinstance(row, dict):
+        row = {field: getattr(row, field) for field in EVENT_FIELDS}
+    if deleted:
+        return {
+            'type': 'product.deleted', 'id': row['id'],
+            'category_id': row['category_id'], 'farmer_id': row['farmer_id'],
+        }
+    return {
+        'type': 'product.updated',
+        'id': row['id'],
+        'category_id': row['category_id'],
+        'farmer_id': row['farmer_id'],
+        'price': str(row['price']),
+        'quantity_available': str(row['quantity_available']),
+        'unit': row['unit'],
+        'status': row['status'],
+        'updated_at': row['updated_at'].isoformat() if row['updated_at'] else None,
+    }
+
+
+def event_topics(event):
+    return (f"product:{event['id']}", f"category:{event['category_id']}", f"farmer:{event['farmer_id']}")
+
+
+class Subscription:
+    """One client's topics and its pending events, latest per product"""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.topics = set()
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.wakeup = asyncio.Event()
+
+    def push(self, event):
+        with self.lock:
+            # Re-insert so products are sent in the order of their last change
+            self.pending.pop(event['id'], None)
+            self.pending[event['id']] = event
+        try:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+        except RuntimeError:
+            pass  # The client's event loop is gone
+
+    async def next_batch(self, timeout=None):
+        """Wait up to `timeout` seconds for events; [] on timeout"""
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            return []
+        coalesce = getattr(settings, 'REALTIME_COALESCE_SECONDS', 0.25)
+        if coalesce:
+            await asyncio.sleep(coalesce)
+        self.wakeup.clear()
+        with self.lock:
+            events, self.pending = list(self.pending.values()), {}
+        return events
+
+
+class Broker:
+    """In-process fan-out of events to the subscriptions of their topics"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.topics = {}
+
+    def subscribe(self, topics=()):
+        """Create a subscription bound to the running event loop"""
+        subscription = Subscription(asyncio.get_running_loop())
+        self.update(subscription, add=topics)
+        bridge = get_bridge()
+        if bridge is not None:
+            bridge.start(self)
+        return subscription
+
+    def update(self, subscription, add=(), remove=()):
+        with self.lock:
+            for topic in add:
+                self.topics.setdefault(topic, set()).add(subscription)
+                subscription.topics.add(topic)
+            for topic in remove:
+                self._discard(subscription, topic)
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            for topic in list(subscription.topics):
+                self._discard(subscription, topic)
+
+    def _discard(self, subscription, topic):
+        subscribers = self.topics.get(topic)
+        if subscribers is not None:
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self.topics[topic]
+        subscription.topics.discard(topic)
+
+    def subscriber_count(self):
+        with self.lock:
+            return len(set().union(*self.topics.values())) if self.topics else 0
+
+    def deliver(self, events):
+        """Hand events to this process's subscribers"""
+        for event in events:
+            with self.lock:
+                targets = set()
+                for topic in event_topics(event):
+                    targets.update(self.topics.get(topic, ()))
+            for subscription in targets:
+                subscription.push(event)
+
+    def publish(self, events):
+        """Deliver events here and, through the bridge, in every other worker"""
+        if not events:
+            return
+        self.deliver(events)
+        bridge = get_bridge()
+        if bridge is not None:
+            bridge.publish(events)
+
+
+broker = Broker()
+
+
+class RedisBridge:
+    """
+    Relays events between worker processes over a Redis pub/sub channel.
+    Publishing only queues the events; a background thread sends them in
+    batches, so writes are not slowed down or failed by Redis.
+    """
+
+    def __init__(self, url, channel):
+        self.client = redis.Redis.from_url(url)
+        self.channel = channel
+        self.origin = uuid.uuid4().hex
+        self.outbox = queue.Queue(maxsize=10000)
+        self.lock = threading.Lock()
+        self.started = False
+
+    def start(self, broker):
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        threading.Thread(target=self._send, name='realtime-redis-send', daemon=True).start()
+        threading.Thread(target=self._listen, args=(broker,), name='realtime-redis-listen', daemon=True).start()
+
+    def publish(self, events):
+        self.start(broker)
+        for event in events:
+            try:
+                self.outbox.put_nowait(event)
+            except queue.Full:
+                logger.warning('Realtime outbox full, dropping product events')
+                return
+
+    def _send(self):
+        while True:
+            batch = {}
+            event = self.outbox.get()
+            batch[event['id']] = event
+            while True:
+                try:
+                    event = self.outbox.get_nowait()
+                except queue.Empty:
+                    break
+                batch[event['id']] = event
+            try:
+                self.client.publish(self.channel, json.dumps({'origin': self.origin, 'events': list(batch.values())}))
+            except Exception as e:
+                logger.warning(f"Error publishing product events to Redis: {str(e)}")
+
+    def _listen(self, broker):
+        while True:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    payload = json.loads(message['data'])
+                    if payload['origin'] != self.origin:
+                        broker.deliver(payload['events'])
+            except Exception as e:
+                logger.warning(f"Realtime Redis subscription lost, reconnecting: {str(e)}")
+                time.sleep(1)
+
+
+# One bridge per process; forked workers build their own
+_bridges = {}
+_bridges_lock = threading.Lock()
+
+
+def get_bridge():
+    url = getattr(settings, 'REALTIME_REDIS_URL', None)
+    if not url or redis is None:
+        return None
+    pid = os.getpid()
+    with _bridges_lock:
+        bridge = _bridges.get(pid)
+        if bridge is None:
+            bridge = _bridges[pid] = RedisBridge(url, getattr(settings, 'REALTIME_CHANNEL', 'agrozor:products'))
+        return bridge
+
+
+def publish_events(events):
+    """Publish events once the current transaction commits"""
+    transaction.on_commit(lambda: broker.publish(events))
+
+
+def publish_products(product_ids):
+    """
+    Publish the committed state of products changed without signals, e.g.
+    by QuerySet.update(). Call it inside the transaction making the change.
+    """
+    product_ids = list(product_ids)
+
+    def publish():
+        rows = Product.objects.filter(id__in=product_ids).values(*EVENT_FIELDS)
+        broker.publish([product_event(row) for row in rows])
+
+    transaction.on_commit(publish)
+
+
+def sse_format(event):
+    return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+
+async def sse_stream(subscription):
+    heartbeat = getattr(settings, 'REALTIME_HEARTBEAT_SECONDS', 15)
+    try:
+        yield 'retry: 5000\n\n'
+        while True:
+            events = await subscription.next_batch(heartbeat)
+            if not events:
+                # Keeps proxies from closing an idle connection
+                yield ': keep-alive\n\n'
+            for event in events:
+                yield sse_format(event)
+    finally:
+        broker.unsubscribe(subscription)
+
+
+async def websocket_application(scope, receive, send):
+    """
+    ASGI WebSocket endpoint. Topics come from ?topics= and from
+    {"subscribe": [...]} / {"unsubscribe": [...]} messages; events are sent
+    as JSON text frames.
+    """
+    message = await receive()
+    if message['type'] != 'websocket.connect':
+        return
+    if scope['path'] != getattr(settings, 'REALTIME_WEBSOCKET_PATH', '/ws/events/'):
+        await send({'type': 'websocket.close', 'code': 4404})
+        return
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    try:
+        topics = parse_topics(query.get('topics', [''])[0])
+    except ValueError:
+        await send({'type': 'websocket.close', 'code': 4400})
+        return
+
+    await send({'type': 'websocket.accept'})
+    subscription = broker.subscribe(topics)
+
+    async def pump():
+        while True:
+            for event in await subscription.next_batch():
+                await send({'type': 'websocket.send', 'text': json.dumps(event)})
+
+    pump_task = asyncio.ensure_future(pump())
+    try:
+        while True:
+            message = await receive()
+            if message['type'] == 'websocket.disconnect':
+                break
+            if message['type'] != 'websocket.receive':
+                continue
+            try:
+                command = json.loads(message.get('text') or '{}')
+                add = parse_topics(','.join(command.get('subscribe', [])))
+                remove = parse_topics(','.join(command.get('unsubscribe', [])))
+                if len(subscription.topics | add) > getattr(settings, 'REALTIME_MAX_TOPICS', 50):
+                    raise ValueError('Too many topics.')
+            except (ValueError, TypeError, AttributeError) as e:
+                await send({'type': 'websocket.send', 'text': json.dumps({
+                    'type': 'error', 'error': 'INVALID_TOPICS', 'message': str(e)
+                })})
+                continue
+            broker.update(subscription, add=add, remove=remove)
+    finally:
+        pump_task.cancel()
+        broker.unsubscribe(subscription)
@@ -0,0 +1,219 @@
+# recommendations.py
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+
+from .models import Favorite
+
+# Serving arrays, memory-mapped by the web workers
+SERVING_FILES = ('items', 'indptr', 'neighbors', 'scores')
+# Build state kept between incremental runs
+STATE_FILE = 'cooccurrence.npz'
+# Names the build directory currently being served
+CURRENT_FILE = 'CURRENT'
+
+
+def _directory():
+    return str(getattr(settings, 'RECOMMENDATIONS_DIR',
+                       os.path.join(settings.BASE_DIR, 'var', 'recommendations')))
+
+
+def _pair_codes(items):
+    """Codes (i << 32 | j) for every pair i < j of a user's sorted product ids"""
+    left, right = np.triu_indices(len(items), 1)
+    return (items[left] << 32) | items[right]
+
+
+def _user_items():
+    """{user id: sorted int64 array of favorited product ids}"""
+    max_items = getattr(settings, 'RECOMMENDATIONS_MAX_USER_ITEMS', 500)
+    by_user = {}
+    rows = Favorite.objects.order_by('user_id', '-created_at').values_list('user_id', 'product_id')
+    for user_id, product_id in rows.iterator(chunk_size=10000):
+        items = by_user.setdefault(user_id, [])
+        if len(items) < max_items:
+            items.append(product_id)
+    return {user_id: np.array(sorted(items), dtype=np.int64) for user_id, items in by_user.items()}
+
+
+def _load_state(path):
+    if not os.path.exists(path):
+        return None
+    # Every key access on an NpzFile reads and decompresses the array again
+    with np.load(path) as state:
+        codes, counts = state['codes'], state['counts']
+        user_ids, user_indptr, user_items = state['user_ids'], state['user_indptr'], state['user_items']
+    users = {}
+    for user_id, start, end in zip(user_ids.tolist(), user_indptr[:-1].tolist(), user_indptr[1:].tolist()):
+        users[user_id] = user_items[start:end]
+    return codes, counts, users
+
+
+def _save(directory, arrays, state):
+    """
+    Write the serving arrays to a fresh build directory and switch CURRENT to
+    it in one rename, so readers never mix arrays from two builds. The build
+    being replaced is kept, since workers may have read CURRENT but not opened
+    its files yet; older ones are removed, and workers that still map them
+    keep their pages until they reload.
+    """
+    os.makedirs(directory, exist_ok=True)
+    try:
+        with open(os.path.join(directory, CURRENT_FILE)) as current:
+            previous = current.read().strip()
+    except FileNotFoundError:
+        previous = None
+    build = f'build-{time.time_ns()}'
+    os.makedirs(os.path.join(directory, build))
+    for name in SERVING_FILES:
+        np.save(os.path.join(directory, build, f'{name}.npy'), arrays[name])
+    tmp = os.path.join(directory, 'cooccurrence.tmp.npz')
+    np.savez(tmp, **state)
+    os.replace(tmp, os.path.join(directory, STATE_FILE))
+
+    tmp = os.path.join(directory, f'{CURRENT_FILE}.tmp')
+    with open(tmp, 'w') as current:
+        current.write(build)
+    os.replace(tmp, os.path.join(directory, CURRENT_FILE))
+    for entry in os.listdir(directory):
+        if entry.startswith('build-') and entry not in (build, previous):
+            shutil.rmtree(os.path.join(directory, entry), ignore_errors=True)
+
+
+def build_related_products(full=False):
+    """
+    Rebuild the item-item co-occurrence matrix from Favorite and write the top
+    RECOMMENDATIONS_TOP_K neighbours per product for serving.
+
+    Pair counts are kept on disk between runs along with each user's item set,
+    so an incremental run only subtracts and re-adds the pairs of users whose
+    favorites changed. Returns the number of users that were (re)counted.
+    """
+    directory = _directory()
+    users = _user_items()
+    previous = None if full else _load_state(os.path.join(directory, STATE_FILE))
+
+    if previous is None:
+        codes, counts = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        old_users = {}
+    else:
+        codes, counts, old_users = previous
+
+    changed = [
+        user_id for user_id in set(users) | set(old_users)
+        if user_id not in users or user_id not in old_users
+        or not np.array_equal(users[user_id], old_users[user_id])
+    ]
+    empty = np.empty(0, dtype=np.int64)
+    removed = [_pair_codes(old_users[u]) for u in changed if u in old_users]
+    added = [_pair_codes(users[u]) for u in changed if u in users]
+    all_codes = np.concatenate([codes] + removed + added)
+    all_weights = np.concatenate(
+        [counts]
+        + [-np.ones(len(c), dtype=np.int64) for c in removed]
+        + [np.ones(len(c), dtype=np.int64) for c in added]
+    ) if len(all_codes) else empty
+    codes, inverse = np.unique(all_codes, return_inverse=True)
+    counts = np.bincount(inverse, weights=all_weights, minlength=len(codes)).astype(np.int64)
+    codes, counts = codes[counts > 0], counts[counts > 0]
+
+    arrays = _top_neighbors(codes, counts, users)
+    user_ids = np.array(sorted(users), dtype=np.int64)
+    user_lengths = [len(users[u]) for u in user_ids]
+    state = {
+        'codes': codes,
+        'counts': counts,
+        'user_ids': user_ids,
+        'user_indptr': np.concatenate([[0], np.cumsum(user_lengths)]).astype(np.int64),
+        'user_items': np.concatenate([users[u] for u in user_ids]) if len(user_ids) else empty,
+    }
+    _save(directory, arrays, state)
+    return len(changed)
+
+
+def _top_neighbors(codes, counts, users):
+    """CSR arrays of the best neighbours per product by cosine similarity"""
+    top_k = getattr(settings, 'RECOMMENDATIONS_TOP_K', 20)
+    left, right = codes >> 32, codes & 0xFFFFFFFF
+
+    all_items = np.concatenate(list(users.values())) if users else np.empty(0, dtype=np.int64)
+    item_ids, item_counts = np.unique(all_items, return_counts=True)
+
+    source = np.concatenate([left, right])
+    target = np.concatenate([right, left])
+    weight = np.concatenate([counts, counts]).astype(np.float64)
+    # Cosine similarity: co-favorites over the geometric mean of each item's favorites
+    source_favorites = item_counts[np.searchsorted(item_ids, source)]
+    target_favorites = item_counts[np.searchsorted(item_ids, target)]
+    scores = weight / np.sqrt(source_favorites * target_favorites.astype(np.float64))
+
+    order = np.lexsort((-scores, source))
+    source, target, scores = source[order], target[order], scores[order]
+    items, starts = np.unique(source, return_index=True)
+    group = np.searchsorted(items, source)
+    keep = np.arange(len(source)) - starts[group] < top_k
+    source, target, scores = source[keep], target[keep], scores[keep]
+
+    lengths = np.bincount(np.searchsorted(items, source), minlength=len(items))
+    return {
+        'items': items.astype(np.int64),
+        'indptr': np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64),
+        'neighbors': target.astype(np.int64),
+        'scores': scores.astype(np.float32),
+    }
+
+
+class RelatedProducts:
+    """Serves neighbours from the memory-mapped arrays, reloading after rebuilds"""
+
+    check_interval = 30
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.arrays = None
+        self.build = None
+        self.checked_at = 0
+
+    def load(self):
+        now = time.monotonic()
+        if self.arrays is not None and now - self.checked_at < self.check_interval:
+            return self.arrays
+        with self.lock:
+            self.checked_at = now
+            directory = _directory()
+            # A second attempt picks up a build that replaced the one just read
+            for attempt in range(2):
+                try:
+                    with open(os.path.join(directory, CURRENT_FILE)) as current:
+                        build = current.read().strip()
+                    if self.arrays is None or build != self.build:
+                        self.arrays = {
+                            name: np.load(os.path.join(directory, build, f'{name}.npy'), mmap_mode='r')
+                            for name in SERVING_FILES
+                        }
+                        self.build = build
+                    break
+                except FileNotFoundError:
+                    if attempt:
+                        self.arrays = None
+        return self.arrays
+
+    def lookup(self, product_id, limit=10):
+        """[(product id, score)] for products favorited together with product_id"""
+        arrays = self.load()
+        if arrays is None:
+            return []
+        items = arrays['items']
+        position = np.searchsorted(items, product_id)
+        if position >= len(items) or items[position] != product_id:
+            return []
+        start, end = arrays['indptr'][position], arrays['indptr'][position + 1]
+        end = min(end, start + limit)
+        return list(zip(arrays['neighbors'][start:end].tolist(), arrays['scores'][start:end].tolist()))
+
+
+related_products = RelatedProducts()
@@ -0,0 +1,35 @@
+# renderers.py
+import orjson
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+
+class ORJSONRenderer(JSONRenderer):
+    """
+    JSON renderer backed by orjson.
+
+    UUIDs are serialized natively by orjson. Dates, times and datetimes go
+    through DRF's encoder, since orjson rounds UTC offsets to the minute
+    (historical zone offsets such as +05:53:28), and so does anything orjson
+    does not know about (Decimal, lazy strings, querysets, ...), so the
+    output matches the stock JSONRenderer byte for byte.
+    Pretty-printed requests (e.g. from the browsable API) use the stock path.
+    """
+    options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+    _fallback = JSONEncoder().default
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+
+        renderer_context = renderer_context or {}
+        if self.get_indent(accepted_media_type, renderer_context) is not None:
+            return super().render(data, accepted_media_type, renderer_context)
+
+        ret = orjson.dumps(data, default=self._fallback, option=self.options)
+
+        # Keep the output a strict javascript subset, same as JSONRenderer.
+        if b'\xe2\x80\xa8' in ret or b'\xe2\x80\xa9' in ret:
+            ret = ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+        return ret
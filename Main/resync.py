@@ -0,0 +1,64 @@
+# resync.py
+"""
+Keeping the per-worker in-memory indexes (facets, geo, semantic search) in
+step with writes made by other workers.
+
+Each index has a generation counter in the shared cache, bumped after every
+write it applies locally. A worker whose last seen generation differs pulls
+the product rows changed since its last sync, by `updated_at`, and applies
+them. Its own bump is skipped when nobody else wrote in between.
+
+This needs a cache shared by the workers (Redis, see REDIS_URL). With the
+default LocMemCache each worker only sees its own bumps, so other workers'
+writes only show up at its next max-age rebuild or check.
+"""
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.utils import timezone
+
+from .models import Product
+
+
+class SyncedIndex:
+    """
+    Mixin for the indexes above. Subclasses set `generation_key`, keep
+    `lock`, `generation` and `synced_at`, and implement `apply_changes()`.
+    """
+    generation_key = None
+
+    def apply_changes(self, queryset):
+        """Apply the products in `queryset`, changed since the last sync"""
+        raise NotImplementedError
+
+    def shared_generation(self):
+        return cache.get(self.generation_key, 0)
+
+    def sync(self):
+        """Apply rows changed since the last sync (a second of overlap covers clock skew)"""
+        with self.lock:
+            since = self.synced_at - timedelta(seconds=1)
+            self.synced_at = timezone.now()
+            self.apply_changes(Product.objects.filter(updated_at__gte=since))
+
+    def sync_if_changed(self, force=False):
+        """sync() when another worker wrote since the last one, or when `force`; True if it ran"""
+        generation = self.shared_generation()
+        if generation == self.generation and not force:
+            return False
+        with self.lock:
+            self.sync()
+            self.generation = generation
+        return True
+
+    def bump_generation(self):
+        """Tell other workers to resync, after applying a write locally"""
+        try:
+            generation = cache.incr(self.generation_key)
+        except ValueError:
+            generation = 1
+            cache.set(self.generation_key, generation, None)
+        with self.lock:
+            # Nobody else wrote since our last sync, so there is nothing to pull
+            if self.generation == generation - 1:
+                self.generation = generation
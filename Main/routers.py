@@ -0,0 +1,121 @@
+# routers.py
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+
+# True while serving a read-only endpoint that may use a replica
+_replica_reads = ContextVar('replica_reads', default=False)
+
+
+def replica_aliases():
+    """Database aliases configured as read replicas"""
+    return getattr(settings, 'DATABASE_REPLICAS', [])
+
+
+def reads_use_replicas():
+    """Whether ORM reads in the current context may go to a replica"""
+    return _replica_reads.get()
+
+
+def primary_pin_key(user_id):
+    return f'db:primary:{user_id}'
+
+
+def pin_to_primary(user_id):
+    """Serve this user's reads from the primary until replicas have caught up"""
+    cache.set(primary_pin_key(user_id), True, getattr(settings, 'READ_YOUR_WRITES_SECONDS', 10))
+
+
+def is_pinned(request):
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_authenticated:
+        return False
+    return bool(cache.get(primary_pin_key(user.pk)))
+
+
+@contextmanager
+def replica_reads(enabled=True):
+    """Route ORM reads in this block to a replica (or back to the primary)"""
+    token = _replica_reads.set(enabled)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+def primary_reads():
+    """Force reads in this block to the primary, e.g. for index syncs"""
+    return replica_reads(enabled=False)
+
+
+def on_primary(func):
+    """
+    Decorator keeping a function's reads on the primary. The in-process
+    indexes sync on `updated_at`, and a lagging replica would make them skip rows.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with primary_reads():
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def use_replica(view):
+    """Decorator for read-only function views; see ReplicaReadMixin"""
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        with replica_reads(not is_pinned(request)):
+            return view(request, *args, **kwargs)
+    return wrapper
+
+
+class ReplicaReadMixin:
+    """
+    Serve a read-only API view from a replica. Requests from users who wrote
+    within READ_YOUR_WRITES_SECONDS stay on the primary so they see their own
+    changes.
+    """
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if request.method in ('GET', 'HEAD', 'OPTIONS') and not is_pinned(request):
+            self._replica_token = _replica_reads.set(True)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        token = getattr(self, '_replica_token', None)
+        if token is not None:
+            _replica_reads.reset(token)
+            self._replica_token = None
+        return super().finalize_response(request, response, *args, **kwargs)
+
+
+class ReplicaRouter:
+    """
+    Writes always go to the primary. Reads go to a random replica only inside
+    replica_reads(), so reads made while handling a write cannot see stale
+    rows. Objects loaded from a replica keep using it for related lookups.
+    """
+
+    def db_for_read(self, model, **hints):
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            return instance._state.db
+        if _replica_reads.get():
+            replicas = replica_aliases()
+            if replicas:
+                return random.choice(replicas)
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *replica_aliases()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
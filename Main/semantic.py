@@ -0,0 +1,411 @@
+# semantic.py
+import json
+import logging
+import math
+import os
+import re
+import shutil
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from .models import Product
+from .resync import SyncedIndex
+from .routers import on_primary
+
+try:
+    import faiss
+except ImportError:  # pragma: no cover - faiss-cpu is optional
+    faiss = None
+
+try:
+    import spacy
+except ImportError:  # pragma: no cover - only needed for SEMANTIC_SEARCH_MODEL
+    spacy = None
+
+logger = logging.getLogger(__name__)
+
+META_FILE = 'meta.json'
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+# Regional and international names folded onto one term before hashing
+SYNONYMS = {
+    'brinjal': 'eggplant', 'aubergine': 'eggplant', 'baingan': 'eggplant',
+    'cilantro': 'coriander', 'dhania': 'coriander', 'kothimbir': 'coriander',
+    'ladyfinger': 'okra', 'bhindi': 'okra',
+    'capsicum': 'pepper', 'shimla': 'pepper',
+    'aloo': 'potato', 'batata': 'potato',
+    'tamatar': 'tomato',
+    'pyaz': 'onion', 'kanda': 'onion',
+    'palak': 'spinach',
+    'methi': 'fenugreek',
+    'mirchi': 'chilli', 'chili': 'chilli', 'chile': 'chilli',
+    'adrak': 'ginger', 'lehsun': 'garlic', 'lasun': 'garlic',
+    'gobi': 'cauliflower', 'kela': 'banana', 'aam': 'mango',
+    'courgette': 'zucchini', 'scallion': 'spring onion',
+}
+
+
+class HashingEmbedder:
+    """
+    Offline embedding: words (after synonym folding) and their character
+    trigrams hashed into a fixed number of signed buckets, L2-normalized.
+    Deterministic across processes, so stored vectors stay valid.
+    """
+
+    trigram_weight = 0.5
+
+    def __init__(self, dimensions, synonyms):
+        self.dimensions = dimensions
+        self.synonyms = synonyms
+        self.signature = f'hashing-{dimensions}-{zlib.crc32(json.dumps(synonyms, sort_keys=True).encode())}'
+        self.bucket = lru_cache(maxsize=200000)(self._bucket)
+
+    def _bucket(self, feature):
+        code = zlib.crc32(feature.encode())
+        return code % self.dimensions, 1.0 if code & 0x80000000 else -1.0
+
+    def features(self, text):
+        for word in TOKEN_RE.findall(text.lower()):
+            for term in self.synonyms.get(word, word).split():
+                yield term, 1.0
+                padded = f'#{term}#'
+                for start in range(len(padded) - 2):
+                    yield padded[start:start + 3], self.trigram_weight
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature, weight in self.features(text):
+                column, sign = self.bucket(feature)
+                vectors[row, column] += sign * weight
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+
+class SpacyEmbedder:
+    """Document vectors from a locally installed spaCy model with word vectors"""
+
+    def __init__(self, model):
+        if spacy is None:
+            raise ImportError('SEMANTIC_SEARCH_MODEL needs spaCy installed')
+        self.nlp = spacy.load(model, exclude=['parser', 'ner', 'lemmatizer', 'textcat'])
+        self.dimensions = self.nlp.vocab.vectors_length
+        self.signature = f'spacy-{model}-{self.nlp.meta.get("version")}'
+
+    def embed(self, texts):
+        vectors = np.array([doc.vector for doc in self.nlp.pipe(texts)], dtype=np.float32)
+        vectors = vectors.reshape(len(texts), self.dimensions)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+
+def get_embedder():
+    model = getattr(settings, 'SEMANTIC_SEARCH_MODEL', None)
+    if model:
+        return SpacyEmbedder(model)
+    return HashingEmbedder(
+        getattr(settings, 'SEMANTIC_SEARCH_DIMENSIONS', 256),
+        getattr(settings, 'SEMANTIC_SEARCH_SYNONYMS', SYNONYMS),
+    )
+
+
+def product_text(name, description):
+    """Text embedded for a product; the name counts twice"""
+    return f'{name} {name} {description or ""}'
+
+
+class NumpyVectors:
+    """Exact inner-product search over a plain matrix, used without faiss"""
+
+    kind = 'numpy'
+
+    def __init__(self, dimensions, ids=None, vectors=None):
+        self.ids = np.empty(0, dtype=np.int64) if ids is None else ids
+        self.vectors = np.empty((0, dimensions), dtype=np.float32) if vectors is None else vectors
+
+    def add(self, ids, vectors):
+        self.ids = np.concatenate([self.ids, ids])
+        self.vectors = np.concatenate([self.vectors, vectors])
+
+    def remove(self, ids):
+        keep = ~np.isin(self.ids, ids)
+        self.ids, self.vectors = self.ids[keep], self.vectors[keep]
+
+    def search(self, vector, limit):
+        if not len(self.ids):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        scores = self.vectors @ vector
+        limit = min(limit, len(scores))
+        top = np.argpartition(-scores, limit - 1)[:limit]
+        return self.ids[top], scores[top]
+
+    def save(self, path):
+        np.save(os.path.join(path, 'ids.npy'), self.ids)
+        np.save(os.path.join(path, 'vectors.npy'), self.vectors)
+
+    @classmethod
+    def load(cls, path, dimensions):
+        return cls(
+            dimensions,
+            np.load(os.path.join(path, 'ids.npy'), mmap_mode='r'),
+            np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r'),
+        )
+
+
+class FaissVectors:
+    """
+    faiss index with product ids attached. Catalogs large enough to train it
+    get an IVF index, which only scans SEMANTIC_FAISS_NPROBE of the clusters
+    per query; smaller ones use an exact flat index.
+    """
+
+    kind = 'faiss'
+
+    def __init__(self, dimensions, index=None):
+        self.index = index if index is not None else faiss.IndexIDMap2(faiss.IndexFlatIP(dimensions))
+        self.set_nprobe()
+
+    @classmethod
+    def build(cls, dimensions, ids, vectors):
+        lists = int(math.sqrt(len(ids)))
+        if lists >= 100:
+            index = faiss.index_factory(dimensions, f'IVF{lists},Flat', faiss.METRIC_INNER_PRODUCT)
+            sample = np.random.default_rng(0).choice(len(ids), min(len(ids), lists * 64), replace=False)
+            index.train(np.ascontiguousarray(vectors[np.sort(sample)]))
+            vectors_index = cls(dimensions, index)
+        else:
+            vectors_index = cls(dimensions)
+        vectors_index.add(ids, vectors)
+        return vectors_index
+
+    def set_nprobe(self):
+        if isinstance(self.index, faiss.IndexIVF):
+            self.index.nprobe = getattr(settings, 'SEMANTIC_FAISS_NPROBE', 16)
+
+    def add(self, ids, vectors):
+        if len(ids):
+            self.index.add_with_ids(np.ascontiguousarray(vectors, dtype=np.float32),
+                                    np.ascontiguousarray(ids, dtype=np.int64))
+
+    def remove(self, ids):
+        if len(ids):
+            self.index.remove_ids(np.ascontiguousarray(ids, dtype=np.int64))
+
+    def search(self, vector, limit):
+        scores, ids = self.index.search(vector.reshape(1, -1), limit)
+        found = ids[0] >= 0
+        return ids[0][found], scores[0][found]
+
+    def save(self, path):
+        faiss.write_index(self.index, os.path.join(path, 'index.faiss'))
+
+    @classmethod
+    def load(cls, path, dimensions):
+        return cls(dimensions, faiss.read_index(os.path.join(path, 'index.faiss')))
+
+
+def vector_store():
+    return FaissVectors if faiss is not None else NumpyVectors
+
+
+class SemanticIndex(SyncedIndex):
+    """
+    Nearest-neighbour index over product embeddings. Builds are made by
+    `manage.py build_semantic_index` and published under SEMANTIC_INDEX_DIR;
+    request paths only ever load the published build, never write one.
+
+    Product writes are embedded into a small overlay that shadows the stored
+    vectors until the next build. Other workers' writes arrive through
+    SyncedIndex; every SEMANTIC_INDEX_MAX_AGE seconds workers also look for
+    a newer build and changed rows, for caches not shared across processes.
+    Deleted or unavailable products may linger until the next build, which
+    is why callers filter the returned ids against the database.
+    """
+    generation_key = 'semantic:generation'
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.embedder = None
+        self.vectors = None
+        self.overlay = {}
+        self.build = None
+        self.synced_at = None
+        self.generation = None
+        self.checked_at = None
+        self.overlay_warned = False
+        self.missing_warned = False
+
+    def directory(self):
+        return str(getattr(settings, 'SEMANTIC_INDEX_DIR',
+                           os.path.join(settings.BASE_DIR, 'var', 'semantic')))
+
+    def get_embedder(self):
+        if self.embedder is None:
+            self.embedder = get_embedder()
+        return self.embedder
+
+    def read_meta(self):
+        try:
+            with open(os.path.join(self.directory(), META_FILE)) as meta:
+                return json.load(meta)
+        except FileNotFoundError:
+            return None
+
+    def rebuild(self):
+        """Embed every available product, then persist and load the result"""
+        embedder = self.get_embedder()
+        synced_at = timezone.now()
+        ids, chunks = [], []
+        batch = []
+        rows = Product.objects.filter(status='available').order_by().values_list('id', 'name', 'description')
+        for pk, name, description in rows.iterator(chunk_size=5000):
+            ids.append(pk)
+            batch.append(product_text(name, description))
+            if len(batch) == 5000:
+                chunks.append(embedder.embed(batch))
+                batch = []
+        if batch:
+            chunks.append(embedder.embed(batch))
+        vectors = np.concatenate(chunks) if chunks else np.empty((0, embedder.dimensions), dtype=np.float32)
+        store = vector_store()
+        if store is FaissVectors:
+            index = FaissVectors.build(embedder.dimensions, np.array(ids, dtype=np.int64), vectors)
+        else:
+            index = NumpyVectors(embedder.dimensions, np.array(ids, dtype=np.int64), vectors)
+
+        with self.lock:
+            self.save(index, synced_at)
+            self.vectors = index
+            self.overlay = {}
+            self.overlay_warned = False
+            self.synced_at = synced_at
+        self.bump_generation()
+
+    def save(self, index, synced_at):
+        directory = self.directory()
+        build = f'build-{time.time_ns()}'
+        os.makedirs(os.path.join(directory, build))
+        index.save(os.path.join(directory, build))
+        previous = (self.read_meta() or {}).get('build')
+        meta = {
+            'build': build,
+            'kind': index.kind,
+            'embedder': self.get_embedder().signature,
+            'synced_at': synced_at.isoformat(),
+        }
+        tmp = os.path.join(directory, f'{META_FILE}.{os.getpid()}.tmp')
+        with open(tmp, 'w') as handle:
+            json.dump(meta, handle)
+        os.replace(tmp, os.path.join(directory, META_FILE))
+        # Workers may have just read the previous build's name, so it stays
+        # until the next build replaces it
+        for entry in os.listdir(directory):
+            if entry.startswith('build-') and entry not in (build, previous):
+                shutil.rmtree(os.path.join(directory, entry), ignore_errors=True)
+        self.build = build
+
+    def load(self):
+        """Load the persisted build; False when there is none usable"""
+        meta = self.read_meta()
+        embedder = self.get_embedder()
+        store = vector_store()
+        if not meta or meta['embedder'] != embedder.signature or meta['kind'] != store.kind:
+            return False
+        try:
+            index = store.load(os.path.join(self.directory(), meta['build']), embedder.dimensions)
+        except FileNotFoundError:
+            # Replaced by a newer build since meta.json was read
+            return self.load() if self.read_meta() != meta else False
+        with self.lock:
+            self.vectors = index
+            self.overlay = {}
+            self.overlay_warned = False
+            self.build = meta['build']
+            self.synced_at = datetime.fromisoformat(meta['synced_at'])
+        return True
+
+    def apply_changes(self, queryset):
+        self.apply_rows(list(queryset.order_by().values_list('id', 'status', 'name', 'description')))
+
+    def apply_rows(self, rows):
+        """Record (id, status, name, description) rows in the overlay"""
+        if self.vectors is None:
+            return
+        available = [row for row in rows if row[1] == 'available']
+        vectors = self.get_embedder().embed([product_text(row[2], row[3]) for row in available])
+        with self.lock:
+            if self.vectors is None:
+                return
+            for row in rows:
+                self.overlay[row[0]] = None
+            for row, vector in zip(available, vectors):
+                self.overlay[row[0]] = vector
+            limit = getattr(settings, 'SEMANTIC_OVERLAY_LIMIT', 5000)
+            if len(self.overlay) > limit and not self.overlay_warned:
+                self.overlay_warned = True
+                logger.warning(f"Semantic index overlay has over {limit} products; run build_semantic_index")
+
+    @on_primary
+    def ensure_fresh(self):
+        """Load the published build and catch up on writes; False when there is no build"""
+        if self.vectors is None:
+            with self.lock:
+                if self.vectors is None and not self.load():
+                    return False
+                self.sync_if_changed(force=True)
+                self.checked_at = time.monotonic()
+            return True
+        max_age = getattr(settings, 'SEMANTIC_INDEX_MAX_AGE', 300)
+        if self.checked_at is None or time.monotonic() - self.checked_at > max_age:
+            with self.lock:
+                meta = self.read_meta()
+                if meta and meta['build'] != self.build:
+                    self.load()
+                self.sync_if_changed(force=True)
+                self.checked_at = time.monotonic()
+        else:
+            self.sync_if_changed()
+        return True
+
+    def search(self, query, limit=None):
+        """[(product id, similarity)] closest to the query, best first"""
+        limit = limit or getattr(settings, 'SEMANTIC_SEARCH_CANDIDATES', 200)
+        min_score = getattr(settings, 'SEMANTIC_SEARCH_MIN_SCORE', 0.2)
+        if not self.ensure_fresh():
+            if not self.missing_warned:
+                self.missing_warned = True
+                logger.warning('No semantic search index built yet; run build_semantic_index')
+            return []
+        vector = self.get_embedder().embed([query])[0]
+        with self.lock:
+            ids, scores = self.vectors.search(vector, limit + len(self.overlay))
+            hits = {int(pk): float(score) for pk, score in zip(ids, scores) if int(pk) not in self.overlay}
+            for pk, stored in self.overlay.items():
+                if stored is not None:
+                    hits[pk] = float(stored @ vector)
+        ranked = sorted(hits.items(), key=lambda item: -item[1])
+        return [(pk, score) for pk, score in ranked[:limit] if score >= min_score]
+
+
+semantic_index = SemanticIndex()
+
+
+def mark_product_text_changed(product_id):
+    """Re-embed a product locally and tell other workers to resync"""
+    mark_products_text_changed([product_id])
+
+
+def mark_products_text_changed(product_ids):
+    rows = list(Product.objects.filter(pk__in=product_ids).values_list('id', 'status', 'name', 'description'))
+    found = {row[0] for row in rows}
+    rows += [(pk, None, None, None) for pk in product_ids if pk not in found]
+    semantic_index.apply_rows(rows)
+    semantic_index.bump_generation()
@@ -1,9 +1,57 @@
 # serializers.py
+from decimal import Decimal
+from functools import lru_cache
+from operator import itemgetter
 from rest_framework import serializers
+from rest_framework.fields import get_attribute
 from rest_framework_simplejwt.tokens import RefreshToken
 from django.contrib.auth import authenticate
 from django.contrib.auth.password_validation import validate_password
-from .models import User, Category, SubCategory, Product, ProductImage, ContactMessage, Favorite
+from .favorites import favorite_product_ids
+from .models import (
+    User, Category, SubCategory, Product, ProductImage, ContactMessage, Favorite, InventoryReservation, BASE_UNITS
+)
+
+
+def favorite_ids_for(context, product_ids=None):
+    """
+    Product ids favorited by the requesting user, loaded once per serializer
+    context. Pass `product_ids` to look up only those products (see
+    favorite_product_ids); a later call for a subset reuses the result.
+    """
+    if 'favorite_ids' in context:
+        return context['favorite_ids']
+    user = getattr(context.get('request'), 'user', None)
+    if product_ids is None:
+        context['favorite_ids'] = favorite_product_ids(user)
+        return context['favorite_ids']
+    product_ids = frozenset(product_ids)
+    scope, favorite_ids = context.get('favorite_scope', (frozenset(), frozenset()))
+    if not product_ids <= scope:
+        scope, favorite_ids = product_ids, favorite_product_ids(user, product_ids)
+        context['favorite_scope'] = scope, favorite_ids
+    return favorite_ids
+
+
+def listed_product_ids(serializer, obj):
+    """
+    Ids of the products serialized alongside `obj`: the whole page when
+    `serializer` sits under a many=True list (directly or as a nested field),
+    else just `obj`
+    """
+    sources = []
+    node = serializer
+    while node.parent is not None and not isinstance(node.parent, serializers.ListSerializer):
+        sources.append(node.source_attrs)
+        node = node.parent
+    if node.parent is None or node.parent.instance is None:
+        return [obj.pk]
+    product_ids = []
+    for item in node.parent.instance:
+        for attrs in reversed(sources):
+            item = get_attribute(item, attrs)
+        product_ids.append(item.pk)
+    return product_ids
 
 class UserRegistrationSerializer(serializers.ModelSerializer):
     password = serializers.CharField(write_only=True, validators=[validate_password])
@@ -13,7 +61,8 @@ class UserRegistrationSerializer(serializers.ModelSerializer):
         model = User
         fields = [
             'first_name', 'last_name', 'email', 'phone', 'password', 'password_confirm',
-            'user_type', 'farm_name', 'farm_location', 'farm_size', 
+            'user_type', 'farm_name', 'farm_location', 'farm_size',
+            'farm_latitude', 'farm_longitude',
             'business_name', 'business_type', 'business_address'
         ]
     
@@ -71,23 +120,33 @@ class UserProfileSerializer(serializers.ModelSerializer):
         fields = [
             'uid', 'first_name', 'last_name', 'email', 'phone', 'profile_picture',
             'user_type', 'is_verified', 'farm_name', 'farm_location', 'farm_size',
-            'business_name', 'business_type', 'business_address', 'created_at'
+            'farm_latitude', 'farm_longitude', 'business_name', 'business_type', 'business_address',
+            'created_at'
         ]
         read_only_fields = ['uid', 'email', 'user_type', 'is_verified', 'created_at']
 
 
+# Materialized product stats shared by category and subcategory payloads
+PRODUCT_STATS_FIELDS = ['available_count', 'organic_count', 'min_price', 'max_price', 'avg_price']
+
+
 class CategorySerializer(serializers.ModelSerializer):
+    avg_price = serializers.DecimalField(max_digits=10, decimal_places=2, read_only=True)
+    
     class Meta:
         model = Category
-        fields = ['id', 'name', 'description', 'image', 'is_active']
+        fields = ['id', 'name', 'description', 'image', 'is_active'] + PRODUCT_STATS_FIELDS
+        read_only_fields = PRODUCT_STATS_FIELDS
 
 
 class SubCategorySerializer(serializers.ModelSerializer):
     category_name = serializers.CharField(source='category.name', read_only=True)
+    avg_price = serializers.DecimalField(max_digits=10, decimal_places=2, read_only=True)
     
     class Meta:
         model = SubCategory
-        fields = ['id', 'name', 'description', 'category', 'category_name', 'is_active']
+        fields = ['id', 'name', 'description', 'category', 'category_name', 'is_active'] + PRODUCT_STATS_FIELDS
+        read_only_fields = PRODUCT_STATS_FIELDS
 
 
 class ProductImageSerializer(serializers.ModelSerializer):
@@ -101,50 +160,99 @@ class ProductListSerializer(serializers.ModelSerializer):
     category_name = serializers.CharField(source='category.name', read_only=True)
     subcategory_name = serializers.CharField(source='subcategory.name', read_only=True)
     primary_image = serializers.SerializerMethodField()
+    is_favorited = serializers.SerializerMethodField()
+    base_unit = serializers.SerializerMethodField()
     
     class Meta:
         model = Product
         fields = [
-            'id', 'name', 'description', 'price', 'unit', 'quantity_available',
-            'farmer_name', 'category_name', 'subcategory_name', 'location',
-            'organic', 'is_featured', 'status', 'primary_image', 'created_at'
+            'id', 'name', 'description', 'price', 'unit', 'price_per_base_unit', 'base_unit',
+            'quantity_available', 'farmer_name', 'category_name', 'subcategory_name', 'location',
+            'organic', 'is_featured', 'status', 'primary_image', 'is_favorited', 'created_at'
         ]
     
     def get_farmer_name(self, obj):
         return f"{obj.farmer.first_name} {obj.farmer.last_name}".strip() or obj.farmer.email
     
+    def get_base_unit(self, obj):
+        return obj.base_unit
+    
     def get_primary_image(self, obj):
         primary_image = obj.images.filter(is_primary=True).first()
         if primary_image:
             return self.context['request'].build_absolute_uri(primary_image.image.url)
         return None
+    
+    def get_is_favorited(self, obj):
+        return obj.pk in favorite_ids_for(self.context, listed_product_ids(self, obj))
+
+
+class SparseFieldsMixin:
+    """
+    Keep only the fields named in context['fields'] (the ?fields= query
+    parameter) and report which columns and relations those fields read, so
+    views can trim the SELECT to match.
+    """
+    # SerializerMethodField name -> model lookups the method reads
+    method_field_sources = {}
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        fields = self.context.get('fields')
+        if fields:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
 
-class ProductDetailSerializer(serializers.ModelSerializer):
+    def get_select_columns(self):
+        """Return (columns for only(), relations for select_related())"""
+        columns, relations = {'id'}, set()
+        for name, field in self.fields.items():
+            if isinstance(field, serializers.SerializerMethodField):
+                sources = self.method_field_sources.get(name, ())
+            elif isinstance(field, serializers.ListSerializer):
+                continue
+            else:
+                sources = ('__'.join(field.source_attrs),)
+            for source in sources:
+                columns.add(source)
+                if '__' in source:
+                    relation = source.split('__')[0]
+                    relations.add(relation)
+                    columns.add(relation)
+        return sorted(columns), sorted(relations)
+
+
+class ProductDetailSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     farmer_name = serializers.SerializerMethodField()
     farmer_phone = serializers.CharField(source='farmer.phone', read_only=True)
     category_name = serializers.CharField(source='category.name', read_only=True)
     subcategory_name = serializers.CharField(source='subcategory.name', read_only=True)
     images = ProductImageSerializer(many=True, read_only=True)
     is_favorited = serializers.SerializerMethodField()
+    base_unit = serializers.SerializerMethodField()
     
     class Meta:
         model = Product
         fields = [
-            'id', 'name', 'description', 'price', 'unit', 'quantity_available',
-            'min_order_quantity', 'harvest_date', 'expiry_date', 'organic',
-            'location', 'status', 'farmer_name', 'farmer_phone', 'category_name',
+            'id', 'name', 'description', 'price', 'unit', 'price_per_base_unit', 'base_unit',
+            'quantity_available', 'min_order_quantity', 'harvest_date', 'expiry_date', 'organic',
+            'location', 'latitude', 'longitude', 'status', 'farmer_name', 'farmer_phone', 'category_name',
             'subcategory_name', 'images', 'is_favorited', 'created_at', 'updated_at'
         ]
     
+    method_field_sources = {
+        'farmer_name': ('farmer__first_name', 'farmer__last_name', 'farmer__email'),
+        'base_unit': ('unit',),
+    }
+    
     def get_farmer_name(self, obj):
         return f"{obj.farmer.first_name} {obj.farmer.last_name}".strip() or obj.farmer.email
     
+    def get_base_unit(self, obj):
+        return obj.base_unit
+    
     def get_is_favorited(self, obj):
-        request = self.context.get('request')
-        if request and request.user.is_authenticated:
-            return Favorite.objects.filter(user=request.user, product=obj).exists()
-        return False
+        return obj.pk in favorite_ids_for(self.context, listed_product_ids(self, obj))
 
 
 class ProductCreateUpdateSerializer(serializers.ModelSerializer):
@@ -160,7 +268,8 @@ class ProductCreateUpdateSerializer(serializers.ModelSerializer):
         fields = [
             'name', 'description', 'price', 'unit', 'quantity_available',
             'min_order_quantity', 'harvest_date', 'expiry_date', 'organic',
-            'location', 'category', 'subcategory', 'images', 'uploaded_images'
+            'location', 'latitude', 'longitude', 'category', 'subcategory', 'images',
+            'uploaded_images'
         ]
     
     def create(self, validated_data):
@@ -179,9 +288,15 @@ class ProductCreateUpdateSerializer(serializers.ModelSerializer):
     def update(self, instance, validated_data):
         uploaded_images = validated_data.pop('uploaded_images', [])
         
+        # Restocking a sold-out product lists it again, as returned reservations do
+        if (instance.status == 'out_of_stock' and 'status' not in validated_data
+                and validated_data.get('quantity_available', 0) > 0):
+            validated_data['status'] = 'available'
+        
         for attr, value in validated_data.items():
             setattr(instance, attr, value)
-        instance.save()
+        # Only the submitted fields, so a partial update never rewrites stock or status
+        instance.save(update_fields=[*validated_data, 'updated_at'])
         
         # If new images are uploaded, add them
         if uploaded_images:
@@ -218,6 +333,209 @@ class FavoriteSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'created_at']
 
 
+class ReservationRequestSerializer(serializers.Serializer):
+    quantity = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=Decimal('0.01'))
+
+
+class InventoryReservationSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = InventoryReservation
+        fields = ['id', 'product', 'quantity', 'expires_at']
+        read_only_fields = fields
+
+
+# Fields whose to_representation() is a no-op for values coming out of the DB
+_PASSTHROUGH_FIELDS = (serializers.CharField, serializers.IntegerField,
+                       serializers.BooleanField, serializers.ChoiceField)
+_SKIP = object()
+
+
+def _column_getter(index, convert, traversed):
+    """Build a row getter that mimics how DRF renders a single model field"""
+    def getter(row):
+        value = row[index]
+        if value is None:
+            # A missing related object makes DRF drop read-only dotted fields
+            return _SKIP if traversed else None
+        return convert(value) if convert else value
+
+    if convert is None and not traversed:
+        return itemgetter(index)
+    return getter
+
+
+class ProductListRowSerializer:
+    """
+    Read-only twin of ProductListSerializer for hot list endpoints.
+
+    Works on `values_list(*columns())` tuples instead of model instances. The
+    field plan is derived once from ProductListSerializer, so the output is
+    identical without per-object field dispatch, and primary images for the
+    whole page come from a single query. `fields` limits both the selected
+    columns and the output; `expand=['images']` nests all product images.
+    """
+    mirror = ProductListSerializer
+    method_columns = {
+        'farmer_name': ('farmer__first_name', 'farmer__last_name', 'farmer__email'),
+        'primary_image': ('id',),
+        'is_favorited': ('id',),
+        'base_unit': ('unit',),
+    }
+    expandable_fields = ('images',)
+    _field_plan = None
+
+    def __init__(self, rows, context=None, offset=0, fields=None, expand=()):
+        self.rows = rows
+        self.context = context or {}
+        self.offset = offset
+        self.fields = tuple(fields) if fields else None
+        self.expand = tuple(expand)
+
+    @classmethod
+    def field_plan(cls):
+        """(output name, column, converter, traversed) for each declared field"""
+        if cls._field_plan is None:
+            plan = []
+            for name, field in cls.mirror().fields.items():
+                if isinstance(field, serializers.SerializerMethodField):
+                    plan.append((name, None, None, False))
+                    continue
+                convert = None if isinstance(field, _PASSTHROUGH_FIELDS) else field.to_representation
+                plan.append((name, '__'.join(field.source_attrs), convert, len(field.source_attrs) > 1))
+            cls._field_plan = plan
+        return cls._field_plan
+
+    @classmethod
+    def field_names(cls):
+        return [name for name, _, _, _ in cls.field_plan()]
+
+    @classmethod
+    def selected_plan(cls, fields=None):
+        # An empty selection means all fields, as in __init__
+        if not fields:
+            return cls.field_plan()
+        return [entry for entry in cls.field_plan() if entry[0] in fields]
+
+    @classmethod
+    def columns(cls, prefix='', fields=None, expand=()):
+        """Lookups to pass to values_list(), optionally behind a relation prefix"""
+        names = []
+        for name, column, _, _ in cls.selected_plan(fields):
+            for lookup in ((column,) if column else cls.method_columns[name]):
+                if lookup not in names:
+                    names.append(lookup)
+        if expand and 'id' not in names:
+            names.append('id')
+        return tuple(prefix + name for name in names)
+
+    def get_plan(self):
+        # Keyed on the declared fields selected, in declared order, however the request spelled them
+        names = tuple(name for name, _, _, _ in self.selected_plan(self.fields))
+        return self.build_plan(self.offset, names, bool(self.expand))
+
+    @classmethod
+    @lru_cache(maxsize=256)
+    def build_plan(cls, offset, names, expand):
+        """(getters, column index) for rows holding `names` from `offset` on"""
+        index = {
+            column: offset + i
+            for i, column in enumerate(cls.columns(fields=names, expand=expand))
+        }
+        getters = []
+        for name, column, convert, traversed in cls.selected_plan(names):
+            if column is None:
+                getters.append((name, None))
+            else:
+                getters.append((name, _column_getter(index[column], convert, traversed)))
+        return getters, index
+
+    def get_primary_images(self, product_ids):
+        if not product_ids:
+            return {}
+        request = self.context['request']
+        storage = ProductImage._meta.get_field('image').storage
+        images = {}
+        rows = (ProductImage.objects
+                .filter(product_id__in=product_ids, is_primary=True)
+                .order_by('product_id', 'pk')
+                .values_list('product_id', 'image'))
+        for product_id, name in rows:
+            if product_id not in images:
+                images[product_id] = request.build_absolute_uri(storage.url(name))
+        return images
+
+    def get_images(self, product_ids):
+        images = {product_id: [] for product_id in product_ids}
+        if not product_ids:
+            return images
+        queryset = ProductImage.objects.filter(product_id__in=product_ids).order_by('pk')
+        for image in queryset:
+            images[image.product_id].append(image)
+        return {
+            product_id: ProductImageSerializer(product_images, many=True, context=self.context).data
+            for product_id, product_images in images.items()
+        }
+
+    @property
+    def data(self):
+        getters, index = self.get_plan()
+        names = dict(getters)
+        methods = {}
+        if 'farmer_name' in names:
+            first, last, email = (index[column] for column in self.method_columns['farmer_name'])
+            methods['farmer_name'] = lambda row: f"{row[first]} {row[last]}".strip() or row[email]
+        if 'primary_image' in names or 'is_favorited' in names or self.expand:
+            id_index = index['id']
+            product_ids = [row[id_index] for row in self.rows]
+        if 'primary_image' in names:
+            primary_images = self.get_primary_images(product_ids)
+            methods['primary_image'] = lambda row: primary_images.get(row[id_index])
+        if 'base_unit' in names:
+            unit_index = index['unit']
+            methods['base_unit'] = lambda row: BASE_UNITS.get(row[unit_index], (None,))[0]
+        if 'is_favorited' in names:
+            favorite_ids = favorite_ids_for(self.context, product_ids)
+            methods['is_favorited'] = lambda row: row[id_index] in favorite_ids
+        if 'images' in self.expand:
+            images = self.get_images(product_ids)
+            getters = getters + [('images', lambda row: images[row[id_index]])]
+        getters = [(name, getter or methods[name]) for name, getter in getters]
+
+        data = []
+        for row in self.rows:
+            item = {}
+            for name, getter in getters:
+                value = getter(row)
+                if value is not _SKIP:
+                    item[name] = value
+            data.append(item)
+        return data
+
+
+class FavoriteRowSerializer:
+    """Read-only twin of FavoriteSerializer built on values_list() rows"""
+    own_columns = ('id', 'created_at')
+
+    def __init__(self, rows, context=None):
+        self.rows = rows
+        self.context = context or {}
+
+    @classmethod
+    def columns(cls):
+        return cls.own_columns + ProductListRowSerializer.columns(prefix='product__')
+
+    @property
+    def data(self):
+        products = ProductListRowSerializer(
+            self.rows, context=self.context, offset=len(self.own_columns)
+        ).data
+        created_at = FavoriteSerializer().fields['created_at'].to_representation
+        return [
+            {'id': row[0], 'product': product, 'created_at': created_at(row[1])}
+            for row, product in zip(self.rows, products)
+        ]
+
+
 class PasswordChangeSerializer(serializers.Serializer):
     old_password = serializers.CharField(required=True)
     new_password = serializers.CharField(required=True, validators=[validate_password])
@@ -0,0 +1,207 @@
+# signals.py
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .changelog import record_change
+from .facets import facet_row, mark_product_changed
+from .favorites import invalidate_favorites
+from .geo import mark_products_moved
+from .history import record_price
+from .models import Category, Product, ProductImage, SubCategory, User, Favorite
+from .pages import invalidate_product_pages
+from .popularity import record_favorites
+from .realtime import product_event, publish_events
+from .semantic import mark_product_text_changed
+from .singleflight import invalidate_group
+from .stats import STAT_FIELDS, apply_product_change, product_state
+
+
+@receiver(pre_save, sender=Product)
+def remember_product_state(sender, instance, raw=False, **kwargs):
+    """Keep the stored state so post_save can compute the stats delta and log price changes"""
+    instance._stats_state = None
+    if instance.pk and not raw:
+        instance._stats_state = Product.objects.filter(pk=instance.pk).values(
+            *STAT_FIELDS, 'quantity_available'
+        ).first()
+
+
+@receiver(post_save, sender=Product)
+def update_stats_on_save(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    apply_product_change(getattr(instance, '_stats_state', None), product_state(instance))
+
+
+@receiver(post_delete, sender=Product)
+def update_stats_on_delete(sender, instance, **kwargs):
+    apply_product_change(product_state(instance), None)
+
+
+@receiver(post_save, sender=Product)
+def reindex_facets_on_save(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    row = facet_row(instance)
+    transaction.on_commit(lambda: mark_product_changed(row))
+
+
+@receiver(post_delete, sender=Product)
+def reindex_facets_on_delete(sender, instance, **kwargs):
+    row = facet_row(instance, deleted=True)
+    transaction.on_commit(lambda: mark_product_changed(row))
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def reindex_geo_on_product_change(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    product_id = instance.pk
+    transaction.on_commit(lambda: mark_products_moved([product_id]))
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def reembed_product_on_change(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    product_id = instance.pk
+    transaction.on_commit(lambda: mark_product_text_changed(product_id))
+
+
+@receiver(post_save, sender=Product)
+def log_product_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        record_change(instance.pk)
+
+
+@receiver(post_delete, sender=Product)
+def log_product_deleted(sender, instance, **kwargs):
+    record_change(instance.pk, 'delete')
+
+
+@receiver(post_save, sender=ProductImage)
+@receiver(post_delete, sender=ProductImage)
+def log_product_image_changed(sender, instance, raw=False, **kwargs):
+    """Images are part of the product in the sync payload"""
+    if not raw:
+        record_change(instance.product_id)
+
+
+@receiver(post_save, sender=Product)
+def push_product_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        publish_events([product_event(instance)])
+
+
+@receiver(post_delete, sender=Product)
+def push_product_deleted(sender, instance, **kwargs):
+    publish_events([product_event(instance, deleted=True)])
+
+
+@receiver(post_save, sender=Product)
+def record_price_change(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    old = getattr(instance, '_stats_state', None)
+    if old is None:
+        record_price(instance)
+    elif old['price'] != instance.price or old.get('quantity_available') != instance.quantity_available:
+        record_price(instance, previous_price=old['price'])
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=ProductImage)
+@receiver(post_delete, sender=ProductImage)
+def invalidate_featured_cache(sender, raw=False, **kwargs):
+    if not raw:
+        transaction.on_commit(lambda: invalidate_group('featured'))
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=SubCategory)
+@receiver(post_delete, sender=SubCategory)
+def invalidate_category_cache(sender, raw=False, **kwargs):
+    """Category payloads include the product stats"""
+    if not raw:
+        transaction.on_commit(lambda: invalidate_group('categories'))
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_product_page(sender, instance, raw=False, **kwargs):
+    if not raw:
+        invalidate_product_pages([instance.pk], [instance.farmer_id])
+
+
+@receiver(post_save, sender=ProductImage)
+@receiver(post_delete, sender=ProductImage)
+def invalidate_product_page_images(sender, instance, raw=False, **kwargs):
+    if not raw:
+        product = Product.objects.filter(pk=instance.product_id).values('farmer_id').first()
+        invalidate_product_pages([instance.product_id], [product['farmer_id']] if product else [])
+
+
+@receiver(post_save, sender=User)
+def invalidate_farmer_pages(sender, instance, raw=False, update_fields=None, **kwargs):
+    """Product pages show the farmer's name and phone"""
+    if raw or not instance.is_farmer:
+        return
+    if update_fields is not None and set(update_fields) <= {'last_login', 'password'}:
+        return
+    product_ids = list(Product.objects.filter(farmer_id=instance.pk).values_list('id', flat=True))
+    invalidate_product_pages(product_ids, [instance.pk])
+
+
+@receiver(pre_save, sender=User)
+def remember_farm_location(sender, instance, raw=False, **kwargs):
+    """Keep the stored farm coordinates so post_save can tell whether the farm moved"""
+    instance._farm_location = None
+    if instance.pk and not raw and instance.is_farmer:
+        instance._farm_location = User.objects.filter(pk=instance.pk).values_list(
+            'farm_latitude', 'farm_longitude'
+        ).first()
+
+
+@receiver(post_save, sender=User)
+def reindex_geo_on_farm_move(sender, instance, raw=False, created=False, **kwargs):
+    """Products without their own coordinates follow the farm's"""
+    if raw or created or not instance.is_farmer:
+        return
+    location = tuple(None if value is None else Decimal(str(value))
+                     for value in (instance.farm_latitude, instance.farm_longitude))
+    if getattr(instance, '_farm_location', None) == location:
+        return
+    following = Product.objects.filter(Q(latitude__isnull=True) | Q(longitude__isnull=True), farmer_id=instance.pk)
+    product_ids = list(following.values_list('id', flat=True))
+    # Other workers' geo indexes pull changed rows by updated_at
+    following.update(updated_at=timezone.now())
+    transaction.on_commit(lambda: mark_products_moved(product_ids))
+
+
+@receiver(post_save, sender=Favorite)
+@receiver(post_delete, sender=Favorite)
+def invalidate_favorites_on_change(sender, instance, **kwargs):
+    user_id = instance.user_id
+    transaction.on_commit(lambda: invalidate_favorites(user_id))
+
+
+@receiver(post_save, sender=Favorite)
+def count_favorite(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        record_favorites([instance.product_id], instance.created_at)
+
+
+@receiver(post_delete, sender=Favorite)
+def uncount_favorite(sender, instance, **kwargs):
+    record_favorites([instance.product_id], instance.created_at, removed=True)
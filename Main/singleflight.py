@@ -0,0 +1,181 @@
+# singleflight.py
+"""
+Cache lookups that recompute each key once, however many requests miss it.
+
+Entries have a soft TTL: after `ttl` seconds they are stale but are still
+served for `stale_ttl` more seconds while a single caller recomputes them
+(stale-while-revalidate). Only cold misses wait, for the caller computing the
+value instead of running the same queries themselves.
+
+Deduplication works at two levels: callers in one process wait on an
+in-memory flight, and processes coordinate through a lock key added to the
+shared cache (Redis when REDIS_URL is set). Keys can belong to a group,
+which invalidate_group() marks stale in one step. The group's generation key
+expires with the longest-lived entry stored under it, so it cannot lapse
+and make old entries look current again.
+
+Payloads with absolute URLs are cached per origin. get_or_compute_for_request()
+only lets PUBLIC_BASE_URL, or hosts listed in ALLOWED_HOSTS, have entries, so
+clients cannot create keys by sending arbitrary Host headers.
+"""
+import threading
+import time
+import uuid
+from urllib.parse import urljoin
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http.request import split_domain_port, validate_host
+
+
+def _settings():
+    return (
+        getattr(settings, 'SINGLE_FLIGHT_STALE_SECONDS', 600),
+        getattr(settings, 'SINGLE_FLIGHT_LOCK_SECONDS', 30),
+        getattr(settings, 'SINGLE_FLIGHT_WAIT_SECONDS', 5),
+    )
+
+
+def _group_key(group):
+    return f'singleflight:group:{group}'
+
+
+# group -> longest lifetime (ttl + stale seconds) of the entries this process stored in it
+_group_lifetimes = {}
+
+
+def invalidate_group(group):
+    """Mark every entry cached under `group` stale"""
+    try:
+        cache.incr(_group_key(group))
+    except ValueError:
+        cache.set(_group_key(group), 1, _group_lifetimes.get(group, _settings()[0]))
+
+
+def _lookup(key, group):
+    """(cached entry or None, whether it is fresh, the group's generation)"""
+    if group is None:
+        entry, generation = cache.get(key), None
+    else:
+        values = cache.get_many([key, _group_key(group)])
+        entry, generation = values.get(key), values.get(_group_key(group), 0)
+    fresh = entry is not None and entry[1] > time.time() and entry[2] == generation
+    return entry, fresh, generation
+
+
+def _store(key, value, generation, ttl, group=None):
+    lifetime = ttl + _settings()[0]
+    cache.set(key, (value, time.time() + ttl, generation), lifetime)
+    if group is not None:
+        # Keep the generation at least as long as the entries it guards
+        lifetime = _group_lifetimes[group] = max(lifetime, _group_lifetimes.get(group, 0))
+        if not cache.touch(_group_key(group), lifetime):
+            cache.add(_group_key(group), generation, lifetime)
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def get_or_compute(key, compute, ttl, group=None):
+    """Cached value of `key`, calling `compute()` at most once at a time per key"""
+    entry, fresh, generation = _lookup(key, group)
+    if fresh:
+        return entry[0]
+
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _Flight()
+    if not leader:
+        if entry is not None:
+            return entry[0]
+        wait = _settings()[2]
+        if flight.done.wait(wait) and flight.error is None:
+            return flight.value
+        return compute()
+
+    try:
+        flight.value = _refresh(key, compute, entry, generation, ttl, group)
+        return flight.value
+    except Exception as e:
+        flight.error = e
+        raise
+    finally:
+        with _flights_lock:
+            _flights.pop(key, None)
+        flight.done.set()
+
+
+def _refresh(key, compute, entry, generation, ttl, group):
+    """Recompute under the cross-worker lock, or wait for the worker holding it"""
+    _, lock_seconds, wait = _settings()
+    lock_key, token = f'{key}:lock', uuid.uuid4().hex
+    if cache.add(lock_key, token, lock_seconds):
+        try:
+            value = compute()
+            _store(key, value, generation, ttl, group)
+            return value
+        finally:
+            # Not atomic, but only matters when compute() outlived the lock
+            if cache.get(lock_key) == token:
+                cache.delete(lock_key)
+
+    if entry is not None:
+        # Another worker is refreshing it
+        return entry[0]
+    deadline = time.monotonic() + wait
+    delay = 0.01
+    while time.monotonic() < deadline:
+        time.sleep(delay)
+        delay = min(delay * 2, 0.2)
+        entry = cache.get(key)
+        if entry is not None:
+            return entry[0]
+    return compute()
+
+
+class OriginRequest:
+    """A request whose absolute URLs point at `origin` instead of its own host"""
+
+    def __init__(self, request, origin):
+        self._request = request
+        self._origin = origin
+
+    def build_absolute_uri(self, location=None):
+        return urljoin(self._origin + '/', location if location is not None else self._request.get_full_path())
+
+    def __getattr__(self, name):
+        return getattr(self._request, name)
+
+
+def cache_origin(request):
+    """Origin cached payloads for this request are built for, None for unlisted hosts"""
+    base_url = getattr(settings, 'PUBLIC_BASE_URL', None)
+    if base_url:
+        return base_url.rstrip('/')
+    host = request.get_host()
+    domain, _port = split_domain_port(host)
+    if domain and validate_host(domain, [allowed for allowed in settings.ALLOWED_HOSTS if allowed != '*']):
+        return f'{request.scheme}://{host}'
+    return None
+
+
+def get_or_compute_for_request(request, key, compute, ttl, group=None):
+    """
+    get_or_compute() for payloads with absolute URLs. `compute(request)` gets
+    a request bound to the canonical origin; requests for other hosts are
+    computed without the cache.
+    """
+    origin = cache_origin(request)
+    if origin is None:
+        return compute(request)
+    return get_or_compute(f'{key}:{origin}', lambda: compute(OriginRequest(request, origin)), ttl, group)
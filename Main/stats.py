@@ -0,0 +1,98 @@
+# stats.py
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Count, DecimalField, F, Max, Min, Q, Sum, Value
+from django.db.models.functions import Coalesce, Greatest, Least
+
+from .models import Category, SubCategory, Product
+
+# Product fields that decide how a product contributes to the catalog stats
+STAT_FIELDS = ('category_id', 'subcategory_id', 'status', 'organic', 'price')
+
+# (stats model, product field holding its key)
+STAT_GROUPS = ((Category, 'category_id'), (SubCategory, 'subcategory_id'))
+
+
+def product_state(product):
+    """Snapshot of the fields in STAT_FIELDS for a product instance"""
+    return {field: getattr(product, field) for field in STAT_FIELDS}
+
+
+def _contributions(state):
+    """Map (stats model, pk) -> (organic, price) for a product state that counts"""
+    if not state or state['status'] != 'available':
+        return {}
+    price = Decimal(str(state['price']))
+    return {
+        (model, state[key]): (bool(state['organic']), price)
+        for model, key in STAT_GROUPS
+        if state[key] is not None
+    }
+
+
+def apply_product_change(old_state, new_state):
+    """
+    Move a product's contribution from old_state to new_state (either may be
+    None for creations and deletions). Counts and sums are applied as F()
+    deltas; min/max are widened in place on additions and recomputed from the
+    (category, status) index only when a product leaves a group.
+    """
+    old = _contributions(old_state)
+    new = _contributions(new_state)
+    price_field = DecimalField(max_digits=10, decimal_places=2)
+
+    with transaction.atomic():
+        for model, pk in set(old) | set(new):
+            before, after = old.get((model, pk)), new.get((model, pk))
+            if before == after:
+                continue
+
+            updates = {
+                'available_count': F('available_count') + (after is not None) - (before is not None),
+                'organic_count': (F('organic_count') + bool(after and after[0])
+                                  - bool(before and before[0])),
+                'price_sum': (F('price_sum') + (after[1] if after else 0)
+                              - (before[1] if before else 0)),
+            }
+            if before is not None:
+                key = dict(STAT_GROUPS)[model]
+                updates.update(Product.objects.filter(status='available', **{key: pk}).aggregate(
+                    min_price=Min('price'), max_price=Max('price')
+                ))
+            else:
+                price = Value(after[1], output_field=price_field)
+                updates['min_price'] = Least(Coalesce(F('min_price'), price), price)
+                updates['max_price'] = Greatest(Coalesce(F('max_price'), price), price)
+
+            model.objects.filter(pk=pk).update(**updates)
+
+
+def refresh_catalog_stats(only=None):
+    """
+    Recompute the stats of every category and subcategory from scratch, or
+    only of the groups in `only` ({stats model: pks}), e.g. after a bulk update
+    """
+    available = Product.objects.filter(status='available').order_by()
+    with transaction.atomic():
+        for model, key in STAT_GROUPS:
+            groups = model.objects.all()
+            products = available.exclude(**{key: None})
+            if only is not None:
+                pks = {pk for pk in only.get(model, ()) if pk is not None}
+                if not pks:
+                    continue
+                groups = groups.filter(pk__in=pks)
+                products = products.filter(**{f'{key}__in': pks})
+            rows = products.values(key).annotate(
+                available_count=Count('id'),
+                organic_count=Count('id', filter=Q(organic=True)),
+                price_sum=Sum('price'),
+                min_price=Min('price'),
+                max_price=Max('price'),
+            )
+            groups.update(
+                available_count=0, organic_count=0, price_sum=0, min_price=None, max_price=None
+            )
+            for row in rows:
+                model.objects.filter(pk=row.pop(key)).update(**row)
@@ -0,0 +1,122 @@
+# sweeper.py
+"""
+Retire expired products and archive long-discontinued ones.
+
+Both run in bounded batches, each in its own short transaction, so the
+product table is never locked for long. See `manage.py sweep_products`.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .changelog import record_changes
+from .db.retry import retry_on_lock
+from .facets import INDEX_COLUMNS, mark_products_changed
+from .geo import mark_products_moved
+from .models import ArchivedProduct, Category, Product, SubCategory
+from .pages import invalidate_product_lists, invalidate_product_pages
+from .realtime import publish_products
+from .semantic import mark_products_text_changed
+from .stats import refresh_catalog_stats
+
+# Statuses an expired product can still be listed or restocked under
+LIVE_STATUSES = ('available', 'out_of_stock')
+
+ARCHIVE_FIELDS = ('id', 'farmer_id', 'category_id', 'subcategory_id', 'name', 'description', 'price', 'unit',
+                  'quantity_available', 'harvest_date', 'expiry_date', 'organic', 'location',
+                  'created_at', 'updated_at')
+
+
+def products_updated_in_bulk(rows):
+    """
+    Bring everything derived from products up to date after QuerySet.update()
+    changed them, since it skips the model signals. `rows` are the changed
+    products' category_id, subcategory_id and farmer_id, keyed by id. Call it
+    inside the transaction making the change.
+    """
+    product_ids = list(rows)
+    record_changes(product_ids)
+    refresh_catalog_stats(only={
+        Category: {row['category_id'] for row in rows.values()},
+        SubCategory: {row['subcategory_id'] for row in rows.values()},
+    })
+
+    def reindex():
+        mark_products_changed(list(Product.objects.filter(pk__in=product_ids).values(*INDEX_COLUMNS)))
+        mark_products_moved(product_ids)
+        mark_products_text_changed(product_ids)
+
+    transaction.on_commit(reindex)
+    invalidate_product_pages(product_ids, {row['farmer_id'] for row in rows.values()})
+    invalidate_product_lists()
+    publish_products(product_ids)
+
+
+@retry_on_lock
+def _retire_batch(today, batch_size):
+    with transaction.atomic():
+        rows = {
+            row['id']: row
+            for row in Product.objects.filter(status__in=LIVE_STATUSES, expiry_date__lt=today).order_by().values(
+                'id', 'category_id', 'subcategory_id', 'farmer_id'
+            )[:batch_size]
+        }
+        if not rows:
+            return 0
+        Product.objects.filter(id__in=list(rows), status__in=LIVE_STATUSES).update(
+            status='discontinued', updated_at=timezone.now()
+        )
+        products_updated_in_bulk(rows)
+    return len(rows)
+
+
+def retire_expired_products(today=None, batch_size=None):
+    """Discontinue products whose expiry_date has passed; returns how many"""
+    today = today or timezone.localdate()
+    batch_size = batch_size or getattr(settings, 'PRODUCT_SWEEP_BATCH_SIZE', 500)
+    retired = 0
+    while True:
+        count = _retire_batch(today, batch_size)
+        retired += count
+        if count < batch_size:
+            return retired
+
+
+@retry_on_lock
+def _archive_batch(cutoff, batch_size):
+    with transaction.atomic():
+        products = list(
+            Product.objects.filter(status='discontinued', updated_at__lt=cutoff).order_by()
+            .prefetch_related('images')[:batch_size]
+        )
+        if not products:
+            return 0
+        ArchivedProduct.objects.bulk_create([
+            ArchivedProduct(
+                images=[image.image.name for image in product.images.all()],
+                **{field: getattr(product, field) for field in ARCHIVE_FIELDS}
+            )
+            for product in products
+        ], ignore_conflicts=True)
+        # A regular delete, so the delete signals clean up indexes, stats and caches
+        Product.objects.filter(id__in=[product.pk for product in products]).delete()
+    return len(products)
+
+
+def archive_discontinued_products(older_than_days=None, batch_size=None):
+    """
+    Move products left untouched as discontinued for more than
+    PRODUCT_ARCHIVE_AFTER_DAYS to ArchivedProduct; returns how many
+    """
+    if older_than_days is None:
+        older_than_days = getattr(settings, 'PRODUCT_ARCHIVE_AFTER_DAYS', 90)
+    batch_size = batch_size or getattr(settings, 'PRODUCT_ARCHIVE_BATCH_SIZE', 200)
+    cutoff = timezone.now() - timedelta(days=older_than_days)
+    archived = 0
+    while True:
+        count = _archive_batch(cutoff, batch_size)
+        archived += count
+        if count < batch_size:
+            return archived
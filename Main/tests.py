@@ -1,3 +1,1434 @@
-from django.test import TestCase
+import asyncio
+from datetime import date, datetime, time as time_of_day, timedelta, timezone as dt_timezone
+from decimal import Decimal
+import io
+import json
+import gzip
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from zoneinfo import ZoneInfo
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.http import HttpResponse, StreamingHttpResponse
+from django.db import OperationalError, connection, transaction
+from django.utils import timezone
+from django.test import Client, SimpleTestCase, TestCase, TransactionTestCase, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils.translation import gettext_lazy
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+from rest_framework.test import APIClient, APIRequestFactory, force_authenticate
+from rest_framework.views import APIView
+import zstandard
+
+from .changelog import compact_changes, head_token
+from .db.pool import ConnectionPool
+from .db.retry import retry_on_lock
+from .facets import facet_index
+from .geo import geo_index
+from .history import rollup_category_prices
+from .inventory import InsufficientStock, expire_reservations, reserve
+from .logs import JSONFormatter, QueueLogHandler, RequestContextFilter, SamplingFilter, sampled_var
+from .middleware import CompressionMiddleware, negotiate_encoding
+from .routers import ReplicaReadMixin, ReplicaRouter, pin_to_primary, reads_use_replicas, replica_reads
+from .realtime import broker, websocket_application
+from .recommendations import build_related_products, related_products
+from .semantic import HashingEmbedder, SYNONYMS, SemanticIndex, semantic_index
+from .models import (
+    User, Category, SubCategory, Product, ProductImage, Favorite, ProductChange, InventoryReservation,
+    ArchivedProduct, DailyPrice, PriceHistory
+)
+from .parsers import ORJSONParser
+from .popularity import favorite_weight, rebuild_popularity, record_favorites
+from .renderers import ORJSONRenderer
+from .stats import refresh_catalog_stats
+from .sweeper import archive_discontinued_products, retire_expired_products
+from .singleflight import get_or_compute, invalidate_group
+from .serializers import (
+    ProductListSerializer, FavoriteSerializer, ProductListRowSerializer, FavoriteRowSerializer,
+    ProductCreateUpdateSerializer
+)
+
+
+class CatalogTestCase(TestCase):
+    """Small catalog shared by the API tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.media_root = tempfile.mkdtemp()
+        cls.media_override = override_settings(MEDIA_ROOT=cls.media_root)
+        cls.media_override.enable()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.media_override.disable()
+        shutil.rmtree(cls.media_root, ignore_errors=True)
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.farmer = User.objects.create(
+            email='farmer@example.com', phone='+919800000001', user_type='farmer',
+            first_name='Ravi', last_name='Kumar'
+        )
+        cls.anonymous_farmer = User.objects.create(
+            email='nameless@example.com', phone='+919800000002', user_type='farmer'
+        )
+        cls.buyer = User.objects.create(
+            email='buyer@example.com', phone='+919800000003', user_type='horeca',
+            business_name='Spice Route'
+        )
+        cls.vegetables = Category.objects.create(name='Vegetables')
+        cls.fruits = Category.objects.create(name='Fruits')
+        cls.leafy = SubCategory.objects.create(category=cls.vegetables, name='Leafy Greens')
+
+        cls.spinach = Product.objects.create(
+            farmer=cls.farmer, category=cls.vegetables, subcategory=cls.leafy,
+            name='Spinach', description='Fresh spinach \u2028 bunches', price=Decimal('40.5'),
+            unit='bunch', quantity_available=Decimal('120'), location='Nashik', organic=True
+        )
+        cls.mango = Product.objects.create(
+            farmer=cls.anonymous_farmer, category=cls.fruits, name='Alphonso Mango',
+            description='Ratnagiri mangoes', price=Decimal('850.00'), unit='dozen',
+            quantity_available=Decimal('30.25'), location='Ratnagiri', is_featured=True
+        )
+        for is_primary in (False, True, True):
+            ProductImage.objects.create(
+                product=cls.spinach, is_primary=is_primary,
+                image=SimpleUploadedFile('spinach.png', b'\x89PNG', content_type='image/png')
+            )
+        Favorite.objects.create(user=cls.buyer, product=cls.spinach)
+        Favorite.objects.create(user=cls.buyer, product=cls.mango)
+
+    def setUp(self):
+        # Cached category and featured lists would outlive the test's rollback
+        cache.clear()
+        self.request = APIRequestFactory().get('/api/products/')
+        self.renderer = ORJSONRenderer()
+
+
+class ORJSONTests(SimpleTestCase):
+    """The orjson renderer and parser must behave exactly like DRF's JSON ones"""
+
+    def test_renderer_matches_json_renderer(self):
+        payloads = [
+            {'price': Decimal('40.50'), 'quantity': Decimal('1E+2')},
+            {'created_at': datetime(2026, 10, 19, 7, 30, 15, 123456, tzinfo=dt_timezone.utc)},
+            {'created_at': datetime(2026, 10, 19, 13, 0, 15, 999, tzinfo=dt_timezone(timedelta(hours=5, minutes=30)))},
+            {'created_at': datetime(2026, 10, 19, 7, 30), 'day': date(2026, 10, 19), 'at': time_of_day(7, 30, 0, 5)},
+            {'harvested_at': datetime(1870, 1, 1, 6, 0, tzinfo=ZoneInfo('Asia/Kolkata'))},
+            {'id': uuid.UUID('12345678-1234-5678-1234-567812345678')},
+            {'message': gettext_lazy('Product not found.'), 'note': 'line\u2028break'},
+            [1, 2.5, None, True, 'Nashik \u0928\u093e\u0936\u093f\u0915'],
+        ]
+        for payload in payloads:
+            with self.subTest(payload=payload):
+                self.assertEqual(ORJSONRenderer().render(payload), JSONRenderer().render(payload))
+
+    def test_parser_matches_json_parser(self):
+        body = '{"ids": [1, 2], "price": 40.5, "name": "Spinach \u2028", "nested": {"organic": true}}'.encode()
+        self.assertEqual(ORJSONParser().parse(io.BytesIO(body)), JSONParser().parse(io.BytesIO(body)))
+        with self.assertRaises(ParseError):
+            ORJSONParser().parse(io.BytesIO(b'{"ids": [1, 2'))
+
+
+class RowSerializerTests(CatalogTestCase):
+    """The values_list() serializers must render exactly like the model serializers"""
+
+    def test_product_rows_match_product_list_serializer(self):
+        queryset = Product.objects.all()
+        context = {'request': self.request}
+        expected = ProductListSerializer(queryset, many=True, context=context).data
+        rows = queryset.values_list(*ProductListRowSerializer.columns())
+        actual = ProductListRowSerializer(rows, context=context).data
+        self.assertEqual(self.renderer.render(actual), self.renderer.render(expected))
+
+    def test_favorite_rows_match_favorite_serializer(self):
+        queryset = Favorite.objects.filter(user=self.buyer)
+        context = {'request': self.request}
+        expected = FavoriteSerializer(queryset, many=True, context=context).data
+        rows = queryset.values_list(*FavoriteRowSerializer.columns())
+        actual = FavoriteRowSerializer(rows, context=context).data
+        self.assertEqual(self.renderer.render(actual), self.renderer.render(expected))
+
+    def test_primary_images_are_fetched_in_one_query(self):
+        rows = list(Product.objects.values_list(*ProductListRowSerializer.columns()))
+        with self.assertNumQueries(1):
+            ProductListRowSerializer(rows, context={'request': self.request}).data
+
+
+@override_settings(COMPRESSION_MIN_LENGTH=64, COMPRESSION_ENCODINGS=['zstd', 'gzip'])
+class CompressionMiddlewareTests(CatalogTestCase):
+    """Negotiated response compression and its interaction with conditional GET"""
+
+    def test_negotiation(self):
+        self.assertEqual(negotiate_encoding('gzip, zstd', ['zstd', 'gzip']), 'zstd')
+        self.assertEqual(negotiate_encoding('zstd;q=0.5, gzip', ['zstd', 'gzip']), 'gzip')
+        self.assertEqual(negotiate_encoding('*;q=0.1, gzip;q=0', ['zstd', 'gzip']), 'zstd')
+        self.assertIsNone(negotiate_encoding('identity', ['zstd', 'gzip']))
+        self.assertIsNone(negotiate_encoding('', ['zstd', 'gzip']))
+
+    def test_json_is_compressed_losslessly(self):
+        plain = self.client.get('/api/products/')
+        self.assertFalse(plain.has_header('Content-Encoding'))
+
+        response = self.client.get('/api/products/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(gzip.decompress(response.content), plain.content)
+
+        response = self.client.get('/api/products/', HTTP_ACCEPT_ENCODING='gzip, zstd')
+        self.assertEqual(response['Content-Encoding'], 'zstd')
+        self.assertEqual(zstandard.ZstdDecompressor().decompress(response.content), plain.content)
+
+    def test_small_bodies_are_not_compressed(self):
+        response = self.client.get('/api/search/suggestions/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+    def test_conditional_get(self):
+        response = self.client.get('/api/products/', HTTP_ACCEPT_ENCODING='zstd')
+        etag = response['ETag']
+        self.assertTrue(etag.startswith('W/'))
+
+        response = self.client.get('/api/products/', HTTP_ACCEPT_ENCODING='zstd', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+        response = self.client.get('/api/products/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_streaming_responses_are_compressed_incrementally(self):
+        chunks = [b'{"products":[', b'{"name":"spinach"},' * 50, b'{}]}']
+        middleware = CompressionMiddleware(
+            lambda request: StreamingHttpResponse(iter(chunks), content_type='application/json')
+        )
+        response = middleware(RequestFactory().get('/', HTTP_ACCEPT_ENCODING='gzip'))
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(b''.join(response.streaming_content)), b''.join(chunks))
+
+    def test_event_streams_are_not_compressed(self):
+        middleware = CompressionMiddleware(
+            lambda request: StreamingHttpResponse(iter([b'data: {}\n\n'] * 100), content_type='text/event-stream')
+        )
+        response = middleware(RequestFactory().get('/', HTTP_ACCEPT_ENCODING='gzip'))
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+    def test_cached_bytes_follow_the_varied_headers(self):
+        def respond(request):
+            response = HttpResponse(request.headers['Accept-Language'].encode() * 600, content_type='text/plain')
+            response['ETag'] = '"same"'
+            response['Vary'] = 'Accept-Language'
+            return response
+
+        middleware = CompressionMiddleware(respond)
+        for language in ('en', 'hi'):
+            request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING='gzip', HTTP_ACCEPT_LANGUAGE=language)
+            self.assertEqual(gzip.decompress(middleware(request).content), language.encode() * 600)
+
+
+class SparseFieldsTests(CatalogTestCase):
+    """?fields= trims both the SELECT and the response"""
+
+    def test_list_fields_limit_columns_and_output(self):
+        with self.assertNumQueries(3) as queries:
+            response = self.client.get('/api/products/', {'mode': 'grid'})
+        products = response.json()['results']['products']
+        self.assertEqual(list(products[1]), ['id', 'name', 'price', 'unit', 'primary_image'])
+        self.assertTrue(products[1]['primary_image'].startswith('http://testserver/media/'))
+        self.assertNotIn('description', queries.captured_queries[1]['sql'])
+
+    def test_list_expand_images(self):
+        response = self.client.get('/api/products/', {'fields': 'name', 'expand': 'images'})
+        products = response.json()['results']['products']
+        self.assertEqual(list(products[1]), ['name', 'images'])
+        self.assertEqual(len(products[1]['images']), 3)
+
+    def test_unknown_fields_are_rejected(self):
+        response = self.client.get('/api/products/', {'fields': 'name,password'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error'], 'INVALID_FIELDS')
+
+    def test_empty_field_list_means_all_fields(self):
+        full = self.client.get('/api/products/').json()['results']['products']
+        for value in (',', ' , '):
+            response = self.client.get('/api/products/', {'fields': value})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()['results']['products'], full)
+        self.assertEqual(ProductListRowSerializer.columns(fields=[]), ProductListRowSerializer.columns())
+
+    def test_field_spellings_share_one_plan(self):
+        self.client.get('/api/products/', {'fields': 'name,price'})
+        cached = ProductListRowSerializer.build_plan.cache_info().currsize
+        for value in ('price,name', 'name,name,price', ' price , name ,price'):
+            response = self.client.get('/api/products/', {'fields': value})
+            self.assertEqual(list(response.json()['results']['products'][0]), ['name', 'price'])
+        self.assertEqual(ProductListRowSerializer.build_plan.cache_info().currsize, cached)
+
+    def test_detail_fields(self):
+        url = f'/api/products/{self.spinach.pk}/'
+        full = self.client.get(url).json()['product']
+
+        with self.assertNumQueries(1) as queries:
+            response = self.client.get(url, {'fields': 'id,name,farmer_name,price'})
+        product = response.json()['product']
+        self.assertEqual(product, {key: full[key] for key in ('id', 'name', 'price', 'farmer_name')})
+        self.assertNotIn('description', queries.captured_queries[0]['sql'])
+
+        product = self.client.get(url, {'fields': 'name', 'expand': 'images'}).json()['product']
+        self.assertEqual(product['images'], full['images'])
+
+
+class CatalogStatsTests(CatalogTestCase):
+    """Category aggregates follow product changes without a full recount"""
+
+    STATS = ('available_count', 'organic_count', 'price_sum', 'min_price', 'max_price')
+
+    def assertStatsFresh(self):
+        incremental = {
+            model: list(model.objects.order_by('pk').values_list(*self.STATS))
+            for model in (Category, SubCategory)
+        }
+        refresh_catalog_stats()
+        for model, rows in incremental.items():
+            self.assertEqual(rows, list(model.objects.order_by('pk').values_list(*self.STATS)))
+
+    def test_stats_follow_product_changes(self):
+        self.vegetables.refresh_from_db()
+        self.assertEqual(self.vegetables.available_count, 1)
+        self.assertEqual(self.vegetables.avg_price, Decimal('40.50'))
+
+        okra = Product.objects.create(
+            farmer=self.farmer, category=self.vegetables, subcategory=self.leafy, name='Okra',
+            description='Tender okra', price=Decimal('25'), unit='kg',
+            quantity_available=Decimal('10'), location='Pune', organic=True
+        )
+        self.assertStatsFresh()
+
+        okra.price = Decimal('60')
+        okra.save()
+        self.assertStatsFresh()
+
+        self.spinach.status = 'out_of_stock'
+        self.spinach.save()
+        self.assertStatsFresh()
+
+        okra.category = self.fruits
+        okra.subcategory = None
+        okra.save()
+        self.assertStatsFresh()
+
+        okra.delete()
+        self.assertStatsFresh()
+        self.vegetables.refresh_from_db()
+        self.assertEqual(self.vegetables.available_count, 0)
+        self.assertIsNone(self.vegetables.min_price)
+
+    def test_category_endpoint_exposes_stats(self):
+        categories = {c['name']: c for c in self.client.get('/api/categories/').json()['categories']}
+        self.assertEqual(categories['Vegetables']['available_count'], 1)
+        self.assertEqual(categories['Vegetables']['organic_count'], 1)
+        self.assertEqual(categories['Fruits']['min_price'], '850.00')
+        self.assertEqual(categories['Fruits']['avg_price'], '850.00')
+
+
+class FacetTests(CatalogTestCase):
+    """Facet counts come from the in-memory index and follow product writes"""
+
+    def setUp(self):
+        super().setUp()
+        facet_index.built_at = None
+
+    def get_facets(self, **params):
+        response = self.client.get('/api/products/', {'facets': 'true', **params})
+        return response.json()['results']['facets']
+
+    def test_counts_ignore_own_filter(self):
+        facets = self.get_facets(category=self.vegetables.pk)
+        self.assertEqual(facets['category'], [
+            {'value': self.vegetables.pk, 'count': 1}, {'value': self.fruits.pk, 'count': 1}
+        ])
+        self.assertEqual(facets['organic'], [{'value': True, 'count': 1}])
+        self.assertEqual(facets['unit'], [{'value': 'bunch', 'count': 1}])
+        self.assertEqual(facets['price'], [{'min': '0', 'max': '50', 'count': 1}])
+
+    def test_search_and_location_filters(self):
+        facets = self.get_facets(search='mango')
+        self.assertEqual(facets['location'], [{'value': 'Ratnagiri', 'count': 1}])
+        self.assertEqual(facets['price'], [{'min': '500', 'max': '1000', 'count': 1}])
+
+        facets = self.get_facets(location='nash')
+        self.assertEqual(facets['unit'], [{'value': 'bunch', 'count': 1}])
+
+    def test_invalid_id_filters_are_rejected(self):
+        for param in ('category', 'subcategory', 'farmer'):
+            response = self.client.get('/api/products/', {'facets': 'true', param: 'abc'})
+            self.assertEqual((response.status_code, response.json()['error']), (400, 'INVALID_FILTER'))
+
+    def test_index_follows_writes(self):
+        self.get_facets()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.mango.status = 'out_of_stock'
+            self.mango.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.create(
+                farmer=self.farmer, category=self.vegetables, name='Okra', description='Okra',
+                price=Decimal('1200'), unit='kg', quantity_available=Decimal('5'), location='Pune'
+            )
+        # Count, page and primary images only: the index itself needs no query
+        with self.assertNumQueries(3):
+            facets = self.get_facets()
+        self.assertEqual(facets['category'], [{'value': self.vegetables.pk, 'count': 2}])
+        self.assertEqual(facets['price'], [
+            {'min': '0', 'max': '50', 'count': 1}, {'min': '1000', 'max': None, 'count': 1}
+        ])
+
+
+class NearbyProductTests(CatalogTestCase):
+    """?near= uses the grid index and orders products by distance"""
+
+    def setUp(self):
+        super().setUp()
+        geo_index.built_at = None
+        # Nashik farm; spinach inherits it, the mango has its own coordinates
+        User.objects.filter(pk=self.farmer.pk).update(farm_latitude='19.997500', farm_longitude='73.789800')
+        Product.objects.filter(pk=self.mango.pk).update(latitude='16.990200', longitude='73.312000')
+
+    def test_products_are_ordered_by_distance(self):
+        response = self.client.get('/api/products/', {'near': '19.0760,72.8777', 'radius_km': 400})
+        products = response.json()['results']['products']
+        self.assertEqual([p['name'] for p in products], ['Spinach', 'Alphonso Mango'])
+        self.assertAlmostEqual(products[0]['distance_km'], 142.0, delta=2)
+
+        response = self.client.get('/api/products/', {'near': '20.0,73.8', 'radius_km': 10})
+        self.assertEqual([p['name'] for p in response.json()['results']['products']], ['Spinach'])
+
+    def test_other_filters_still_apply(self):
+        response = self.client.get('/api/products/', {
+            'near': '19.0760,72.8777', 'radius_km': 400, 'organic': 'false', 'fields': 'name'
+        })
+        products = response.json()['results']['products']
+        self.assertEqual([list(p) for p in products], [['name', 'distance_km']])
+        self.assertEqual(products[0]['name'], 'Alphonso Mango')
+
+    def test_facets_count_products_in_range(self):
+        facet_index.built_at = None
+        response = self.client.get('/api/products/', {'near': '20.0,73.8', 'radius_km': 10, 'facets': 'true'})
+        facets = response.json()['results']['facets']
+        self.assertEqual(facets['category'], [{'value': self.vegetables.pk, 'count': 1}])
+        self.assertEqual(facets['location'], [{'value': 'Nashik', 'count': 1}])
+
+    def test_farm_moves_reach_other_workers(self):
+        Product.objects.update(updated_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual([pk for pk, _ in geo_index.nearby(20.0, 73.8, 10)], [self.spinach.pk])
+        # Saved by another worker: this one only sees the generation change
+        farmer = User.objects.get(pk=self.farmer.pk)
+        with self.captureOnCommitCallbacks(execute=False):
+            farmer.farm_latitude, farmer.farm_longitude = '18.520400', '73.856700'
+            farmer.save()
+        cache.set(geo_index.generation_key, geo_index.shared_generation() + 1, None)
+        self.assertEqual(geo_index.nearby(20.0, 73.8, 10), [])
+        self.assertEqual([pk for pk, _ in geo_index.nearby(18.52, 73.85, 10)], [self.spinach.pk])
+
+        # Profile edits that keep the farm where it is leave the products alone
+        updated_at = Product.objects.get(pk=self.spinach.pk).updated_at
+        farmer.first_name = 'Ramesh'
+        farmer.save()
+        self.assertEqual(Product.objects.get(pk=self.spinach.pk).updated_at, updated_at)
+
+    def test_invalid_location(self):
+        response = self.client.get('/api/products/', {'near': 'mumbai'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error'], 'INVALID_LOCATION')
+
+    def test_index_follows_writes(self):
+        self.assertEqual(len(geo_index.nearby(16.99, 73.31, 5)), 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.mango.latitude, self.mango.longitude = Decimal('28.6139'), Decimal('77.2090')
+            self.mango.save()
+        self.assertEqual(geo_index.nearby(16.99, 73.31, 5), [])
+        self.assertEqual([pk for pk, _ in geo_index.nearby(28.6, 77.2, 5)], [self.mango.pk])
+
+
+class FavoriteBatchTests(CatalogTestCase):
+    """Batch favorite updates and page-wide is_favorited lookups"""
+
+    def setUp(self):
+        super().setUp()
+        self.api = APIClient()
+        self.api.force_authenticate(self.buyer)
+
+    def test_batch_add_and_remove(self):
+        okra = Product.objects.create(
+            farmer=self.farmer, category=self.vegetables, name='Okra', description='Okra',
+            price=Decimal('30'), unit='kg', quantity_available=Decimal('5'), location='Pune'
+        )
+        response = self.api.post('/api/favorites/batch/', {
+            'add': [okra.pk, self.spinach.pk, 9999], 'remove': [self.mango.pk]
+        }, format='json')
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual(body['added'], [okra.pk])
+        self.assertEqual(body['removed'], [self.mango.pk])
+        self.assertEqual(body['not_found'], [9999])
+        self.assertEqual(
+            set(Favorite.objects.filter(user=self.buyer).values_list('product_id', flat=True)),
+            {okra.pk, self.spinach.pk}
+        )
+
+    def test_batch_rejects_bad_payload(self):
+        response = self.api.post('/api/favorites/batch/', {'add': 'all'}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_batch_rejects_booleans_and_list_bodies(self):
+        response = self.api.post('/api/favorites/batch/', {'add': [True]}, format='json')
+        self.assertEqual(response.status_code, 400)
+        response = self.api.post('/api/favorites/batch/', [self.mango.id], format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_list_marks_favorites_with_constant_queries(self):
+        Favorite.objects.filter(product=self.mango).delete()
+        with self.assertNumQueries(4):
+            response = self.api.get('/api/products/')
+        products = {p['name']: p for p in response.json()['results']['products']}
+        self.assertTrue(products['Spinach']['is_favorited'])
+        self.assertFalse(products['Alphonso Mango']['is_favorited'])
+
+    @override_settings(FAVORITES_CACHE_TIMEOUT=0)
+    def test_uncached_lookups_only_read_the_shown_products(self):
+        with CaptureQueriesContext(connection) as queries:
+            detail = self.api.get(f'/api/products/{self.spinach.pk}/').json()
+            page = self.api.get(f'/api/products/{self.mango.pk}/page/').json()
+        self.assertTrue(detail['product']['is_favorited'])
+        self.assertTrue(page['product']['is_favorited'])
+        favorite_queries = [q['sql'] for q in queries if 'FROM "Main_favorite"' in q['sql']]
+        self.assertEqual(len(favorite_queries), 2)
+        for sql in favorite_queries:
+            self.assertIn('"product_id" IN', sql)
+
+
+class PopularityTests(CatalogTestCase):
+    """Favorite counts and decayed scores are kept on the product row"""
+
+    def test_counters_follow_favorites(self):
+        self.spinach.refresh_from_db()
+        self.assertEqual(self.spinach.favorite_count, 1)
+        other = User.objects.create(email='chef@example.com', phone='+919800000004', user_type='horeca')
+        favorite = Favorite.objects.create(user=other, product=self.spinach)
+        self.spinach.refresh_from_db()
+        self.assertEqual(self.spinach.favorite_count, 2)
+
+        favorite.delete()
+        Favorite.objects.filter(product=self.mango).delete()
+        self.mango.refresh_from_db()
+        self.assertEqual(self.mango.favorite_count, 0)
+        self.assertAlmostEqual(self.mango.popularity_score, 0)
+
+    @override_settings(POPULARITY_HALF_LIFE_DAYS=1)
+    def test_scores_stay_finite_and_exact_far_from_the_epoch(self):
+        rebuild_popularity()
+        self.spinach.refresh_from_db()
+        base = self.spinach.popularity_score
+        far = timezone.now() + timedelta(days=30000)
+        record_favorites([self.spinach.pk], far)
+        self.spinach.refresh_from_db()
+        self.assertAlmostEqual(self.spinach.popularity_score, favorite_weight(far))
+
+        # Taking out the favorite that makes up nearly all of the score recounts it
+        record_favorites([self.spinach.pk], far, removed=True)
+        self.spinach.refresh_from_db()
+        self.assertEqual(self.spinach.favorite_count, 1)
+        self.assertAlmostEqual(self.spinach.popularity_score, base)
+
+    def test_sort_popular(self):
+        api = APIClient()
+        api.force_authenticate(self.buyer)
+        api.post('/api/favorites/batch/', {'remove': [self.mango.pk]}, format='json')
+        response = self.client.get('/api/products/', {'sort': 'popular', 'fields': 'name'})
+        self.assertEqual(
+            [p['name'] for p in response.json()['results']['products']], ['Spinach', 'Alphonso Mango']
+        )
+
+
+class RelatedProductsTests(CatalogTestCase):
+    """Co-occurrence recommendations built into memory-mapped arrays"""
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        override = override_settings(RECOMMENDATIONS_DIR=self.directory)
+        override.enable()
+        self.addCleanup(override.disable)
+        related_products.arrays = None
+
+    def related(self, product):
+        related_products.arrays = None
+        return related_products.lookup(product.pk)
+
+    def test_incremental_build_matches_full_build(self):
+        okra = Product.objects.create(
+            farmer=self.farmer, category=self.vegetables, name='Okra', description='Okra',
+            price=Decimal('30'), unit='kg', quantity_available=Decimal('5'), location='Pune'
+        )
+        self.assertEqual(build_related_products(), 1)
+        self.assertEqual([pk for pk, _ in self.related(self.spinach)], [self.mango.pk])
+        self.assertEqual(self.related(okra), [])
+
+        chef = User.objects.create(email='chef@example.com', phone='+919800000004', user_type='horeca')
+        Favorite.objects.create(user=chef, product=self.spinach)
+        Favorite.objects.create(user=chef, product=okra)
+        Favorite.objects.filter(user=self.buyer, product=self.mango).delete()
+        self.assertEqual(build_related_products(), 2)
+        incremental = self.related(self.spinach)
+        self.assertEqual([pk for pk, _ in incremental], [okra.pk])
+        self.assertEqual(self.related(self.mango), [])
+
+        build_related_products(full=True)
+        self.assertEqual(self.related(self.spinach), incremental)
+
+    def test_previous_build_survives_a_rebuild(self):
+        build_related_products()
+        with open(os.path.join(self.directory, 'CURRENT')) as current:
+            first = current.read()
+        build_related_products(full=True)
+        build_related_products(full=True)
+        builds = sorted(entry for entry in os.listdir(self.directory) if entry.startswith('build-'))
+        self.assertEqual(len(builds), 2)
+        self.assertNotIn(first, builds)
+
+    def test_endpoint_returns_scored_products(self):
+        build_related_products()
+        response = self.client.get(f'/api/products/{self.spinach.pk}/related/', {'fields': 'id,name'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['products'], [
+            {'id': self.mango.pk, 'name': 'Alphonso Mango', 'score': 1.0}
+        ])
+
+
+class SemanticSearchTests(CatalogTestCase):
+    """?semantic=true merges nearest-neighbour matches into the keyword search"""
+
+    def setUp(self):
+        super().setUp()
+        self.directory = directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        override = override_settings(SEMANTIC_INDEX_DIR=directory)
+        override.enable()
+        self.addCleanup(override.disable)
+        semantic_index.vectors = None
+        self.addCleanup(setattr, semantic_index, 'vectors', None)
+        self.brinjal = Product.objects.create(
+            farmer=self.farmer, category=self.vegetables, name='Brinjal',
+            description='Purple brinjal from the Deccan', price=Decimal('35'), unit='kg',
+            quantity_available=Decimal('50'), location='Pune'
+        )
+        semantic_index.rebuild()
+
+    def names(self, params):
+        response = self.client.get('/api/products/', dict(params, fields='name'))
+        self.assertEqual(response.status_code, 200)
+        return [p['name'] for p in response.json()['results']['products']]
+
+    def test_hashing_embedder_folds_synonyms(self):
+        embedder = HashingEmbedder(256, SYNONYMS)
+        eggplant, brinjal, mango = embedder.embed(['eggplant', 'brinjal', 'mango'])
+        self.assertAlmostEqual(float(eggplant @ brinjal), 1.0, places=5)
+        self.assertLess(float(eggplant @ mango), 0.5)
+
+    def test_semantic_search_finds_synonyms(self):
+        self.assertEqual(self.names({'search': 'eggplant'}), [])
+        self.assertEqual(self.names({'search': 'eggplant', 'semantic': 'true'}), ['Brinjal'])
+
+    def test_workers_pick_up_builds_from_other_processes(self):
+        self.assertTrue(semantic_index.ensure_fresh())
+        first = semantic_index.build
+        # Another process, whose generation bump a per-process cache never shows us
+        builder = SemanticIndex()
+        builder.bump_generation = lambda: None
+        builder.rebuild()
+        semantic_index.ensure_fresh()
+        self.assertEqual(semantic_index.build, first)
+        with self.settings(SEMANTIC_INDEX_MAX_AGE=0):
+            semantic_index.ensure_fresh()
+        self.assertEqual(semantic_index.build, builder.build)
+
+    def test_requests_never_build_the_index(self):
+        shutil.rmtree(self.directory)
+        os.makedirs(self.directory)
+        semantic_index.vectors = None
+        semantic_index.missing_warned = False
+        with self.assertLogs('Main.semantic', 'WARNING'):
+            self.assertEqual(self.names({'search': 'eggplant', 'semantic': 'true'}), [])
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_index_follows_writes_and_reloads_from_disk(self):
+        self.assertEqual(self.names({'search': 'cilantro', 'semantic': 'true'}), [])
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.create(
+                farmer=self.farmer, category=self.vegetables, name='Coriander',
+                description='Fresh dhania bunches', price=Decimal('10'), unit='bunch',
+                quantity_available=Decimal('40'), location='Nashik'
+            )
+            self.brinjal.status = 'out_of_stock'
+            self.brinjal.save()
+        self.assertEqual(self.names({'search': 'cilantro', 'semantic': 'true'}), ['Coriander'])
+        self.assertEqual(self.names({'search': 'aubergine', 'semantic': 'true'}), [])
+
+        # A fresh worker loads the persisted build and catches up on later writes
+        worker = SemanticIndex()
+        self.assertTrue(worker.load())
+        worker.sync()
+        self.assertEqual([pk for pk, _ in worker.search('aubergine')], [])
+
+
+class ReplicaRoutingTests(CatalogTestCase):
+    """Catalog reads use replicas unless the user just wrote something"""
+
+    class ProbeView(ReplicaReadMixin, APIView):
+        def get(self, request):
+            return Response({'replica': reads_use_replicas()})
+
+    def setUp(self):
+        super().setUp()
+        override = override_settings(DATABASE_REPLICAS=['replica1'])
+        override.enable()
+        self.addCleanup(override.disable)
+        self.addCleanup(cache.clear)
+
+    def probe(self, user):
+        request = APIRequestFactory().get('/probe/')
+        force_authenticate(request, user)
+        return self.ProbeView.as_view()(request).data['replica']
+
+    def test_router_only_reads_from_replica_inside_replica_reads(self):
+        router = ReplicaRouter()
+        self.assertEqual(router.db_for_read(Product), 'default')
+        with replica_reads():
+            self.assertEqual(router.db_for_read(Product), 'replica1')
+            self.assertEqual(router.db_for_write(Product), 'default')
+            self.assertEqual(router.db_for_read(Product, instance=self.spinach), 'default')
+        self.assertFalse(reads_use_replicas())
+
+    def test_recent_writers_are_pinned_to_primary(self):
+        self.assertTrue(self.probe(self.farmer))
+        pin_to_primary(self.farmer.pk)
+        self.assertFalse(self.probe(self.farmer))
+        self.assertTrue(self.probe(self.buyer))
+        self.assertFalse(reads_use_replicas())
+
+    def test_successful_write_pins_user(self):
+        api = APIClient()
+        api.force_authenticate(self.buyer)
+        self.assertTrue(self.probe(self.buyer))
+        api.post(f'/api/favorites/toggle/{self.spinach.pk}/')
+        self.assertFalse(self.probe(self.buyer))
+
+
+class ConnectionPoolTests(SimpleTestCase):
+    """Pool sizing, overflow, timeouts and pre-ping"""
+
+    def make_pool(self, **options):
+        self.opened = []
+
+        def connect():
+            connection = sqlite3.connect(':memory:', check_same_thread=False)
+            self.opened.append(connection)
+            return connection
+
+        return ConnectionPool(connect, ping=lambda c: c.execute('SELECT 1'), **options)
+
+    def test_reuses_idle_connections_and_closes_overflow(self):
+        pool = self.make_pool(size=1, max_overflow=1)
+        first, second = pool.acquire(), pool.acquire()
+        pool.release(first)
+        pool.release(second)
+        self.assertEqual(pool.stats()['idle'], 1)
+        self.assertIs(pool.acquire(), first)
+        self.assertEqual(len(self.opened), 2)
+        with self.assertRaises(sqlite3.ProgrammingError):
+            second.execute('SELECT 1')
+
+    def test_exhausted_pool_times_out_and_records_waits(self):
+        pool = self.make_pool(size=1, max_overflow=0, timeout=0.05)
+        connection = pool.acquire()
+        with self.assertRaises(OperationalError):
+            pool.acquire()
+        pool.release(connection)
+        stats = pool.stats()
+        self.assertEqual((stats['timeouts'], stats['in_use'], stats['checkouts']), (1, 0, 1))
+
+    def test_pre_ping_replaces_broken_connections(self):
+        pool = self.make_pool(size=1, max_overflow=0, pre_ping=0)
+        connection = pool.acquire()
+        pool.release(connection)
+        connection.close()
+        self.assertIsNot(pool.acquire(), connection)
+        self.assertEqual(len(self.opened), 2)
+
+
+class SQLiteTuningTests(TestCase):
+    """Pragmas on connect and retries on lock contention"""
+
+    def test_connection_pragmas(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], 20000)
+
+
+
+class LockRetryTests(TransactionTestCase):
+    """Write transactions are retried only when they are the outermost block"""
+
+    @override_settings(DB_LOCK_RETRY_DELAY=0)
+    def test_retries_lock_errors_outside_transactions(self):
+        attempts = []
+
+        @retry_on_lock
+        def write():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise OperationalError('database is locked')
+            return 'done'
+
+        with self.assertLogs('Main.db.retry', 'WARNING'):
+            self.assertEqual(write(), 'done')
+        self.assertEqual(len(attempts), 3)
+
+        attempts.clear()
+        with self.assertRaises(OperationalError), transaction.atomic():
+            write()
+        self.assertEqual(len(attempts), 1)
+
+
+class MiddlewareStackTests(CatalogTestCase):
+    """The API skips the session stack; the admin keeps it, CSRF included"""
+
+    def test_api_requests_skip_sessions(self):
+        response = self.client.get('/api/products/')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(hasattr(response.wsgi_request, 'session'))
+        self.assertNotIn('Cookie', response.get('Vary', ''))
+
+    def test_admin_keeps_sessions_and_csrf(self):
+        response = self.client.get('/admin/login/')
+        self.assertTrue(hasattr(response.wsgi_request, 'session'))
+        self.assertIn('csrftoken', response.cookies)
+
+        strict = Client(enforce_csrf_checks=True)
+        response = strict.post('/admin/login/', {'username': 'x', 'password': 'y'})
+        self.assertEqual(response.status_code, 403)
+
+
+@override_settings(PRODUCT_CHANGES_SETTLE_SECONDS=0)
+class ProductChangesTests(CatalogTestCase):
+    """Delta sync hands out updates and tombstones after a token"""
+
+    def test_without_token_returns_head(self):
+        response = self.client.get('/api/products/changes/')
+        self.assertEqual(response.json()['next_token'], str(head_token()))
+        self.assertEqual(response.json()['products'], [])
+
+    def test_updates_and_tombstones(self):
+        token = head_token()
+        mango_id = self.mango.pk
+        self.spinach.price = Decimal('45')
+        self.spinach.save()
+        self.mango.delete()
+        ProductImage.objects.filter(product=self.spinach).first().delete()
+
+        body = self.client.get('/api/products/changes/', {'since': token}).json()
+        self.assertEqual([product['id'] for product in body['products']], [self.spinach.pk])
+        self.assertEqual(body['deleted'], [mango_id])
+        self.assertFalse(body['has_more'])
+
+        body = self.client.get('/api/products/changes/', {'since': body['next_token']}).json()
+        self.assertEqual((body['products'], body['deleted']), ([], []))
+
+    def test_unavailable_products_are_reported_deleted(self):
+        token = head_token()
+        Product.objects.filter(pk=self.spinach.pk).update(status='out_of_stock')
+        self.spinach.refresh_from_db()
+        self.spinach.save()
+        body = self.client.get('/api/products/changes/', {'since': token}).json()
+        self.assertEqual(body['deleted'], [self.spinach.pk])
+
+    @override_settings(PRODUCT_CHANGES_PAGE_SIZE=1)
+    def test_pages_until_caught_up(self):
+        token = head_token()
+        self.spinach.save()
+        self.mango.save()
+        body = self.client.get('/api/products/changes/', {'since': token}).json()
+        self.assertTrue(body['has_more'])
+        body = self.client.get('/api/products/changes/', {'since': body['next_token']}).json()
+        self.assertFalse(body['has_more'])
+        self.assertEqual([product['id'] for product in body['products']], [self.mango.pk])
+
+    def test_compaction_keeps_latest_entry_per_product(self):
+        token = head_token()
+        for _ in range(3):
+            self.spinach.save()
+        compact_changes()
+        self.assertEqual(ProductChange.objects.filter(product_id=self.spinach.pk).count(), 1)
+        body = self.client.get('/api/products/changes/', {'since': token}).json()
+        self.assertEqual([product['id'] for product in body['products']], [self.spinach.pk])
+
+    def test_head_skips_entries_still_settling(self):
+        ProductChange.objects.update(created_at=timezone.now() - timedelta(minutes=5))
+        settled = head_token()
+        with override_settings(PRODUCT_CHANGES_SETTLE_SECONDS=60):
+            self.spinach.save()
+            self.assertEqual(head_token(), settled)
+            body = self.client.get('/api/products/changes/').json()
+            self.assertEqual(body['next_token'], str(settled))
+        body = self.client.get('/api/products/changes/', {'since': settled}).json()
+        self.assertEqual([product['id'] for product in body['products']], [self.spinach.pk])
+
+    @override_settings(PRODUCT_CHANGES_TOMBSTONE_DAYS=0)
+    def test_expired_token_must_resync(self):
+        token = head_token()
+        self.mango.delete()
+        compact_changes()
+        response = self.client.get('/api/products/changes/', {'since': token})
+        self.assertEqual(response.status_code, 410)
+        self.assertEqual(response.json()['error'], 'RESYNC_REQUIRED')
+        self.assertEqual(self.client.get('/api/products/changes/', {'since': 'abc'}).status_code, 400)
+
+
+@override_settings(REALTIME_COALESCE_SECONDS=0, REALTIME_REDIS_URL=None)
+class RealtimeTests(CatalogTestCase):
+    """Product changes are pushed to SSE and WebSocket subscribers"""
+
+    def change_spinach(self, *prices):
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                for price in prices:
+                    self.spinach.price = Decimal(price)
+                    self.spinach.save()
+
+    async def test_changes_are_coalesced_per_product(self):
+        subscription = broker.subscribe({f'category:{self.vegetables.pk}'})
+        try:
+            await sync_to_async(self.change_spinach)('41', '42', '43')
+            events = await subscription.next_batch(timeout=1)
+            self.assertEqual([(event['id'], event['price']) for event in events], [(self.spinach.pk, '43')])
+            self.assertEqual(await subscription.next_batch(timeout=0.01), [])
+        finally:
+            broker.unsubscribe(subscription)
+        self.assertEqual(broker.subscriber_count(), 0)
+
+    async def test_server_sent_events(self):
+        response = await self.async_client.get('/api/events/', {'topics': f'product:{self.mango.pk}'})
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        stream = response.streaming_content
+        self.assertEqual(await anext(stream), b'retry: 5000\n\n')
+
+        deleted = {'type': 'product.deleted', 'id': self.mango.pk, 'category_id': self.fruits.pk, 'farmer_id': 0}
+        broker.publish([deleted])
+        chunk = (await anext(stream)).decode()
+        self.assertTrue(chunk.startswith('event: product.deleted\n'))
+        self.assertEqual(json.loads(chunk.split('data: ')[1]), deleted)
+        await stream.aclose()
+
+    def test_server_sent_events_need_asgi(self):
+        with self.assertLogs('django.request', 'ERROR'):
+            self.assertEqual(self.client.get('/api/events/', {'topics': 'product:1'}).status_code, 501)
+
+    async def test_server_sent_events_validate_topics(self):
+        response = await self.async_client.get('/api/events/', {'topics': 'user:1'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error'], 'INVALID_TOPICS')
+
+    async def test_websocket_subscribe(self):
+        incoming, outgoing = asyncio.Queue(), asyncio.Queue()
+        scope = {'type': 'websocket', 'path': '/ws/events/', 'query_string': b''}
+        task = asyncio.ensure_future(websocket_application(scope, incoming.get, outgoing.put))
+        await incoming.put({'type': 'websocket.connect'})
+        self.assertEqual((await outgoing.get())['type'], 'websocket.accept')
+
+        await incoming.put({'type': 'websocket.receive', 'text': json.dumps({'subscribe': ['farmer:x']})})
+        self.assertEqual(json.loads((await outgoing.get())['text'])['error'], 'INVALID_TOPICS')
+        topic = f'farmer:{self.farmer.pk}'
+        await incoming.put({'type': 'websocket.receive', 'text': json.dumps({'subscribe': [topic]})})
+        while broker.subscriber_count() == 0 or topic not in broker.topics:
+            await asyncio.sleep(0)
+
+        await sync_to_async(self.change_spinach)('39')
+        event = json.loads((await asyncio.wait_for(outgoing.get(), 1))['text'])
+        self.assertEqual((event['type'], event['id'], event['price']), ('product.updated', self.spinach.pk, '39'))
+
+        await incoming.put({'type': 'websocket.disconnect'})
+        await asyncio.wait_for(task, 1)
+        self.assertEqual(broker.subscriber_count(), 0)
+
+
+class InventoryReservationTests(CatalogTestCase):
+    """Stock is taken atomically, held until expiry and given back"""
+
+    def setUp(self):
+        super().setUp()
+        self.api = APIClient()
+        self.api.force_authenticate(self.buyer)
+
+    def test_product_edit_keeps_stock_reserved_meanwhile(self):
+        stale = Product.objects.get(pk=self.spinach.pk)
+        reserve(self.spinach.pk, self.buyer, Decimal('20'))
+        serializer = ProductCreateUpdateSerializer(stale, data={'name': 'Baby spinach'}, partial=True)
+        self.assertTrue(serializer.is_valid())
+        serializer.save()
+        self.spinach.refresh_from_db()
+        self.assertEqual((self.spinach.name, self.spinach.quantity_available), ('Baby spinach', Decimal('100')))
+
+        farmer = APIClient()
+        farmer.force_authenticate(self.farmer)
+        response = farmer.patch(f'/api/products/{self.spinach.pk}/update/', {'price': '42'}, format='json')
+        self.assertEqual(response.json()['product']['quantity_available'], '100.00')
+
+    def test_farmer_restock_reopens_sold_out_product(self):
+        reserve(self.mango.pk, self.buyer, Decimal('30.25'))
+        farmer = APIClient()
+        farmer.force_authenticate(self.anonymous_farmer)
+        response = farmer.patch(f'/api/products/{self.mango.pk}/update/', {'quantity_available': '50'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.mango.refresh_from_db()
+        self.assertEqual((self.mango.quantity_available, self.mango.status), (Decimal('50'), 'available'))
+        self.assertIn(self.mango.pk, [p['id'] for p in self.client.get('/api/products/').json()['results']['products']])
+
+    def test_reserving_all_stock_marks_product_out_of_stock(self):
+        reserve(self.mango.pk, self.buyer, Decimal('30'))
+        self.mango.refresh_from_db()
+        self.assertEqual((self.mango.quantity_available, self.mango.status), (Decimal('0.25'), 'available'))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            reserve(self.mango.pk, self.buyer, Decimal('0.25'))
+        self.mango.refresh_from_db()
+        self.assertEqual((self.mango.quantity_available, self.mango.status), (Decimal('0'), 'out_of_stock'))
+        self.fruits.refresh_from_db()
+        self.assertEqual(self.fruits.available_count, 0)
+        with self.assertRaises(InsufficientStock):
+            reserve(self.mango.pk, self.buyer, Decimal('0.01'))
+
+    def test_release_returns_stock_and_reopens_product(self):
+        response = self.api.post(f'/api/products/{self.mango.pk}/reserve/', {'quantity': '30.25'}, format='json')
+        self.assertEqual(response.status_code, 201)
+        reservation_id = response.json()['reservation']['id']
+        response = self.api.post(f'/api/products/{self.mango.pk}/reserve/', {'quantity': '1'}, format='json')
+        self.assertEqual((response.status_code, response.json()['error']), (409, 'INSUFFICIENT_STOCK'))
+
+        self.assertEqual(self.api.delete(f'/api/reservations/{reservation_id}/').status_code, 200)
+        self.mango.refresh_from_db()
+        self.assertEqual((self.mango.quantity_available, self.mango.status), (Decimal('30.25'), 'available'))
+        self.assertEqual(self.api.delete(f'/api/reservations/{reservation_id}/').status_code, 404)
+
+    def test_expired_reservations_are_restocked(self):
+        reserve(self.spinach.pk, self.buyer, Decimal('20'), ttl=-1)
+        kept = reserve(self.spinach.pk, self.buyer, Decimal('5'))
+        self.assertEqual(expire_reservations(), 1)
+        self.spinach.refresh_from_db()
+        self.assertEqual(self.spinach.quantity_available, Decimal('115'))
+        self.assertEqual(list(InventoryReservation.objects.values_list('id', flat=True)), [kept.pk])
+
+    def test_confirm_keeps_stock_taken(self):
+        reservation = reserve(self.spinach.pk, self.buyer, Decimal('20'))
+        response = self.api.post(f'/api/reservations/{reservation.pk}/confirm/')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(InventoryReservation.objects.exists())
+        self.spinach.refresh_from_db()
+        self.assertEqual(self.spinach.quantity_available, Decimal('100'))
+
+    def test_minimum_order_quantity(self):
+        Product.objects.filter(pk=self.spinach.pk).update(min_order_quantity=Decimal('10'))
+        response = self.api.post(f'/api/products/{self.spinach.pk}/reserve/', {'quantity': '5'}, format='json')
+        self.assertEqual((response.status_code, response.json()['error']), (400, 'BELOW_MIN_ORDER'))
+
+
+class ProductSweepTests(CatalogTestCase):
+    """Expired products are discontinued, old discontinued ones archived"""
+
+    def test_expired_products_are_discontinued(self):
+        today = timezone.localdate()
+        Product.objects.filter(pk=self.spinach.pk).update(expiry_date=today - timedelta(days=1))
+        Product.objects.filter(pk=self.mango.pk).update(expiry_date=today)
+        token = ProductChange.objects.order_by('-id').values_list('id', flat=True).first()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(retire_expired_products(batch_size=1), 1)
+        self.assertEqual(
+            dict(Product.objects.values_list('id', 'status')),
+            {self.spinach.pk: 'discontinued', self.mango.pk: 'available'}
+        )
+        self.vegetables.refresh_from_db()
+        self.assertEqual(self.vegetables.available_count, 0)
+        self.assertEqual(
+            list(ProductChange.objects.filter(id__gt=token).values_list('product_id', flat=True)), [self.spinach.pk]
+        )
+        self.assertEqual(retire_expired_products(), 0)
+
+    def test_long_discontinued_products_are_archived(self):
+        spinach_id = self.spinach.pk
+        Product.objects.filter(pk=spinach_id).update(
+            status='discontinued', updated_at=timezone.now() - timedelta(days=91)
+        )
+        Product.objects.filter(pk=self.mango.pk).update(status='discontinued')
+
+        self.assertEqual(archive_discontinued_products(), 1)
+        self.assertFalse(Product.objects.filter(pk=spinach_id).exists())
+        archived = ArchivedProduct.objects.get()
+        self.assertEqual((archived.id, archived.name, len(archived.images)), (spinach_id, 'Spinach', 3))
+        self.assertTrue(ProductChange.objects.filter(product_id=spinach_id, action='delete').exists())
+
+
+class UnitPriceTests(CatalogTestCase):
+    """price_per_base_unit makes prices comparable across units"""
+
+    def test_maintained_on_save_and_bulk_writes(self):
+        self.assertEqual(self.mango.price_per_base_unit, Decimal('70.8333'))
+        self.spinach.unit = 'g'
+        self.spinach.save(update_fields=['unit'])
+        self.spinach.refresh_from_db()
+        self.assertEqual(self.spinach.price_per_base_unit, Decimal('40500'))
+
+        Product.objects.filter(pk=self.spinach.pk).update(price=Decimal('2'))
+        Product.objects.filter(pk=self.mango.pk).update(unit='piece')
+        self.assertEqual(
+            dict(Product.objects.values_list('id', 'price_per_base_unit')),
+            {self.spinach.pk: Decimal('2000'), self.mango.pk: Decimal('850')}
+        )
+        self.mango.price = Decimal('24')
+        Product.objects.bulk_update([self.mango], ['price'])
+        self.mango.refresh_from_db()
+        self.assertEqual(self.mango.price_per_base_unit, Decimal('2'))
+
+    def test_sort_and_filter_by_unit_price(self):
+        response = self.client.get('/api/products/', {'sort': '-unit_price'})
+        products = response.json()['results']['products']
+        self.assertEqual([product['id'] for product in products], [self.mango.pk, self.spinach.pk])
+        self.assertEqual((products[0]['price_per_base_unit'], products[0]['base_unit']), ('70.8333', 'piece'))
+
+        response = self.client.get('/api/products/', {'max_unit_price': '50'})
+        self.assertEqual([product['id'] for product in response.json()['results']['products']], [self.spinach.pk])
+        response = self.client.get('/api/products/', {'base_unit': 'kg'})
+        self.assertEqual(response.json()['results']['products'], [])
+        response = self.client.get('/api/products/', {'min_unit_price': 'cheap'})
+        self.assertEqual((response.status_code, response.json()['error']), (400, 'INVALID_PRICE'))
+        response = self.client.get('/api/products/', {'base_unit': 'litre'})
+        self.assertEqual((response.status_code, response.json()['error']), (400, 'INVALID_UNIT'))
+
+    def test_unit_price_sort_groups_base_units(self):
+        rice = Product.objects.create(
+            farmer=self.farmer, category=self.vegetables, name='Rice', description='Basmati',
+            price=Decimal('60'), unit='kg', quantity_available=Decimal('500'), location='Karnal'
+        )
+        response = self.client.get('/api/products/', {'sort': 'unit_price'})
+        self.assertEqual([product['id'] for product in response.json()['results']['products']],
+                         [rice.pk, self.spinach.pk, self.mango.pk])
+
+    def test_facets_follow_the_unit_price_filters(self):
+        Product.objects.create(
+            farmer=self.farmer, category=self.vegetables, name='Rice', description='Basmati',
+            price=Decimal('60'), unit='kg', quantity_available=Decimal('500'), location='Karnal'
+        )
+        facet_index.rebuild()
+        facets = self.client.get('/api/products/', {'facets': 'true', 'base_unit': 'piece',
+                                                    'max_unit_price': '50'}).json()['results']['facets']
+        self.assertEqual(facets['unit'], [{'value': 'bunch', 'count': 1}])
+
+
+class PriceHistoryTests(CatalogTestCase):
+    """Price changes are logged and rolled up per day for trend charts"""
+
+    def setUp(self):
+        super().setUp()
+        self.api = APIClient()
+        self.api.force_authenticate(self.farmer)
+
+    def test_changes_fold_into_the_daily_rollup(self):
+        for price in ('44', '38', '41'):
+            self.api.patch(f'/api/products/{self.spinach.pk}/update/', {'price': price}, format='json')
+        self.api.patch(f'/api/products/{self.spinach.pk}/update/', {'name': 'Baby spinach'}, format='json')
+        self.assertEqual(PriceHistory.objects.filter(product_id=self.spinach.pk).count(), 4)
+
+        history = self.client.get(f'/api/products/{self.spinach.pk}/price-history/').json()['history']
+        self.assertEqual(history, [{
+            'day': timezone.localdate().isoformat(), 'open': '40.50', 'min': '38.00', 'avg': '40.88',
+            'max': '44.00', 'close': '41.00', 'quantity': '120.00'
+        }])
+
+    def test_reservations_log_stock_changes(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            reserve(self.spinach.pk, self.buyer, Decimal('20'))
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            reserve(self.mango.pk, self.buyer, Decimal('30.25'))
+        # Written after commit, outside the row lock
+        self.assertEqual(PriceHistory.objects.filter(product_id=self.mango.pk).count(), 1)
+        for callback in callbacks:
+            callback()
+        self.assertEqual(
+            list(PriceHistory.objects.order_by('id').values_list('product_id', 'quantity_available'))[-2:],
+            [(self.spinach.pk, Decimal('100.00')), (self.mango.pk, Decimal('0.00'))]
+        )
+        # Running out of stock also refreshes stats and indexes, but is logged once
+        self.assertEqual(PriceHistory.objects.filter(product_id=self.mango.pk).count(), 2)
+        history = self.client.get(f'/api/products/{self.spinach.pk}/price-history/').json()['history']
+        self.assertEqual((history[0]['close'], history[0]['quantity']), ('40.50', '100.00'))
+
+    def test_days_without_changes_carry_the_close_forward(self):
+        today = timezone.localdate()
+        Product.objects.filter(pk=self.spinach.pk).update(created_at=timezone.now() - timedelta(days=4))
+        DailyPrice.objects.filter(product_id=self.spinach.pk).update(day=today - timedelta(days=2))
+        DailyPrice.objects.filter(product_id=self.spinach.pk).update(open_price=Decimal('39'))
+
+        response = self.client.get(f'/api/products/{self.spinach.pk}/price-history/', {'days': 4})
+        closes = [(point['open'], point['close']) for point in response.json()['history']]
+        self.assertEqual(closes, [('39.00', '39.00'), ('39.00', '40.50'), ('40.50', '40.50'), ('40.50', '40.50')])
+        response = self.client.get(f'/api/products/{self.spinach.pk}/price-history/', {'days': 0})
+        self.assertEqual((response.status_code, response.json()['error']), (400, 'INVALID_DAYS'))
+
+    def test_category_trend_uses_base_unit_rollups(self):
+        self.assertEqual(rollup_category_prices(timezone.localdate()), 2)
+        response = self.client.get(f'/api/categories/{self.fruits.pk}/price-trend/', {'days': 7})
+        self.assertEqual(response.json()['trend'], {'piece': [{
+            'day': timezone.localdate().isoformat(), 'min': '70.8333', 'avg': '70.8333', 'max': '70.8333',
+            'products': 1
+        }]})
+
+
+class SingleFlightTests(CatalogTestCase):
+    """Cache misses are recomputed once while other callers wait or get the stale copy"""
+
+    def test_concurrent_misses_compute_once(self):
+        calls = []
+        started = threading.Event()
+
+        def compute():
+            calls.append(1)
+            started.set()
+            time.sleep(0.2)
+            return 'value'
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(get_or_compute('sf:test', compute, ttl=60)))
+            for _ in range(8)
+        ]
+        threads[0].start()
+        started.wait(1)
+        for thread in threads[1:]:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual((len(calls), results), (1, ['value'] * 8))
+
+    def test_stale_value_is_served_while_refreshing(self):
+        get_or_compute('sf:group', lambda: 'old', ttl=60, group='test')
+        invalidate_group('test')
+        refreshing = threading.Event()
+        release = threading.Event()
+
+        def slow():
+            refreshing.set()
+            release.wait(1)
+            return 'new'
+
+        leader = threading.Thread(target=lambda: get_or_compute('sf:group', slow, ttl=60, group='test'))
+        leader.start()
+        refreshing.wait(1)
+        self.assertEqual(get_or_compute('sf:group', lambda: 'other', ttl=60, group='test'), 'old')
+        release.set()
+        leader.join()
+        self.assertEqual(get_or_compute('sf:group', lambda: 'other', ttl=60, group='test'), 'new')
+
+    @override_settings(SINGLE_FLIGHT_STALE_SECONDS=600)
+    def test_group_generation_outlives_its_entries(self):
+        get_or_compute('sf:long', lambda: 'long', ttl=300, group='lifetime')
+        get_or_compute('sf:short', lambda: 'short', ttl=60, group='lifetime')
+        invalidate_group('lifetime')
+        # LocMemCache keeps expiry times in _expire_info
+        expires = cache._expire_info[cache.make_key('singleflight:group:lifetime')]
+        self.assertAlmostEqual(expires - time.time(), 900, delta=5)
+
+    def test_unlisted_hosts_bypass_the_cache(self):
+        with self.settings(ALLOWED_HOSTS=['testserver', 'evil.example']):
+            self.client.get('/api/categories/')
+        Category.objects.filter(name='Fruits').update(name='Fresh Fruits')
+        names = {category['name'] for category in self.client.get('/api/categories/').json()['categories']}
+        self.assertNotIn('Fresh Fruits', names)
+        with self.settings(ALLOWED_HOSTS=['*']):
+            names = {category['name'] for category in
+                     self.client.get('/api/categories/', HTTP_HOST='evil.example').json()['categories']}
+        self.assertIn('Fresh Fruits', names)
+
+    def test_public_base_url_builds_cached_image_urls(self):
+        with self.settings(PUBLIC_BASE_URL='https://cdn.agrozor.example/', ALLOWED_HOSTS=['*']):
+            body = self.client.get(f'/api/products/{self.spinach.pk}/page/', HTTP_HOST='evil.example').json()
+        images = [image['image'] for image in body['product']['images']]
+        self.assertEqual(len(images), 3)
+        self.assertTrue(all(image.startswith('https://cdn.agrozor.example/media/') for image in images))
+
+    def test_bulk_stock_changes_invalidate_the_cached_lists(self):
+        self.assertEqual(self.client.get('/api/products/featured/').json()['products'][0]['quantity_available'], '30.25')
+        with self.captureOnCommitCallbacks(execute=True):
+            reserve(self.mango.pk, self.buyer, Decimal('5'))
+        self.assertEqual(self.client.get('/api/products/featured/').json()['products'][0]['quantity_available'], '25.25')
+
+    def test_featured_list_is_cached_with_per_user_favorites(self):
+        api = APIClient()
+        api.force_authenticate(self.buyer)
+        anonymous = self.client.get('/api/products/featured/').json()['products']
+        self.assertEqual([(product['id'], product['is_favorited']) for product in anonymous], [(self.mango.pk, False)])
+
+        Product.objects.filter(pk=self.mango.pk).update(name='Kesar Mango')
+        favorited = api.get('/api/products/featured/', {'fields': 'name,is_favorited'}).json()['products']
+        self.assertEqual(favorited, [{'name': 'Kesar Mango', 'is_favorited': True}])
+        self.assertEqual(self.client.get('/api/products/featured/').json()['products'][0]['name'], 'Alphonso Mango')
+
+        invalidate_group('featured')
+        self.assertEqual(self.client.get('/api/products/featured/').json()['products'][0]['name'], 'Kesar Mango')
+
+    def test_category_changes_invalidate_the_cached_list(self):
+        self.assertEqual(len(self.client.get('/api/categories/').json()['categories']), 2)
+        with self.captureOnCommitCallbacks(execute=True):
+            Category.objects.create(name='Grains')
+        self.assertEqual(len(self.client.get('/api/categories/').json()['categories']), 3)
+
+
+class ProductBatchTests(CatalogTestCase):
+    """Many product details in one round-trip"""
+
+    def test_products_come_back_in_request_order(self):
+        api = APIClient()
+        api.force_authenticate(self.buyer)
+        ids = f'{self.mango.pk},999,{self.spinach.pk},{self.mango.pk}'
+        # Products with related rows, images and favorites
+        with self.assertNumQueries(3):
+            response = api.get('/api/products/batch/', {'ids': ids})
+        body = response.json()
+        self.assertEqual([product and product['id'] for product in body['products']],
+                         [self.mango.pk, None, self.spinach.pk, self.mango.pk])
+        self.assertEqual(body['not_found'], [999])
+        self.assertEqual(body['products'][2], self.client.get(f'/api/products/{self.spinach.pk}/').json()['product']
+                         | {'is_favorited': True})
+
+    def test_sparse_fields_and_bad_ids(self):
+        response = self.client.get('/api/products/batch/', {'ids': str(self.spinach.pk), 'fields': 'name,price'})
+        self.assertEqual(response.json()['products'], [{'name': 'Spinach', 'price': '40.50'}])
+        response = self.client.get('/api/products/batch/', {'ids': '1,two'})
+        self.assertEqual((response.status_code, response.json()['error']), (400, 'VALIDATION_ERROR'))
+        with override_settings(PRODUCT_BATCH_LIMIT=1):
+            response = self.client.get('/api/products/batch/', {'ids': f'{self.spinach.pk},{self.mango.pk}'})
+        self.assertEqual((response.status_code, response.json()['error']), (400, 'VALIDATION_ERROR'))
+
+
+class ProductPageTests(CatalogTestCase):
+    """The product page comes in one request from separately cached sections"""
+
+    def setUp(self):
+        super().setUp()
+        self.other = Product.objects.create(
+            farmer=self.farmer, category=self.vegetables, name='Okra', price=Decimal('60'),
+            unit='kg', quantity_available=Decimal('15'), location='Nashik'
+        )
+
+    def test_page_bundles_product_farmer_and_subcategories(self):
+        api = APIClient()
+        api.force_authenticate(self.buyer)
+        # Product, images, farmer, their product count, rows and images, subcategories, favorites
+        with self.assertNumQueries(8):
+            body = api.get(f'/api/products/{self.spinach.pk}/page/').json()
+        self.assertEqual(body['product'], self.client.get(f'/api/products/{self.spinach.pk}/').json()['product']
+                         | {'is_favorited': True})
+        farmer = body['farmer']
+        self.assertEqual((farmer['name'], farmer['product_count']), ('Ravi Kumar', 2))
+        self.assertEqual([(item['name'], item['is_favorited']) for item in farmer['products']], [('Okra', False)])
+        self.assertEqual([item['name'] for item in body['subcategories']], ['Leafy Greens'])
+
+        # Every section is cached; only the favorites are looked up again
+        with self.assertNumQueries(1):
+            api.get(f'/api/products/{self.spinach.pk}/page/')
+
+    def test_writes_invalidate_their_sections(self):
+        self.client.get(f'/api/products/{self.spinach.pk}/page/')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.other.name = 'Lady finger'
+            self.other.save()
+        body = self.client.get(f'/api/products/{self.spinach.pk}/page/').json()
+        self.assertEqual([item['name'] for item in body['farmer']['products']], ['Lady finger'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            reserve(self.spinach.pk, self.buyer, Decimal('20'))
+        body = self.client.get(f'/api/products/{self.spinach.pk}/page/').json()
+        self.assertEqual(body['product']['quantity_available'], '100.00')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.farmer.first_name = 'Ramesh'
+            self.farmer.save()
+        body = self.client.get(f'/api/products/{self.spinach.pk}/page/').json()
+        self.assertEqual((body['product']['farmer_name'], body['farmer']['name']), ('Ramesh Kumar', 'Ramesh Kumar'))
+
+    def test_missing_product(self):
+        response = self.client.get('/api/products/999/page/')
+        self.assertEqual((response.status_code, response.json()['error']), (404, 'NOT_FOUND'))
+
+
+class StructuredLoggingTests(SimpleTestCase):
+    """Logs are JSON lines written off the request thread, tagged with the request"""
+
+    def test_queue_handler_drops_instead_of_blocking(self):
+        handler = QueueLogHandler(maxsize=1)
+        handler.pid = os.getpid()  # No listener thread, so nothing drains the queue
+        record = logging.makeLogRecord({'msg': 'Stock for %s', 'args': ('spinach',)})
+        handler.handle(record)
+        handler.handle(record)
+        self.assertEqual((handler.queue.get_nowait().msg, handler.dropped), ('Stock for spinach', 1))
+
+        # The drop count goes out first once the queue has room; the record itself is dropped again
+        handler.handle(record)
+        report = handler.queue.get_nowait()
+        self.assertEqual((report.levelname, report.dropped, handler.dropped), ('WARNING', 1, 1))
+
+    def test_json_lines_carry_request_context(self):
+        formatter = JSONFormatter()
+        lines = []
+        handler = logging.Handler()
+        handler.emit = lambda record: lines.append(json.loads(formatter.format(record)))
+        handler.addFilter(RequestContextFilter())
+        # assertLogs lets the INFO timing line through without passing it on; it drops our handler on exit
+        with self.assertLogs('Main.requests', 'INFO'):
+            logging.getLogger('Main.requests').addHandler(handler)
+            response = self.client.get('/api/products/batch/', {'ids': 'x'}, HTTP_X_REQUEST_ID='req-42')
+            # Outside a request there is no context
+            logging.getLogger('Main.requests').info('Reserved %s', 'spinach', extra={'quantity': 2})
+
+        self.assertEqual(response['X-Request-ID'], 'req-42')
+        self.assertEqual(
+            {key: lines[0][key] for key in ('level', 'message', 'status', 'request_id', 'route')},
+            {'level': 'INFO', 'message': 'GET /api/products/batch/ 400', 'status': 400,
+             'request_id': 'req-42', 'route': 'product-batch'}
+        )
+        self.assertEqual({key: lines[1][key] for key in ('message', 'quantity')},
+                         {'message': 'Reserved spinach', 'quantity': 2})
+        self.assertNotIn('request_id', lines[1])
+        self.assertNotIn('route', lines[1])
+
+    def test_sampling_keeps_warnings_and_whole_requests(self):
+        sampling = SamplingFilter(rate=0)
+        info = logging.makeLogRecord({'levelno': logging.INFO})
+        warning = logging.makeLogRecord({'levelno': logging.WARNING})
+        self.assertEqual((sampling.filter(info), sampling.filter(warning)), (False, True))
+        token = sampled_var.set(True)
+        try:
+            self.assertTrue(sampling.filter(info))
+        finally:
+            sampled_var.reset(token)
@@ -16,24 +16,39 @@ urlpatterns = [
     # Categories URLs
     path('categories/', views.CategoryListView.as_view(), name='category-list'),
     path('categories/<int:category_id>/subcategories/', views.SubCategoryListView.as_view(), name='subcategory-list'),
+    path('categories/<int:category_id>/price-trend/', views.CategoryPriceTrendView.as_view(), name='category-price-trend'),
     
     # Products URLs
     path('products/', views.ProductListView.as_view(), name='product-list'),
     path('products/<int:pk>/', views.ProductDetailView.as_view(), name='product-detail'),
+    path('products/batch/', views.ProductBatchView.as_view(), name='product-batch'),
     path('products/featured/', views.FeaturedProductsView.as_view(), name='featured-products'),
+    path('products/changes/', views.ProductChangesView.as_view(), name='product-changes'),
+    path('events/', views.product_events, name='product-events'),
+    path('products/<int:pk>/page/', views.ProductPageView.as_view(), name='product-page'),
+    path('products/<int:pk>/price-history/', views.ProductPriceHistoryView.as_view(), name='product-price-history'),
+    path('products/<int:pk>/related/', views.RelatedProductsView.as_view(), name='related-products'),
     path('products/create/', views.ProductCreateView.as_view(), name='product-create'),
     path('products/<int:pk>/update/', views.ProductUpdateView.as_view(), name='product-update'),
     path('products/<int:pk>/delete/', views.ProductDeleteView.as_view(), name='product-delete'),
+    path('products/<int:pk>/reserve/', views.ProductReserveView.as_view(), name='product-reserve'),
     path('my-products/', views.MyProductsView.as_view(), name='my-products'),
     
     # Favorites URLs
     path('favorites/', views.FavoriteListView.as_view(), name='favorite-list'),
     path('favorites/toggle/<int:product_id>/', views.FavoriteToggleView.as_view(), name='favorite-toggle'),
+    path('favorites/batch/', views.FavoriteBatchView.as_view(), name='favorite-batch'),
+    
+    # Reservations URLs
+    path('reservations/', views.ReservationListView.as_view(), name='reservation-list'),
+    path('reservations/<int:pk>/', views.ReservationDetailView.as_view(), name='reservation-release'),
+    path('reservations/<int:pk>/confirm/', views.ReservationConfirmView.as_view(), name='reservation-confirm'),
     
     # Contact URLs
     path('contact/', views.ContactUsView.as_view(), name='contact-us'),
     
     # Utility URLs
     path('dashboard/stats/', views.dashboard_stats, name='dashboard-stats'),
+    path('dashboard/db-pool/', views.database_pool_stats, name='database-pool-stats'),
     path('search/suggestions/', views.search_suggestions, name='search-suggestions'),
 ]
\ No newline at end of file
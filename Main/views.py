@@ -5,18 +5,41 @@ from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework_simplejwt.tokens import RefreshToken
 from django.contrib.auth import authenticate
-from django.db.models import Q
+from django.db.models import Case, CharField, IntegerField, Q, Value, When
 from django.shortcuts import get_object_or_404
 from django.db import IntegrityError, transaction
 from django.core.exceptions import ValidationError
+from django.conf import settings
+from django.utils import timezone
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, StreamingHttpResponse
+from decimal import Decimal, InvalidOperation
 import logging
+import os
 
-from .models import User, Category, SubCategory, Product, ContactMessage, Favorite
+from .changelog import ResyncRequired, changes_since, head_token
+from .db.pool import pool_stats
+from .db.retry import retry_on_lock
+from .facets import facet_index, parse_id_filters, product_search_ids
+from .favorites import invalidate_favorites, lock_favorites
+from .geo import geo_index
+from .history import category_trend, product_trend
+from .inventory import InsufficientStock, confirm, release, reserve
+from .pages import farmer_section, product_section, subcategories_section
+from .popularity import record_favorites
+from .realtime import broker, parse_topics, sse_stream
+from .recommendations import related_products
+from .routers import ReplicaReadMixin, use_replica
+from .semantic import semantic_index
+from .singleflight import get_or_compute_for_request
+from .models import User, Category, SubCategory, Product, ContactMessage, Favorite, InventoryReservation
+from .models import base_unit_names, units_for_base_unit
 from .serializers import (
     UserRegistrationSerializer, UserLoginSerializer, UserProfileSerializer,
     CategorySerializer, SubCategorySerializer, ProductListSerializer,
     ProductDetailSerializer, ProductCreateUpdateSerializer, ContactMessageSerializer,
-    FavoriteSerializer, PasswordChangeSerializer
+    FavoriteSerializer, PasswordChangeSerializer, ProductListRowSerializer,
+    FavoriteRowSerializer, ReservationRequestSerializer, InventoryReservationSerializer, favorite_ids_for
 )
 from drf_spectacular.utils import extend_schema, OpenApiParameter, OpenApiExample
 from drf_spectacular.types import OpenApiTypes
@@ -74,18 +97,13 @@ class FarmerRegistrationView(APIView):
         tags=['Authentication']
     )
     def post(self, request):
-            print(f"DEBUG: Request data: {request.data}")
-        
         # try:
             data = request.data.copy()
             data['user_type'] = 'farmer'
             
-            print(f"DEBUG: Data with user_type: {data}")
-            
             serializer = UserRegistrationSerializer(data=data)
             
             if serializer.is_valid():
-                print("DEBUG: Serializer is valid")
                 try:
                     with transaction.atomic():
                         user = serializer.save()
@@ -100,15 +118,15 @@ class FarmerRegistrationView(APIView):
                             }
                         }, status=status.HTTP_201_CREATED)
                 except Exception as save_error:
-                    print(f"DEBUG: Error saving user: {str(save_error)}")
-                    print(f"DEBUG: Error type: {type(save_error)}")
+                    logger.error(f"Error saving farmer registration: {str(save_error)}", exc_info=True)
                     return Response({
                         'success': False,
                         'message': f'Registration failed: {str(save_error)}',
                         'error': 'SAVE_ERROR'
                     }, status=status.HTTP_400_BAD_REQUEST)
             else:
-                print(f"DEBUG: Serializer errors: {serializer.errors}")
+                # Field names only; the submitted values include the password
+                logger.info('Farmer registration rejected', extra={'invalid_fields': sorted(serializer.errors)})
                 
                 # Handle validation errors with user-friendly messages
                 errors = {}
@@ -352,18 +370,24 @@ class ChangePasswordView(APIView):
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
-class CategoryListView(generics.ListAPIView):
+class CategoryListView(ReplicaReadMixin, generics.ListAPIView):
     """List all categories"""
     queryset = Category.objects.filter(is_active=True)
     serializer_class = CategorySerializer
     
     def list(self, request, *args, **kwargs):
         try:
-            queryset = self.get_queryset()
-            serializer = self.get_serializer(queryset, many=True)
+            # Image URLs are absolute, so the cached copy is per origin
+            categories = get_or_compute_for_request(
+                request, 'categories',
+                lambda req: [dict(item) for item in CategorySerializer(
+                    self.get_queryset(), many=True, context=dict(self.get_serializer_context(), request=req)
+                ).data],
+                ttl=getattr(settings, 'CATEGORY_CACHE_SECONDS', 300), group='categories'
+            )
             return Response({
                 'success': True,
-                'categories': serializer.data
+                'categories': categories
             })
         except Exception as e:
             logger.error(f"Error fetching categories: {str(e)}")
@@ -374,13 +398,13 @@ class CategoryListView(generics.ListAPIView):
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
-class SubCategoryListView(generics.ListAPIView):
+class SubCategoryListView(ReplicaReadMixin, generics.ListAPIView):
     """List subcategories by category"""
     serializer_class = SubCategorySerializer
     
     def get_queryset(self):
         category_id = self.kwargs.get('category_id')
-        return SubCategory.objects.filter(category_id=category_id, is_active=True)
+        return SubCategory.objects.filter(category_id=category_id, is_active=True).select_related('category')
     
     def list(self, request, *args, **kwargs):
         try:
@@ -399,7 +423,42 @@ class SubCategoryListView(generics.ListAPIView):
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
-class ProductListView(generics.ListAPIView):
+class SparseFieldsViewMixin:
+    """Parse the ?fields=, ?expand= and ?mode= query parameters"""
+    field_presets = {
+        'grid': ['id', 'name', 'price', 'unit', 'primary_image'],
+    }
+    expandable_fields = ('images',)
+
+    def get_sparse_fields(self, available):
+        """Return (fields or None for all, expand, unknown names)"""
+        params = self.request.query_params
+        fields = self.field_presets.get(params.get('mode'))
+        requested = [name.strip() for name in params.get('fields', '').split(',') if name.strip()]
+        if requested:
+            # Without repeats and in declared order, so each selection is spelled one way
+            order = {name: i for i, name in enumerate(available)}
+            fields = sorted(dict.fromkeys(requested), key=lambda name: order.get(name, len(order)))
+        expand = [name.strip() for name in params.get('expand', '').split(',') if name.strip()]
+        expand = list(dict.fromkeys(expand))
+
+        unknown = [name for name in fields or [] if name not in available]
+        unknown += [name for name in expand if name not in self.expandable_fields]
+        return fields, expand, unknown
+
+    def invalid_fields_response(self, unknown):
+        return Response({
+            'success': False,
+            'message': f"Unknown fields requested: {', '.join(unknown)}.",
+            'error': 'INVALID_FIELDS'
+        }, status=status.HTTP_400_BAD_REQUEST)
+
+    def get_product_rows(self, queryset, fields, expand):
+        """values_list() queryset limited to the columns the requested fields need"""
+        return queryset.values_list(*ProductListRowSerializer.columns(fields=fields, expand=expand))
+
+
+class ProductListView(ReplicaReadMixin, SparseFieldsViewMixin, generics.ListAPIView):
     """List products with filtering and search"""
     serializer_class = ProductListSerializer
     
@@ -433,36 +492,194 @@ class ProductListView(generics.ListAPIView):
         
         # Search
         search = self.request.query_params.get('search')
+        self.semantic_ids = []
         if search:
-            queryset = queryset.filter(
+            matches = (
                 Q(name__icontains=search) |
                 Q(description__icontains=search) |
                 Q(category__name__icontains=search)
             )
+            # Semantic search adds products whose embeddings are close to the query
+            if self.request.query_params.get('semantic', '').lower() == 'true':
+                self.semantic_ids = [pk for pk, _ in semantic_index.search(search)]
+                if self.semantic_ids:
+                    matches |= Q(id__in=self.semantic_ids)
+            queryset = queryset.filter(matches)
+        
+        # Filter by price per kg (or per piece for count units)
+        base_unit = self.get_base_unit()
+        if base_unit:
+            queryset = queryset.filter(unit__in=units_for_base_unit(base_unit))
+        min_unit_price, max_unit_price = self.get_unit_price_range()
+        if min_unit_price is not None:
+            queryset = queryset.filter(price_per_base_unit__gte=min_unit_price)
+        if max_unit_price is not None:
+            queryset = queryset.filter(price_per_base_unit__lte=max_unit_price)
         
         # Sort
         sort_by = self.request.query_params.get('sort', '-created_at')
-        if sort_by in ['price', '-price', 'name', '-name', 'created_at', '-created_at']:
+        if self.semantic_ids and 'sort' not in self.request.query_params:
+            # Best semantic matches first, keyword-only matches after them
+            queryset = queryset.annotate(semantic_rank=Case(
+                *[When(id=pk, then=Value(rank)) for rank, pk in enumerate(self.semantic_ids)],
+                default=Value(len(self.semantic_ids)), output_field=IntegerField()
+            )).order_by('semantic_rank', '-created_at')
+        elif sort_by in ['price', '-price', 'name', '-name', 'created_at', '-created_at']:
             queryset = queryset.order_by(sort_by)
+        elif sort_by == 'popular':
+            queryset = queryset.order_by('-popularity_score', '-created_at')
+        elif sort_by in ['unit_price', '-unit_price']:
+            ordering = [sort_by.replace('unit_price', 'price_per_base_unit'), 'id']
+            if not base_unit:
+                # Prices per kg and per piece don't compare, so group them by base unit first
+                ordering.insert(0, Case(
+                    *[When(unit__in=units_for_base_unit(base), then=Value(base)) for base in base_unit_names()],
+                    output_field=CharField()
+                ))
+            queryset = queryset.order_by(*ordering)
         
         return queryset
     
+    def get_base_unit(self):
+        """Parse ?base_unit= (kg or piece), None when absent"""
+        base_unit = self.request.query_params.get('base_unit')
+        if base_unit and base_unit not in base_unit_names():
+            raise ValueError(f"base_unit must be one of: {', '.join(base_unit_names())}.")
+        return base_unit or None
+    
+    def get_unit_price_range(self):
+        """Parse ?min_unit_price=&max_unit_price= into Decimals (or None)"""
+        bounds = []
+        for name in ('min_unit_price', 'max_unit_price'):
+            value = self.request.query_params.get(name)
+            try:
+                bounds.append(Decimal(value) if value else None)
+            except InvalidOperation:
+                raise ValueError(f'{name} must be a number.')
+            if bounds[-1] is not None and not bounds[-1].is_finite():
+                raise ValueError(f'{name} must be a number.')
+        return bounds
+    
+    def with_facets(self, data, near_ids=None):
+        """Add facet counts for the current filters when ?facets=true; `near_ids` are the products in range"""
+        params = self.request.query_params
+        if params.get('facets', '').lower() == 'true':
+            search = params.get('search')
+            search_ids = product_search_ids(search, self.semantic_ids) if search else None
+            data['facets'] = facet_index.counts(params, search_ids, near_ids)
+        return data
+    
+    def get_near(self):
+        """Parse ?near=lat,lon&radius_km= into (lat, lon, radius_km), or None"""
+        params = self.request.query_params
+        if not params.get('near'):
+            return None
+        try:
+            lat, lon = (float(value) for value in params['near'].split(','))
+            radius_km = float(params.get('radius_km', 25))
+        except ValueError:
+            raise ValueError('Use near=<latitude>,<longitude> and a numeric radius_km.')
+        max_radius = getattr(settings, 'GEO_MAX_RADIUS_KM', 500)
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            raise ValueError('Coordinates are out of range.')
+        if not 0 < radius_km <= max_radius:
+            raise ValueError(f'radius_km must be between 0 and {max_radius}.')
+        return lat, lon, radius_km
+    
+    def list_near(self, queryset, near, fields, expand):
+        """Products inside the radius, nearest first, with their distance in km"""
+        hits = geo_index.nearby(*near, limit=getattr(settings, 'GEO_MAX_RESULTS', 2000))
+        distances = dict(hits)
+        candidate_ids = list(distances)
+        allowed = set()
+        for start in range(0, len(candidate_ids), 500):
+            chunk = candidate_ids[start:start + 500]
+            allowed.update(queryset.filter(id__in=chunk).values_list('id', flat=True))
+        ordered_ids = [pk for pk, _ in hits if pk in allowed]
+        
+        page_ids = self.paginate_queryset(ordered_ids)
+        paginated = page_ids is not None
+        if not paginated:
+            page_ids = ordered_ids
+        columns = ProductListRowSerializer.columns(fields=fields, expand=expand)
+        id_index = len(columns)
+        rows = {
+            row[id_index]: row
+            for row in queryset.filter(id__in=page_ids).values_list(*columns, 'id')
+        }
+        page_ids = [pk for pk in page_ids if pk in rows]
+        serializer = ProductListRowSerializer(
+            [rows[pk] for pk in page_ids], context=self.get_serializer_context(),
+            fields=fields, expand=expand
+        )
+        products = serializer.data
+        for product, pk in zip(products, page_ids):
+            product['distance_km'] = round(distances[pk], 3)
+        
+        data = self.with_facets({'success': True, 'products': products}, near_ids=distances)
+        if paginated:
+            return self.get_paginated_response(data)
+        return Response(data)
+    
     def list(self, request, *args, **kwargs):
         try:
-            queryset = self.get_queryset()
+            fields, expand, unknown = self.get_sparse_fields(ProductListRowSerializer.field_names())
+            if unknown:
+                return self.invalid_fields_response(unknown)
+
+            try:
+                self.get_unit_price_range()
+            except ValueError as e:
+                return Response({
+                    'success': False,
+                    'message': str(e),
+                    'error': 'INVALID_PRICE'
+                }, status=status.HTTP_400_BAD_REQUEST)
+            
+            try:
+                self.get_base_unit()
+            except ValueError as e:
+                return Response({
+                    'success': False,
+                    'message': str(e),
+                    'error': 'INVALID_UNIT'
+                }, status=status.HTTP_400_BAD_REQUEST)
+            
+            try:
+                parse_id_filters(request.query_params)
+            except ValueError as e:
+                return Response({
+                    'success': False,
+                    'message': str(e),
+                    'error': 'INVALID_FILTER'
+                }, status=status.HTTP_400_BAD_REQUEST)
+            
+            try:
+                near = self.get_near()
+            except ValueError as e:
+                return Response({
+                    'success': False,
+                    'message': str(e),
+                    'error': 'INVALID_LOCATION'
+                }, status=status.HTTP_400_BAD_REQUEST)
+            if near:
+                return self.list_near(self.get_queryset(), near, fields, expand)
+
+            queryset = self.get_product_rows(self.get_queryset(), fields, expand)
+            context = self.get_serializer_context()
             page = self.paginate_queryset(queryset)
             if page is not None:
-                serializer = self.get_serializer(page, many=True)
-                return self.get_paginated_response({
+                serializer = ProductListRowSerializer(page, context=context, fields=fields, expand=expand)
+                return self.get_paginated_response(self.with_facets({
                     'success': True,
                     'products': serializer.data
-                })
+                }))
 
-            serializer = self.get_serializer(queryset, many=True)
-            return Response({
+            serializer = ProductListRowSerializer(queryset, context=context, fields=fields, expand=expand)
+            return Response(self.with_facets({
                 'success': True,
                 'products': serializer.data
-            })
+            }))
         except Exception as e:
             logger.error(f"Error fetching products: {str(e)}")
             return Response({
@@ -472,13 +689,32 @@ class ProductListView(generics.ListAPIView):
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
-class ProductDetailView(generics.RetrieveAPIView):
+class ProductDetailView(ReplicaReadMixin, SparseFieldsViewMixin, generics.RetrieveAPIView):
     """Get product details"""
-    queryset = Product.objects.all()
     serializer_class = ProductDetailSerializer
+    field_presets = {}
+    
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        fields, expand, _ = self.get_sparse_fields(())
+        if fields:
+            context['fields'] = fields + expand
+        return context
+    
+    def get_queryset(self):
+        serializer = self.get_serializer()
+        columns, relations = serializer.get_select_columns()
+        queryset = Product.objects.select_related(*relations).only(*columns)
+        if 'images' in serializer.fields:
+            queryset = queryset.prefetch_related('images')
+        return queryset
     
     def retrieve(self, request, *args, **kwargs):
         try:
+            _, _, unknown = self.get_sparse_fields(ProductDetailSerializer().fields)
+            if unknown:
+                return self.invalid_fields_response(unknown)
+            
             instance = self.get_object()
             serializer = self.get_serializer(instance)
             return Response({
@@ -500,7 +736,103 @@ class ProductDetailView(generics.RetrieveAPIView):
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
-class MyProductsView(generics.ListAPIView):
+class ProductBatchView(ProductDetailView):
+    """Get the details of many products in one request, in the requested order"""
+    
+    def get_product_ids(self):
+        value = self.request.query_params.get('ids', '')
+        ids = [pk.strip() for pk in value.split(',') if pk.strip()]
+        if not ids or not all(pk.isdigit() for pk in ids):
+            raise ValueError("'ids' must be a comma separated list of product ids.")
+        return [int(pk) for pk in ids]
+    
+    def get(self, request, *args, **kwargs):
+        try:
+            _, _, unknown = self.get_sparse_fields(ProductDetailSerializer().fields)
+            if unknown:
+                return self.invalid_fields_response(unknown)
+            
+            try:
+                ids = self.get_product_ids()
+            except ValueError as e:
+                return Response({
+                    'success': False,
+                    'message': str(e),
+                    'error': 'VALIDATION_ERROR'
+                }, status=status.HTTP_400_BAD_REQUEST)
+            
+            limit = getattr(settings, 'PRODUCT_BATCH_LIMIT', 200)
+            if len(set(ids)) > limit:
+                return Response({
+                    'success': False,
+                    'message': f'At most {limit} products can be fetched at once.',
+                    'error': 'VALIDATION_ERROR'
+                }, status=status.HTTP_400_BAD_REQUEST)
+            
+            found = list(self.get_queryset().filter(pk__in=set(ids)))
+            serializer = self.get_serializer(found, many=True)
+            by_id = {product.pk: data for product, data in zip(found, serializer.data)}
+            # Missing ids keep their slot as null, so results line up with the request
+            return Response({
+                'success': True,
+                'products': [by_id.get(pk) for pk in ids],
+                'not_found': [pk for pk in dict.fromkeys(ids) if pk not in by_id]
+            })
+        except Exception as e:
+            logger.error(f"Error fetching products in batch: {str(e)}")
+            return Response({
+                'success': False,
+                'message': 'Unable to fetch products.',
+                'error': 'FETCH_ERROR'
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class ProductPageView(ReplicaReadMixin, APIView):
+    """
+    Everything a product page shows in one request: the product's details,
+    its farmer with more of their products, and the category's subcategories
+    """
+    
+    def get(self, request, pk):
+        try:
+            page = product_section(request, pk)
+            if page is None:
+                return Response({
+                    'success': False,
+                    'message': 'Product not found.',
+                    'error': 'NOT_FOUND'
+                }, status=status.HTTP_404_NOT_FOUND)
+            
+            farmer = farmer_section(request, page['farmer_id'])
+            subcategories = subcategories_section(request, page['category_id'])
+            
+            # The cached sections are shared, so favorites are applied here
+            others = []
+            if farmer is not None:
+                limit = getattr(settings, 'PRODUCT_PAGE_FARMER_PRODUCTS', 8)
+                others = [item for item in farmer['products'] if item['id'] != pk][:limit]
+            favorite_ids = favorite_ids_for({'request': request}, [pk, *(item['id'] for item in others)])
+            product = dict(page['product'], is_favorited=pk in favorite_ids)
+            if farmer is not None:
+                farmer = dict(farmer, products=[
+                    dict(item, is_favorited=item['id'] in favorite_ids) for item in others
+                ])
+            return Response({
+                'success': True,
+                'product': product,
+                'farmer': farmer,
+                'subcategories': subcategories
+            })
+        except Exception as e:
+            logger.error(f"Error fetching product page: {str(e)}")
+            return Response({
+                'success': False,
+                'message': 'Unable to fetch product page.',
+                'error': 'FETCH_ERROR'
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class MyProductsView(SparseFieldsViewMixin, generics.ListAPIView):
     """List products for authenticated farmer"""
     serializer_class = ProductListSerializer
     permission_classes = [permissions.IsAuthenticated]
@@ -519,8 +851,14 @@ class MyProductsView(generics.ListAPIView):
                     'error': 'PERMISSION_DENIED'
                 }, status=status.HTTP_403_FORBIDDEN)
             
-            queryset = self.get_queryset()
-            serializer = self.get_serializer(queryset, many=True)
+            fields, expand, unknown = self.get_sparse_fields(ProductListRowSerializer.field_names())
+            if unknown:
+                return self.invalid_fields_response(unknown)
+            
+            queryset = self.get_product_rows(self.get_queryset(), fields, expand)
+            serializer = ProductListRowSerializer(
+                queryset, context=self.get_serializer_context(), fields=fields, expand=expand
+            )
             return Response({
                 'success': True,
                 'products': serializer.data
@@ -539,6 +877,11 @@ class ProductCreateView(generics.CreateAPIView):
     serializer_class = ProductCreateUpdateSerializer
     permission_classes = [permissions.IsAuthenticated]
     
+    @retry_on_lock
+    def save_product(self, serializer):
+        with transaction.atomic():
+            return serializer.save(farmer=self.request.user)
+    
     def create(self, request, *args, **kwargs):
         try:
             if not request.user.is_farmer:
@@ -550,13 +893,12 @@ class ProductCreateView(generics.CreateAPIView):
             
             serializer = self.get_serializer(data=request.data)
             if serializer.is_valid():
-                with transaction.atomic():
-                    product = serializer.save(farmer=request.user)
-                    return Response({
-                        'success': True,
-                        'message': 'Product created successfully',
-                        'product': ProductDetailSerializer(product, context={'request': request}).data
-                    }, status=status.HTTP_201_CREATED)
+                product = self.save_product(serializer)
+                return Response({
+                    'success': True,
+                    'message': 'Product created successfully',
+                    'product': ProductDetailSerializer(product, context={'request': request}).data
+                }, status=status.HTTP_201_CREATED)
             
             return Response({
                 'success': False,
@@ -581,19 +923,26 @@ class ProductUpdateView(generics.UpdateAPIView):
     def get_queryset(self):
         return Product.objects.filter(farmer=self.request.user)
     
+    @retry_on_lock
+    def save_product(self, serializer):
+        with transaction.atomic():
+            # Re-read under a row lock, so stock taken by reservations since
+            # get_object() is not written back
+            serializer.instance = self.get_queryset().select_for_update().get(pk=serializer.instance.pk)
+            return serializer.save()
+    
     def update(self, request, *args, **kwargs):
         try:
             instance = self.get_object()
             serializer = self.get_serializer(instance, data=request.data, partial=True)
             
             if serializer.is_valid():
-                with transaction.atomic():
-                    product = serializer.save()
-                    return Response({
-                        'success': True,
-                        'message': 'Product updated successfully',
-                        'product': ProductDetailSerializer(product, context={'request': request}).data
-                    })
+                product = self.save_product(serializer)
+                return Response({
+                    'success': True,
+                    'message': 'Product updated successfully',
+                    'product': ProductDetailSerializer(product, context={'request': request}).data
+                })
             
             return Response({
                 'success': False,
@@ -623,15 +972,19 @@ class ProductDeleteView(generics.DestroyAPIView):
     def get_queryset(self):
         return Product.objects.filter(farmer=self.request.user)
     
+    @retry_on_lock
+    def delete_product(self, instance):
+        with transaction.atomic():
+            instance.delete()
+    
     def destroy(self, request, *args, **kwargs):
         try:
             instance = self.get_object()
-            with transaction.atomic():
-                instance.delete()
-                return Response({
-                    'success': True,
-                    'message': 'Product deleted successfully'
-                }, status=status.HTTP_200_OK)
+            self.delete_product(instance)
+            return Response({
+                'success': True,
+                'message': 'Product deleted successfully'
+            }, status=status.HTTP_200_OK)
                 
         except Product.DoesNotExist:
             return Response({
@@ -648,18 +1001,41 @@ class ProductDeleteView(generics.DestroyAPIView):
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
-class FeaturedProductsView(generics.ListAPIView):
+class FeaturedProductsView(ReplicaReadMixin, SparseFieldsViewMixin, generics.ListAPIView):
     """List featured products"""
     serializer_class = ProductListSerializer
     queryset = Product.objects.filter(is_featured=True, status='available')
     
     def list(self, request, *args, **kwargs):
         try:
-            queryset = self.get_queryset()
-            serializer = self.get_serializer(queryset, many=True)
+            fields, expand, unknown = self.get_sparse_fields(ProductListRowSerializer.field_names())
+            if unknown:
+                return self.invalid_fields_response(unknown)
+            
+            # Cached for everyone, so is_favorited is filled in per request from the ids
+            cached_fields = None if fields is None else sorted(set(fields) | {'id'})
+            key = f"featured:{','.join(cached_fields or ['*'])}:{','.join(expand)}"
+            products = get_or_compute_for_request(
+                request, key, lambda req: self.serialize_featured(req, cached_fields, expand),
+                ttl=getattr(settings, 'FEATURED_CACHE_SECONDS', 60), group='featured'
+            )
+            
+            favorite_ids = None
+            if fields is None or 'is_favorited' in fields:
+                favorite_ids = favorite_ids_for(
+                    self.get_serializer_context(), [product['id'] for product in products]
+                )
+            drop_id = fields is not None and 'id' not in fields
+            if favorite_ids is not None or drop_id:
+                products = [dict(product) for product in products]
+                for product in products:
+                    if favorite_ids is not None:
+                        product['is_favorited'] = product['id'] in favorite_ids
+                    if drop_id:
+                        del product['id']
             return Response({
                 'success': True,
-                'products': serializer.data
+                'products': products
             })
         except Exception as e:
             logger.error(f"Error fetching featured products: {str(e)}")
@@ -670,6 +1046,340 @@ class FeaturedProductsView(generics.ListAPIView):
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+    def serialize_featured(self, request, fields, expand):
+        context = dict(self.get_serializer_context(), request=request, favorite_ids=set())
+        queryset = self.get_product_rows(self.get_queryset(), fields, expand)
+        return ProductListRowSerializer(queryset, context=context, fields=fields, expand=expand).data
+
+
+class RelatedProductsView(ReplicaReadMixin, SparseFieldsViewMixin, generics.ListAPIView):
+    """Products most often favorited together with this one"""
+    serializer_class = ProductListSerializer
+    queryset = Product.objects.filter(status='available')
+
+    def list(self, request, *args, **kwargs):
+        try:
+            fields, expand, unknown = self.get_sparse_fields(ProductListRowSerializer.field_names())
+            if unknown:
+                return self.invalid_fields_response(unknown)
+
+            top_k = getattr(settings, 'RECOMMENDATIONS_TOP_K', 20)
+            try:
+                limit = min(max(int(request.query_params.get('limit', 10)), 1), top_k)
+            except ValueError:
+                limit = 10
+
+            scores = dict(related_products.lookup(self.kwargs['pk'], limit=top_k))
+            columns = ProductListRowSerializer.columns(fields=fields, expand=expand)
+            id_index = len(columns)
+            rows = {
+                row[id_index]: row
+                for row in self.get_queryset().filter(id__in=list(scores)).values_list(*columns, 'id')
+            }
+            related_ids = [pk for pk in scores if pk in rows][:limit]
+            serializer = ProductListRowSerializer(
+                [rows[pk] for pk in related_ids], context=self.get_serializer_context(),
+                fields=fields, expand=expand
+            )
+            products = serializer.data
+            for product, pk in zip(products, related_ids):
+                product['score'] = round(scores[pk], 4)
+
+            return Response({
+                'success': True,
+                'products': products
+            })
+        except Exception as e:
+            logger.error(f"Error fetching related products: {str(e)}")
+            return Response({
+                'success': False,
+                'message': 'Unable to fetch related products.',
+                'error': 'FETCH_ERROR'
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class PriceTrendMixin:
+    """Parses ?days= for the price trend views"""
+    
+    def get_days(self):
+        max_days = getattr(settings, 'PRICE_TREND_MAX_DAYS', 365)
+        days = self.request.query_params.get('days', getattr(settings, 'PRICE_TREND_DEFAULT_DAYS', 30))
+        try:
+            days = int(days)
+        except (TypeError, ValueError):
+            days = 0
+        if not 1 <= days <= max_days:
+            raise ValueError(f'days must be a whole number between 1 and {max_days}.')
+        return days
+    
+    def invalid_days_response(self, error):
+        return Response({
+            'success': False,
+            'message': str(error),
+            'error': 'INVALID_DAYS'
+        }, status=status.HTTP_400_BAD_REQUEST)
+
+
+class ProductPriceHistoryView(ReplicaReadMixin, PriceTrendMixin, APIView):
+    """Daily price and stock of a product, from the precomputed daily rollups"""
+    
+    def get(self, request, pk):
+        try:
+            try:
+                days = self.get_days()
+            except ValueError as e:
+                return self.invalid_days_response(e)
+            
+            product = Product.objects.filter(pk=pk).only(
+                'id', 'price', 'unit', 'quantity_available', 'created_at'
+            ).first()
+            if product is None:
+                return Response({
+                    'success': False,
+                    'message': 'Product not found.',
+                    'error': 'NOT_FOUND'
+                }, status=status.HTTP_404_NOT_FOUND)
+            
+            return Response({
+                'success': True,
+                'product': product.pk,
+                'unit': product.unit,
+                'history': product_trend(product, days)
+            })
+        except Exception as e:
+            logger.error(f"Error fetching price history: {str(e)}")
+            return Response({
+                'success': False,
+                'message': 'Unable to fetch price history.',
+                'error': 'FETCH_ERROR'
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class CategoryPriceTrendView(ReplicaReadMixin, PriceTrendMixin, APIView):
+    """Daily min/avg/max price per kg and per piece across a category"""
+    
+    def get(self, request, category_id):
+        try:
+            try:
+                days = self.get_days()
+            except ValueError as e:
+                return self.invalid_days_response(e)
+            
+            if not Category.objects.filter(pk=category_id, is_active=True).exists():
+                return Response({
+                    'success': False,
+                    'message': 'Category not found.',
+                    'error': 'NOT_FOUND'
+                }, status=status.HTTP_404_NOT_FOUND)
+            
+            return Response({
+                'success': True,
+                'category': category_id,
+                'trend': category_trend(category_id, days, request.query_params.get('base_unit'))
+            })
+        except Exception as e:
+            logger.error(f"Error fetching category price trend: {str(e)}")
+            return Response({
+                'success': False,
+                'message': 'Unable to fetch the price trend.',
+                'error': 'FETCH_ERROR'
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class ProductChangesView(ReplicaReadMixin, SparseFieldsViewMixin, generics.ListAPIView):
+    """Products created, updated or deleted since a sync token"""
+    serializer_class = ProductListSerializer
+    queryset = Product.objects.filter(status='available')
+    
+    def list(self, request, *args, **kwargs):
+        try:
+            fields, expand, unknown = self.get_sparse_fields(ProductListRowSerializer.field_names())
+            if unknown:
+                return self.invalid_fields_response(unknown)
+            
+            # Without a token, hand out the current one to use after a full download
+            since = request.query_params.get('since')
+            if since is None:
+                return Response({
+                    'success': True,
+                    'products': [],
+                    'deleted': [],
+                    'next_token': str(head_token()),
+                    'has_more': False
+                })
+            if not since.isdigit():
+                return Response({
+                    'success': False,
+                    'message': 'Invalid sync token.',
+                    'error': 'INVALID_TOKEN'
+                }, status=status.HTTP_400_BAD_REQUEST)
+            
+            try:
+                latest, next_token, has_more = changes_since(
+                    int(since), getattr(settings, 'PRODUCT_CHANGES_PAGE_SIZE', 500)
+                )
+            except ResyncRequired:
+                return Response({
+                    'success': False,
+                    'message': 'This sync token has expired. Download the catalog again.',
+                    'error': 'RESYNC_REQUIRED'
+                }, status=status.HTTP_410_GONE)
+            
+            upserted = [pk for pk, action in latest.items() if action == 'upsert']
+            columns = ProductListRowSerializer.columns(fields=fields, expand=expand)
+            id_index = len(columns)
+            rows = {
+                row[id_index]: row
+                for row in self.get_queryset().filter(id__in=upserted).values_list(*columns, 'id')
+            }
+            serializer = ProductListRowSerializer(
+                [rows[pk] for pk in upserted if pk in rows], context=self.get_serializer_context(),
+                fields=fields, expand=expand
+            )
+            return Response({
+                'success': True,
+                'products': serializer.data,
+                # Deleted, or no longer available for sale
+                'deleted': [pk for pk in latest if pk not in rows],
+                'next_token': str(next_token),
+                'has_more': has_more
+            })
+        except Exception as e:
+            logger.error(f"Error fetching product changes: {str(e)}")
+            return Response({
+                'success': False,
+                'message': 'Unable to fetch product changes.',
+                'error': 'FETCH_ERROR'
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class ProductReserveView(APIView):
+    """Hold stock of a product for the current user"""
+    permission_classes = [permissions.IsAuthenticated]
+    
+    def post(self, request, pk):
+        try:
+            serializer = ReservationRequestSerializer(data=request.data)
+            if not serializer.is_valid():
+                return Response({
+                    'success': False,
+                    'message': 'Invalid quantity.',
+                    'errors': serializer.errors
+                }, status=status.HTTP_400_BAD_REQUEST)
+            quantity = serializer.validated_data['quantity']
+            
+            product = Product.objects.filter(pk=pk).values('status', 'min_order_quantity').first()
+            if product is None or product['status'] == 'discontinued':
+                return Response({
+                    'success': False,
+                    'message': 'Product not found or no longer available.',
+                    'error': 'PRODUCT_NOT_FOUND'
+                }, status=status.HTTP_404_NOT_FOUND)
+            if quantity < product['min_order_quantity']:
+                return Response({
+                    'success': False,
+                    'message': f"The minimum order quantity is {product['min_order_quantity']}.",
+                    'error': 'BELOW_MIN_ORDER'
+                }, status=status.HTTP_400_BAD_REQUEST)
+            
+            try:
+                reservation = reserve(pk, request.user, quantity)
+            except InsufficientStock:
+                return Response({
+                    'success': False,
+                    'message': 'Not enough stock left for this quantity.',
+                    'error': 'INSUFFICIENT_STOCK'
+                }, status=status.HTTP_409_CONFLICT)
+            
+            return Response({
+                'success': True,
+                'message': 'Stock reserved',
+                'reservation': InventoryReservationSerializer(reservation).data
+            }, status=status.HTTP_201_CREATED)
+            
+        except Exception as e:
+            logger.error(f"Error reserving stock: {str(e)}")
+            return Response({
+                'success': False,
+                'message': 'Unable to reserve stock. Please try again.',
+                'error': 'RESERVATION_ERROR'
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class ReservationListView(generics.ListAPIView):
+    """The current user's active reservations"""
+    serializer_class = InventoryReservationSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    
+    def get_queryset(self):
+        return InventoryReservation.objects.filter(
+            user=self.request.user, expires_at__gt=timezone.now()
+        ).order_by('expires_at')
+    
+    def list(self, request, *args, **kwargs):
+        serializer = self.get_serializer(self.get_queryset(), many=True)
+        return Response({
+            'success': True,
+            'reservations': serializer.data
+        })
+
+
+class ReservationDetailView(APIView):
+    """Release a reservation, returning its stock"""
+    permission_classes = [permissions.IsAuthenticated]
+    http_method_names = ['delete', 'options']
+    
+    def get_reservation(self, pk):
+        return InventoryReservation.objects.filter(pk=pk, user=self.request.user).first()
+    
+    def not_found(self):
+        return Response({
+            'success': False,
+            'message': 'Reservation not found or already expired.',
+            'error': 'NOT_FOUND'
+        }, status=status.HTTP_404_NOT_FOUND)
+    
+    def delete(self, request, pk):
+        try:
+            reservation = self.get_reservation(pk)
+            if reservation is None or not release(reservation):
+                return self.not_found()
+            return Response({
+                'success': True,
+                'message': 'Reservation released'
+            })
+        except Exception as e:
+            logger.error(f"Error releasing reservation: {str(e)}")
+            return Response({
+                'success': False,
+                'message': 'Unable to release the reservation.',
+                'error': 'RESERVATION_ERROR'
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class ReservationConfirmView(ReservationDetailView):
+    """Turn a reservation into a sale"""
+    http_method_names = ['post', 'options']
+    
+    def post(self, request, pk):
+        try:
+            reservation = self.get_reservation(pk)
+            if reservation is None or not confirm(reservation):
+                return self.not_found()
+            return Response({
+                'success': True,
+                'message': 'Reservation confirmed',
+                'reservation': InventoryReservationSerializer(reservation).data
+            })
+        except Exception as e:
+            logger.error(f"Error confirming reservation: {str(e)}")
+            return Response({
+                'success': False,
+                'message': 'Unable to confirm the reservation.',
+                'error': 'RESERVATION_ERROR'
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
 class ContactUsView(APIView):
     """Contact us endpoint"""
     
@@ -704,6 +1414,17 @@ class FavoriteToggleView(APIView):
     """Add/remove product from favorites"""
     permission_classes = [permissions.IsAuthenticated]
     
+    @retry_on_lock
+    def toggle(self, user, product):
+        """Add or remove the favorite; True when it was added"""
+        with transaction.atomic():
+            lock_favorites(user.pk)
+            favorite, created = Favorite.objects.get_or_create(user=user, product=product)
+            transaction.on_commit(lambda: invalidate_favorites(user.pk))
+            if not created:
+                favorite.delete()
+            return created
+    
     def post(self, request, product_id):
         try:
             if not request.user.is_horeca:
@@ -722,25 +1443,18 @@ class FavoriteToggleView(APIView):
                     'error': 'PRODUCT_NOT_FOUND'
                 }, status=status.HTTP_404_NOT_FOUND)
             
-            with transaction.atomic():
-                favorite, created = Favorite.objects.get_or_create(
-                    user=request.user,
-                    product=product
-                )
-                
-                if created:
-                    return Response({
-                        'success': True,
-                        'message': 'Product added to favorites',
-                        'action': 'added'
-                    }, status=status.HTTP_201_CREATED)
-                else:
-                    favorite.delete()
-                    return Response({
-                        'success': True,
-                        'message': 'Product removed from favorites',
-                        'action': 'removed'
-                    }, status=status.HTTP_200_OK)
+            if self.toggle(request.user, product):
+                return Response({
+                    'success': True,
+                    'message': 'Product added to favorites',
+                    'action': 'added'
+                }, status=status.HTTP_201_CREATED)
+            else:
+                return Response({
+                    'success': True,
+                    'message': 'Product removed from favorites',
+                    'action': 'removed'
+                }, status=status.HTTP_200_OK)
                     
         except Exception as e:
             logger.error(f"Error toggling favorite: {str(e)}")
@@ -751,7 +1465,93 @@ class FavoriteToggleView(APIView):
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
-class FavoriteListView(generics.ListAPIView):
+class FavoriteBatchView(APIView):
+    """Add and remove many favorites in one transaction"""
+    permission_classes = [permissions.IsAuthenticated]
+    
+    def get_product_ids(self, key):
+        if not isinstance(self.request.data, dict):
+            raise ValueError("Send an object with 'add' and 'remove' lists.")
+        value = self.request.data.get(key, [])
+        if not isinstance(value, list) or not all(
+            isinstance(pk, int) and not isinstance(pk, bool) for pk in value
+        ):
+            raise ValueError(f"'{key}' must be a list of product ids.")
+        return set(value)
+    
+    @retry_on_lock
+    def apply(self, user, add, remove):
+        """Return (already favorited, added, removed) product ids"""
+        with transaction.atomic():
+            # Nobody else changes this user's favorites until we commit, so
+            # every product in `available` is inserted here
+            lock_favorites(user.pk)
+            existing = set(Favorite.objects.filter(
+                user=user, product_id__in=add | remove
+            ).values_list('product_id', flat=True))
+            available = set(Product.objects.filter(
+                id__in=add - existing, status='available'
+            ).values_list('id', flat=True))
+            created = Favorite.objects.bulk_create(
+                [Favorite(user=user, product_id=pk) for pk in available],
+                ignore_conflicts=True
+            )
+            # bulk_create skips post_save, so count the new favorites here
+            if created:
+                record_favorites(available, created[0].created_at)
+            removed = existing & remove
+            if removed:
+                Favorite.objects.filter(user=user, product_id__in=removed).delete()
+            transaction.on_commit(lambda: invalidate_favorites(user.pk))
+        return existing, available, removed
+    
+    def post(self, request):
+        try:
+            if not request.user.is_horeca:
+                return Response({
+                    'success': False,
+                    'message': 'Only HoReCa users can manage favorites.',
+                    'error': 'PERMISSION_DENIED'
+                }, status=status.HTTP_403_FORBIDDEN)
+            
+            try:
+                add = self.get_product_ids('add')
+                remove = self.get_product_ids('remove') - add
+            except ValueError as e:
+                return Response({
+                    'success': False,
+                    'message': str(e),
+                    'error': 'VALIDATION_ERROR'
+                }, status=status.HTTP_400_BAD_REQUEST)
+            
+            limit = getattr(settings, 'FAVORITES_BATCH_LIMIT', 500)
+            if len(add) + len(remove) > limit:
+                return Response({
+                    'success': False,
+                    'message': f'At most {limit} products can be changed at once.',
+                    'error': 'VALIDATION_ERROR'
+                }, status=status.HTTP_400_BAD_REQUEST)
+            
+            existing, available, removed = self.apply(request.user, add, remove)
+            
+            return Response({
+                'success': True,
+                'message': 'Favorites updated',
+                'added': sorted(available),
+                'removed': sorted(removed),
+                'not_found': sorted(add - existing - available)
+            }, status=status.HTTP_200_OK)
+            
+        except Exception as e:
+            logger.error(f"Error updating favorites in batch: {str(e)}")
+            return Response({
+                'success': False,
+                'message': 'Unable to update favorites. Please try again.',
+                'error': 'FAVORITE_ERROR'
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class FavoriteListView(ReplicaReadMixin, generics.ListAPIView):
     """List user's favorite products"""
     serializer_class = FavoriteSerializer
     permission_classes = [permissions.IsAuthenticated]
@@ -761,8 +1561,8 @@ class FavoriteListView(generics.ListAPIView):
     
     def list(self, request, *args, **kwargs):
         try:
-            queryset = self.get_queryset()
-            serializer = self.get_serializer(queryset, many=True)
+            queryset = self.get_queryset().values_list(*FavoriteRowSerializer.columns())
+            serializer = FavoriteRowSerializer(queryset, context=self.get_serializer_context())
             return Response({
                 'success': True,
                 'favorites': serializer.data
@@ -812,6 +1612,18 @@ def dashboard_stats(request):
 
 
 @api_view(['GET'])
+@permission_classes([permissions.IsAdminUser])
+def database_pool_stats(request):
+    """Connection pool usage and wait times for this worker process"""
+    return Response({
+        'success': True,
+        'pid': os.getpid(),
+        'pools': pool_stats()
+    })
+
+
+@api_view(['GET'])
+@use_replica
 def search_suggestions(request):
     """Search suggestions for auto-complete"""
     try:
@@ -844,4 +1656,39 @@ def search_suggestions(request):
             'success': False,
             'message': 'Unable to fetch search suggestions.',
             'error': 'SEARCH_ERROR'
-        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
\ No newline at end of file
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+async def product_events(request):
+    """
+    Server-Sent Events stream of price and stock changes for
+    ?topics=product:<id>,category:<id>,farmer:<id>
+    """
+    if request.method != 'GET':
+        return JsonResponse({
+            'success': False,
+            'message': 'Method not allowed.',
+            'error': 'METHOD_NOT_ALLOWED'
+        }, status=405)
+    if not isinstance(request, ASGIRequest):
+        # A WSGI worker would be tied up for the lifetime of the stream
+        return JsonResponse({
+            'success': False,
+            'message': 'Live updates are only served by the ASGI application.',
+            'error': 'ASGI_REQUIRED'
+        }, status=501)
+    try:
+        topics = parse_topics(request.GET.get('topics', ''))
+    except ValueError as e:
+        return JsonResponse({'success': False, 'message': str(e), 'error': 'INVALID_TOPICS'}, status=400)
+    if not topics:
+        return JsonResponse({
+            'success': False,
+            'message': 'At least one topic is required.',
+            'error': 'INVALID_TOPICS'
+        }, status=400)
+    
+    response = StreamingHttpResponse(sse_stream(broker.subscribe(topics)), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
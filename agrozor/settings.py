@@ -14,6 +14,7 @@ from pathlib import Path
 from django.contrib.messages import constants as messages
 
 import os 
+import sys
 
 MESSAGE_TAGS = {
     messages.DEBUG: 'toast-debug',
@@ -62,8 +63,12 @@ DEBUG = True
 
 REST_FRAMEWORK = {
     'DEFAULT_RENDERER_CLASSES': [
-        'rest_framework.renderers.JSONRenderer',
-        'rest_framework.renderers.BrowsableAPIRenderer',  # Add this
+        'Main.renderers.ORJSONRenderer',
+    ] + (['rest_framework.renderers.BrowsableAPIRenderer'] if DEBUG else []),
+    'DEFAULT_PARSER_CLASSES': [
+        'Main.parsers.ORJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
     ],
     'DEFAULT_AUTHENTICATION_CLASSES': [
         'rest_framework_simplejwt.authentication.JWTAuthentication',
@@ -113,17 +118,95 @@ CORS_ALLOWED_ORIGINS = [
 ]
 MIDDLEWARE = [
         'corsheaders.middleware.CorsMiddleware',  # Add this at the TOP!
+    'Main.logs.RequestLogMiddleware',  # Request ids and timings; above compression so it is timed too
+    'Main.middleware.CompressionMiddleware',  # Must stay above anything that reads the body
 
    'django.middleware.security.SecurityMiddleware',
     'django.middleware.common.BrokenLinkEmailsMiddleware',  # Logs broken links
+    'django.middleware.http.ConditionalGetMiddleware',  # ETags on the uncompressed body
 
-    'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
+    'Main.middleware.BrowserOnlyMiddleware',  # Runs BROWSER_MIDDLEWARE outside /api/
+    'Main.middleware.ReadYourWritesMiddleware',
+    'django.middleware.clickjacking.XFrameOptionsMiddleware',
+]
+
+# Session, CSRF, auth and messages middleware are only needed by the admin and
+# other browser pages; API requests authenticate with JWT and skip them.
+API_PATH_PREFIX = '/api/'
+BROWSER_MIDDLEWARE = [
+    'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
-    'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
+# The admin checks look for these in MIDDLEWARE; BrowserOnlyMiddleware runs them
+SILENCED_SYSTEM_CHECKS = ['admin.E408', 'admin.E409', 'admin.E410']
+
+# Logging: JSON lines written by a background thread (see Main.logs), to
+# LOG_FILE or stderr. LOG_INFO_SAMPLE_RATE is the fraction of requests whose
+# INFO logs (including the per-request timing line) are kept; warnings and
+# errors are always kept. LOG_REQUEST_LEVEL=WARNING turns off the timing lines,
+# as `manage.py test` does by default. django.request's 4xx and CSRF failure
+# warnings are only logged with DEBUG on, as in Django's default logging.
+TESTING = sys.argv[1:2] == ['test']
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+LOG_REQUEST_LEVEL = os.environ.get('LOG_REQUEST_LEVEL', 'WARNING' if TESTING else LOG_LEVEL)
+LOG_FILE = os.environ.get('LOG_FILE')
+LOG_INFO_SAMPLE_RATE = float(os.environ.get('LOG_INFO_SAMPLE_RATE', 1.0))
+LOG_QUEUE_SIZE = 10000  # Records beyond this are dropped rather than blocking a request
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'filters': {
+        'request_context': {'()': 'Main.logs.RequestContextFilter'},
+        'sampling': {'()': 'Main.logs.SamplingFilter', 'rate': LOG_INFO_SAMPLE_RATE},
+        'errors_unless_debug': {'()': 'Main.logs.ErrorsUnlessDebugFilter'},
+    },
+    'handlers': {
+        'queue': {
+            '()': 'Main.logs.QueueLogHandler',
+            'filename': LOG_FILE,
+            'maxsize': LOG_QUEUE_SIZE,
+            'filters': ['request_context', 'sampling'],
+        },
+    },
+    # Third-party libraries only log warnings and errors
+    'root': {'handlers': ['queue'], 'level': 'WARNING'},
+    'loggers': {
+        'Main': {'level': LOG_LEVEL},
+        'Main.requests': {'level': LOG_REQUEST_LEVEL},
+        'django': {'handlers': ['queue'], 'level': LOG_LEVEL, 'propagate': False},
+        'django.request': {'filters': ['errors_unless_debug']},
+        'django.security.csrf': {'filters': ['errors_unless_debug']},
+    },
+}
+
+# Response compression (see Main.middleware.CompressionMiddleware)
+COMPRESSION_ENCODINGS = ['zstd', 'br', 'gzip']  # Server preference; br needs the brotli package
+COMPRESSION_MIN_LENGTH = 512  # Smaller bodies are sent uncompressed
+COMPRESSION_CONTENT_TYPES = [
+    'application/json',
+    'application/vnd.oai.openapi',
+    'application/vnd.oai.openapi+json',
+    'application/javascript',
+    'text/*',
+]
+COMPRESSION_EXCLUDED_CONTENT_TYPES = ['text/event-stream']  # Matched by text/* but must reach clients unbuffered
+COMPRESSION_LEVELS = {'zstd': 3, 'br': 4, 'gzip': 6}
+COMPRESSION_CACHE_TIMEOUT = 300  # Seconds to keep compressed bytes per ETag, 0 disables
+
+# Facet counts on ProductListView (see Main.facets.FacetIndex)
+FACET_PRICE_BUCKETS = [50, 100, 250, 500, 1000]  # Upper bounds of the price buckets, last one is open-ended
+FACET_LOCATION_LIMIT = 20  # Most common locations returned
+FACET_INDEX_MAX_AGE = 300  # Seconds before a full index rebuild
+
+# Nearby product search (see Main.geo.GeoIndex)
+GEO_CELL_DEGREES = 0.1  # Grid cell size, roughly 11 km
+GEO_MAX_RADIUS_KM = 500
+GEO_MAX_RESULTS = 2000  # Nearest products considered per query
+GEO_OVERLAY_LIMIT = 10000  # Pending writes before the arrays are rebuilt
+GEO_INDEX_MAX_AGE = 600  # Seconds before a full index rebuild
 
 ROOT_URLCONF = 'agrozor.urls'
 
@@ -149,13 +232,160 @@ WSGI_APPLICATION = 'agrozor.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
+# Main.db.sqlite3 applies WAL, synchronous=NORMAL, mmap/cache sizes and a
+# busy_timeout on connect and takes the write lock with BEGIN IMMEDIATE;
+# override individual pragmas with a PRAGMAS dict.
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
+        'ENGINE': 'Main.db.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {'timeout': 20},
     }
 }
 
+# Write transactions that hit lock contention are retried with jittered backoff
+DB_LOCK_RETRIES = 5
+DB_LOCK_RETRY_DELAY = 0.05
+
+# PostgreSQL mode: set POSTGRES_DB plus POSTGRES_USER, POSTGRES_PASSWORD,
+# POSTGRES_HOST and POSTGRES_PORT. Connections come from a per-process pool of
+# POSTGRES_POOL_SIZE, growing by up to POSTGRES_POOL_MAX_OVERFLOW under load.
+# With a pool size of 0, Django keeps a persistent connection per thread instead.
+POSTGRES_POOL_SIZE = int(os.environ.get('POSTGRES_POOL_SIZE', 5))
+
+
+def postgres_database(host):
+    pooled = POSTGRES_POOL_SIZE > 0
+    return {
+        'ENGINE': 'Main.db.postgresql' if pooled else 'django.db.backends.postgresql',
+        'NAME': os.environ['POSTGRES_DB'],
+        'USER': os.environ.get('POSTGRES_USER', ''),
+        'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+        'HOST': host,
+        'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+        # Pooled connections go back to the pool when each request ends
+        'CONN_MAX_AGE': 0 if pooled else int(os.environ.get('POSTGRES_CONN_MAX_AGE', 60)),
+        'CONN_HEALTH_CHECKS': True,
+        'POOL': {
+            'SIZE': POSTGRES_POOL_SIZE,
+            'MAX_OVERFLOW': int(os.environ.get('POSTGRES_POOL_MAX_OVERFLOW', 10)),
+            'TIMEOUT': float(os.environ.get('POSTGRES_POOL_TIMEOUT', 10)),
+            'PRE_PING': float(os.environ.get('POSTGRES_POOL_PRE_PING', 30)),
+        },
+    }
+
+
+if os.environ.get('POSTGRES_DB'):
+    DATABASES['default'] = postgres_database(os.environ.get('POSTGRES_HOST', 'localhost'))
+
+# Read replicas for the catalog endpoints: comma-separated hosts in
+# POSTGRES_REPLICA_HOSTS, or SQLite paths in DATABASE_REPLICA_PATHS.
+# Tests mirror them onto the primary test database.
+DATABASE_REPLICAS = []
+if os.environ.get('POSTGRES_DB'):
+    replica_configs = [postgres_database(host.strip()) for host in
+                       filter(None, os.environ.get('POSTGRES_REPLICA_HOSTS', '').split(','))]
+else:
+    replica_configs = [{'ENGINE': 'Main.db.sqlite3', 'NAME': path.strip()} for path in
+                       filter(None, os.environ.get('DATABASE_REPLICA_PATHS', '').split(','))]
+for number, config in enumerate(replica_configs, 1):
+    DATABASES[f'replica{number}'] = dict(config, TEST={'MIRROR': 'default'})
+    DATABASE_REPLICAS.append(f'replica{number}')
+DATABASE_ROUTERS = ['Main.routers.ReplicaRouter']
+# Reads stay on the primary this long after a user's last write
+READ_YOUR_WRITES_SECONDS = 10
+
+# Cache shared by all workers when REDIS_URL is set, per-process memory otherwise.
+# The facet, geo and semantic indexes learn about other workers' writes through
+# it (see Main.resync); without Redis they only catch up at their max-age rebuilds.
+REDIS_URL = os.environ.get('REDIS_URL')
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# Per-user favorite id sets; only cached when the cache is shared between workers
+FAVORITES_CACHE_TIMEOUT = 300 if REDIS_URL else 0
+FAVORITES_BATCH_LIMIT = 500
+
+# Most distinct ids /api/products/batch/?ids= accepts in one request
+PRODUCT_BATCH_LIMIT = 200
+
+# Favorites older than this count half as much towards sort=popular
+POPULARITY_HALF_LIFE_DAYS = 7
+
+# Category and featured lists and product page sections are cached with
+# single-flight recomputation: fresh for *_CACHE_SECONDS, then served stale for
+# up to SINGLE_FLIGHT_STALE_SECONDS while one request (in one worker) refreshes them
+CATEGORY_CACHE_SECONDS = 300
+FEATURED_CACHE_SECONDS = 60
+PRODUCT_PAGE_CACHE_SECONDS = 60  # Product and farmer sections of /api/products/<id>/page/
+PRODUCT_PAGE_FARMER_PRODUCTS = 8  # "More from this farmer" on the product page
+SINGLE_FLIGHT_STALE_SECONDS = 600
+SINGLE_FLIGHT_LOCK_SECONDS = 30  # Cross-worker recompute lock
+SINGLE_FLIGHT_WAIT_SECONDS = 5  # Longest a cold miss waits for another request's result
+# Origin (e.g. https://api.agrozor.in) absolute URLs in cached payloads are built
+# from. Unset, payloads are cached per request host, for hosts in ALLOWED_HOSTS
+# other than '*' only; requests for any other host bypass the cache
+PUBLIC_BASE_URL = os.environ.get('PUBLIC_BASE_URL')
+
+# Delta sync (/api/products/changes/); compact with `manage.py compact_product_changes`
+PRODUCT_CHANGES_PAGE_SIZE = 500
+PRODUCT_CHANGES_SETTLE_SECONDS = 2  # Entries younger than this are not served yet
+PRODUCT_CHANGES_TOMBSTONE_DAYS = 30  # Older sync tokens must download the catalog again
+
+# `manage.py sweep_products`: discontinue expired products, then archive the
+# ones left untouched as discontinued for PRODUCT_ARCHIVE_AFTER_DAYS
+PRODUCT_SWEEP_BATCH_SIZE = 500
+PRODUCT_ARCHIVE_AFTER_DAYS = 90
+PRODUCT_ARCHIVE_BATCH_SIZE = 200
+
+# Price trend endpoints; run `manage.py rollup_category_prices` hourly for the category trends
+PRICE_TREND_DEFAULT_DAYS = 30
+PRICE_TREND_MAX_DAYS = 365
+
+# Stock reservations; run `manage.py expire_reservations` every minute or so
+INVENTORY_RESERVATION_TTL_SECONDS = 900
+INVENTORY_EXPIRY_BATCH_SIZE = 500
+
+# Live price/stock updates over SSE (/api/events/) and WebSockets (/ws/events/),
+# served by agrozor.asgi. Set REALTIME_REDIS_URL to relay events between workers.
+REALTIME_REDIS_URL = os.environ.get('REALTIME_REDIS_URL', REDIS_URL)
+REALTIME_CHANNEL = 'agrozor:products'
+REALTIME_WEBSOCKET_PATH = '/ws/events/'
+REALTIME_COALESCE_SECONDS = 0.25
+REALTIME_HEARTBEAT_SECONDS = 15
+REALTIME_MAX_TOPICS = 50
+
+# "Also favorited" recommendations, rebuilt by `manage.py build_related_products`
+RECOMMENDATIONS_DIR = BASE_DIR / 'var' / 'recommendations'
+RECOMMENDATIONS_TOP_K = 20
+# Only a user's most recent favorites count, bounding the pairs per user
+RECOMMENDATIONS_MAX_USER_ITEMS = 500
+
+# Semantic product search (?search=...&semantic=true). Uses faiss when installed
+# and a spaCy model with word vectors when SEMANTIC_SEARCH_MODEL is set;
+# otherwise a hashing vectorizer with synonym folding that works offline.
+# Requests only read the build published by `manage.py build_semantic_index`;
+# run it at deploy and periodically (semantic matches are skipped until then).
+SEMANTIC_SEARCH_MODEL = os.environ.get('SEMANTIC_SEARCH_MODEL')
+SEMANTIC_SEARCH_DIMENSIONS = 256
+SEMANTIC_SEARCH_CANDIDATES = 200
+SEMANTIC_SEARCH_MIN_SCORE = 0.2
+SEMANTIC_INDEX_DIR = BASE_DIR / 'var' / 'semantic'
+SEMANTIC_OVERLAY_LIMIT = 5000  # Products changed since the build before a rebuild is due (logged)
+SEMANTIC_INDEX_MAX_AGE = 300  # Seconds between checks for a newer build and missed writes
+SEMANTIC_FAISS_NPROBE = 16
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -202,7 +432,10 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
-SESSION_ENGINE = 'django.contrib.sessions.backends.db'  # Default is the database
+# Sessions (admin only) live in Redis when it is configured, otherwise they
+# are written through to the database and read from the local cache
+SESSION_ENGINE = ('django.contrib.sessions.backends.cache' if REDIS_URL
+                  else 'django.contrib.sessions.backends.cached_db')
 
 
 # CORS Configuration